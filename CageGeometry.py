@@ -0,0 +1,98 @@
+"""Capture cage geometry (centroid, basis and region boxes) computed from its target markers."""
+
+import numpy as np
+
+import Metashape
+
+
+class CageGeometry:
+    """ Geometry of the capture cage computed from its target markers: the
+        centroid and width of the cage, its up/view basis and the oriented
+        region boxes used to limit reconstruction. Build one through
+        MetaUtils.getCageGeometry() which caches it until the markers or the
+        chunk transform change. """
+
+    # Coplanar corner targets (the first two also give the width and view direction)
+    CORNER_LABELS = ('target 15', 'target 11', 'target 13', 'target 9')
+
+    # Target above the first corner giving the "upward" direction
+    UP_LABEL = 'target 20'
+
+    # Size of the tie point filter box relative to the cage width (horizontal, vertical)
+    FILTER_SCALE = (2.138, 1.145)
+
+    def __init__(self, lookup, transform):
+        positions = {marker.label: marker.position for marker in lookup.markers
+                     if marker.position is not None}
+
+        # Every corner is needed for the centroid, width and basis
+        missing = [label for label in CageGeometry.CORNER_LABELS if label not in positions]
+        if len(missing) > 0:
+            raise Exception('Cage Geometry Error - markers not found or not placed: ' + ', '.join(missing))
+
+        corners = np.array([[positions[label].x, positions[label].y, positions[label].z]
+                            for label in CageGeometry.CORNER_LABELS])
+
+        # Centroid and width of the cage
+        centroid = np.mean(corners, axis=0)
+        self.centroid = Metashape.Vector(centroid)
+        self.width = float(np.linalg.norm(corners[1] - corners[0]))
+
+        # Best-fit plane normal (eigenvector of the smallest covariance eigenvalue)
+        eigenvalues, eigenvectors = np.linalg.eig(np.cov((corners - centroid).T))
+        self.up = Metashape.Vector(eigenvectors[:, np.argmin(eigenvalues)])
+
+        # View direction from the first two corners
+        self.view = (positions[CageGeometry.CORNER_LABELS[0]] - positions[CageGeometry.CORNER_LABELS[1]]).normalized()
+
+        # Flip the normal to agree with the up target (when it was found)
+        self.upward = None
+        if CageGeometry.UP_LABEL in positions:
+            self.upward = (positions[CageGeometry.UP_LABEL] - positions[CageGeometry.CORNER_LABELS[0]]).normalized()
+            if self.up * self.upward < 0: self.up = -self.up
+
+        # Region rotation follows the chunk transform
+        self.regionRot = transform.rotation.t() if transform.rotation is not None else None
+        self.regionBoxes = {}
+
+    @staticmethod
+    def stateOf(lookup, transform):
+        """ Everything the geometry depends on, for detecting when it must be rebuilt """
+        positions = tuple((marker.label, None if marker.position is None else
+                           (marker.position.x, marker.position.y, marker.position.z))
+                          for marker in lookup.markers)
+        matrix = transform.matrix
+        if matrix is not None:
+            matrix = tuple(matrix.row(i)[j] for i in range(4) for j in range(4))
+        return positions, matrix
+
+    def regionBox(self, scaler):
+        """ Center, size and rotation of the reconstruction region for a scale factor """
+        if scaler not in self.regionBoxes:
+            if self.regionRot is None:
+                raise Exception('Cage Geometry Error - the chunk has no transform (run chunkCorrect first)')
+
+            if scaler > 0.75:
+                center = self.centroid
+                size = Metashape.Vector((self.width * scaler, self.width * scaler, self.width * scaler))
+            else:
+                # Slightly lower than centroid and don't let height be below 75%
+                yAxis = Metashape.Matrix.Rotation(self.regionRot).mulv(Metashape.Vector((0, 1, 0)))
+                adjust = self.width * 0.05
+                center = Metashape.Vector((
+                    self.centroid.x - yAxis.x * adjust,
+                    self.centroid.y - yAxis.y * adjust,
+                    self.centroid.z - yAxis.z * adjust
+                ))
+                size = Metashape.Vector((self.width * scaler, self.width * 0.75, self.width * scaler))
+
+            self.regionBoxes[scaler] = (center, size, self.regionRot)
+
+        center, size, rot = self.regionBoxes[scaler]
+        return center.copy(), size.copy(), rot.copy()
+
+    def filterBox(self):
+        """ Center and size of the box outside of which tie points are removed """
+        horizSize = CageGeometry.FILTER_SCALE[0] * self.width
+        vertSize = CageGeometry.FILTER_SCALE[1] * self.width
+        return self.centroid.copy(), Metashape.Vector([horizSize, vertSize, horizSize])
@@ -0,0 +1,104 @@
+"""A JSON store of optimized camera calibrations keyed by camera body, lens and focal length.
+
+The rig's cameras and lenses are fixed, so the intrinsics optimized in one
+session are a good starting point (or a fixed calibration) for the next.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import concurrent.futures
+
+import ExifHeader
+
+# Default store file name
+DEFAULT_FILENAME = 'calibrations.json'
+
+# Metashape.Calibration parameters kept in the store
+CALIBRATION_PARAMETERS = ('f', 'cx', 'cy', 'b1', 'b2', 'k1', 'k2', 'k3', 'k4', 'p1', 'p2', 'p3', 'p4')
+
+# Number of threads reading headers in parallel
+DEFAULT_WORKERS = 8
+
+
+def cameraIdentity(filename):
+    """ (serial, lens model, focal length) of the camera that took an image from its EXIF
+        data, with None for anything missing """
+    exif = ExifHeader.readExif(filename)
+    serial = exif.get('serial') if isinstance(exif.get('serial'), str) and exif.get('serial') else None
+    lens = exif.get('lensModel') if isinstance(exif.get('lensModel'), str) and exif.get('lensModel') else None
+    focal = exif.get('focalLength')
+    focal = round(float(focal), 1) if isinstance(focal, (int, float)) and focal > 0 else None
+    return serial, lens, focal
+
+
+def identifyCameras(filenames, workers=None):
+    """ {filename: (serial, lens model, focal length)} read in parallel """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers or DEFAULT_WORKERS) as executor:
+        return dict(zip(filenames, executor.map(cameraIdentity, filenames)))
+
+
+def calibrationKey(serial, lens, focal):
+    """ Store key of a camera identity (None when there is no serial to tell bodies apart) """
+    if serial is None:
+        return None
+    return '%s|%s|%s' % (serial, lens or '', '' if focal is None else '%.1f' % focal)
+
+
+def loadStore(path):
+    """ The {key: entry} store saved at path ({} when there is none yet) """
+    try:
+        with open(path, 'r') as storeFile:
+            return json.load(storeFile)
+    except FileNotFoundError:
+        return {}
+    except ValueError as e:
+        raise Exception('Calibration Store Error - "{}" is not a calibration store: {}'.format(path, e))
+
+
+def saveStore(path, store):
+    """ Save the store atomically so an interrupted run never leaves it half written """
+    with open(path + '.tmp', 'w') as storeFile:
+        json.dump(store, storeFile, indent=1, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+def findCalibration(store, key, width, height):
+    """ The stored {parameter: value} calibration for a key, or None when there is none for
+        images of this size """
+    entry = store.get(key)
+    if entry is None or entry['width'] != width or entry['height'] != height:
+        return None
+    return entry['calibration']
+
+
+def recordCalibration(store, key, width, height, calibration, error=None):
+    """ Replace the calibration stored for a key with a newly optimized one """
+    previous = store.get(key, {})
+    store[key] = {
+        'width': width,
+        'height': height,
+        'calibration': {parameter: float(calibration[parameter]) for parameter in CALIBRATION_PARAMETERS},
+        'error': error,
+        'sessions': previous.get('sessions', 0) + 1,
+        'updated': time.strftime('%Y-%m-%d %H:%M:%S')
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='CalibrationStore.py',
+        description='List the camera calibrations in a store.'
+    )
+    parser.add_argument('store', nargs='?', default=DEFAULT_FILENAME, help='Calibration store file.')
+    args = parser.parse_args()
+
+    store = loadStore(args.store)
+    for key, entry in sorted(store.items()):
+        calibration = entry['calibration']
+        print('%s\t%dx%d\tf=%.2f cx=%.2f cy=%.2f k1=%.5f\t%d sessions, updated %s' % (
+            key, entry['width'], entry['height'], calibration['f'], calibration['cx'], calibration['cy'],
+            calibration['k1'], entry['sessions'], entry['updated']))
+    print('%d calibrations' % len(store), file=sys.stderr)
@@ -0,0 +1,140 @@
+"""Stage checkpoints kept in the project so an interrupted workflow can resume.
+
+Each completed stage (sharpness, pose priors, calibrations, masks, alignment,
+correction, region, filtering, depth maps, point cloud and each model's mesh,
+UV and texture) is recorded in the chunk's
+metadata with its parameters and the state of the chunk it produced. When
+resuming, a stage is skipped if it ran with the same parameters and the chunk
+still holds its results, so a failure only costs the stage that failed.
+"""
+
+import json
+import time
+
+import Logger
+logger = None
+
+
+class Checkpoints:
+    """ Stage records of one chunk. The chunk state is a few cheap measures (such as the
+        number of aligned cameras or the faces of a model). Once a stage has to run again
+        every later stage that depends on it runs again too """
+
+    # Metadata key prefix of the stage records
+    META_PREFIX = 'PARSEC/stage/'
+
+    def __init__(self, chunk, resume=False):
+        self.chunk = chunk
+        self.resume = resume
+
+        # An earlier stage ran again so the results of later ones are out of date
+        self.restarted = False
+
+        # Stages skipped because they were already complete
+        self.skipped = []
+
+    @staticmethod
+    def ensureLoggerReady():
+        global logger
+        if logger is None:
+            logger = Logger.getLogger('MetaUtils')
+
+    # Measure of one part of the chunk state, e.g. 'cameras' or 'mesh:<model label>'
+    def measure(self, facet):
+        chunk = self.chunk
+        name, _, label = facet.partition(':')
+        if name == 'enabled':
+            return sum(1 for camera in chunk.cameras if camera.enabled)
+        if name == 'references':
+            return sum(1 for camera in chunk.cameras if camera.reference.location is not None and camera.reference.location_enabled)
+        if name == 'sensors':
+            return sorted(sensor.label for sensor in chunk.sensors)
+        if name == 'masks':
+            return sum(1 for camera in chunk.cameras if camera.mask is not None)
+        if name == 'cameras':
+            return sum(1 for camera in chunk.cameras if camera.transform is not None)
+        if name == 'tiePoints':
+            return 0 if chunk.tie_points is None else len(chunk.tie_points.points)
+        if name == 'transform':
+            matrix = chunk.transform.matrix
+            return None if matrix is None else [round(matrix[row, column], 6) for row in range(4) for column in range(4)]
+        if name == 'region':
+            region = chunk.region
+            return [round(value, 6) for value in list(region.center) + list(region.size) +
+                    [region.rot[row, column] for row in range(3) for column in range(3)]]
+        if name == 'depthMaps':
+            return 0 if chunk.depth_maps is None else len(chunk.depth_maps.keys())
+        if name == 'pointCloud':
+            return 0 if chunk.point_cloud is None else chunk.point_cloud.point_count
+        if name in ('mesh', 'uv', 'texture'):
+            model = self.findModel(label)
+            if model is None:
+                return 0
+            return len({'mesh': model.faces, 'uv': model.tex_vertices, 'texture': model.textures}[name])
+
+        raise Exception('Checkpoint Error - unknown chunk state "{}"'.format(facet))
+
+    # The latest model with a label (None if there is none)
+    def findModel(self, label):
+        models = [model for model in self.chunk.models if model.label == label]
+        return models[-1] if len(models) > 0 else None
+
+    def state(self, facets):
+        return {facet: self.measure(facet) for facet in facets}
+
+    # Parameters as they read back from JSON (so a stored record compares equal)
+    @staticmethod
+    def normalize(params):
+        return json.loads(json.dumps(params, sort_keys=True, default=str))
+
+    def load(self, stage):
+        key = Checkpoints.META_PREFIX + stage
+        if key not in self.chunk.meta.keys():
+            return None
+        try:
+            return json.loads(self.chunk.meta[key])
+        except ValueError:
+            return None
+
+    # True when resuming and the stage already ran with these parameters and the chunk still
+    # holds its results (a stage whose results are all empty is never complete)
+    def isDone(self, stage, params, facets):
+        Checkpoints.ensureLoggerReady()
+
+        if not self.resume or self.restarted:
+            return False
+
+        record = self.load(stage)
+        if record is None or record['params'] != Checkpoints.normalize(params):
+            return False
+
+        state = self.state(facets)
+        if record['state'] != state or not any(state.values()):
+            return False
+
+        logger.info("Skipping %s (completed %s)" % (stage, record['completed']))
+        self.skipped.append(stage)
+        return True
+
+    # Records a completed stage (saved with the project on the next save)
+    # - restartsLater makes every later stage run again when this one ran while resuming
+    def complete(self, stage, params, facets, elapsed, restartsLater=True):
+        if self.resume and restartsLater:
+            self.restarted = True
+
+        self.chunk.meta[Checkpoints.META_PREFIX + stage] = json.dumps({
+            'params': Checkpoints.normalize(params),
+            'state': self.state(facets),
+            'elapsed': elapsed,
+            'completed': time.strftime('%Y-%m-%d %H:%M:%S')
+        })
+
+    # Runs function() as a stage unless it is already done, returning True if it ran
+    def run(self, stage, params, facets, function, restartsLater=True):
+        if self.isDone(stage, params, facets):
+            return False
+
+        startTime = time.perf_counter()
+        function()
+        self.complete(stage, params, facets, time.perf_counter() - startTime, restartsLater)
+        return True
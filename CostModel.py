@@ -0,0 +1,144 @@
+"""Predicted run times of the workflow stages at each quality level, for time budgeted runs.
+
+Every workflow run records how long each of its stages took for how many
+cameras. A stage's cost is predicted from the seconds per camera of the
+runs recorded on this machine (any machine when there are none, the rough
+default rates of the quality presets when there are no runs of that stage
+at all). A level with neither is never picked.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import itertools
+
+# Timing history file (shared by every project processed in the same directory)
+DEFAULT_FILENAME = 'timings.json'
+
+# Only the most recent records are kept
+MAX_RECORDS = 2000
+
+# Stages the workflows record
+STAGES = ('align', 'depth', 'dense', 'model_tie_points', 'model_depth_maps', 'model_dense_cloud')
+
+
+def parseDuration(text):
+    """ Seconds in a duration given as seconds ('900'), minutes ('45m'), hours ('1.5h')
+        or a clock time ('1:30:00' or '45:00') """
+    text = str(text).strip().lower()
+    try:
+        if ':' in text:
+            seconds = 0.0
+            for part in text.split(':'):
+                seconds = seconds * 60 + float(part)
+            return seconds
+        if text.endswith(('h', 'm', 's')):
+            return float(text[:-1]) * {'h': 3600, 'm': 60, 's': 1}[text[-1]]
+        return float(text)
+    except ValueError:
+        raise Exception('Time Budget Error - "{}" is not a duration (e.g. 900, 45m, 1.5h or 1:30:00)'.format(text))
+
+
+def loadHistory(path=DEFAULT_FILENAME):
+    """ The recorded timings (an empty list when there are none yet) """
+    try:
+        with open(path, 'r') as historyFile:
+            return json.load(historyFile)
+    except (OSError, ValueError):
+        return []
+
+
+def recordTiming(stage, level, cameras, seconds, path=DEFAULT_FILENAME):
+    """ Add the run time of one stage to the history (saved atomically) """
+    history = loadHistory(path)
+    history.append({'stage': stage, 'level': level, 'cameras': cameras, 'seconds': seconds,
+                    'host': platform.node(), 'recorded': time.strftime('%Y-%m-%d %H:%M:%S')})
+    with open(path + '.tmp', 'w') as historyFile:
+        json.dump(history[-MAX_RECORDS:], historyFile, indent=1)
+    os.replace(path + '.tmp', path)
+
+
+def stageRate(history, stage, level, defaultRates=None):
+    """ Seconds per camera of a stage: the least squares fit through the origin of the
+        recorded runs on this machine (or any machine), otherwise the default rate
+        ({stage: {level: rate}}). None when there is neither """
+    records = [record for record in history
+               if record['stage'] == stage and record['level'] == level and record['cameras'] > 0]
+    local = [record for record in records if record.get('host') == platform.node()]
+    records = local or records
+    if len(records) == 0:
+        return (defaultRates or {}).get(stage, {}).get(level)
+
+    return (sum(record['seconds'] * record['cameras'] for record in records) /
+            sum(record['cameras'] ** 2 for record in records))
+
+
+def predictCost(history, stage, level, cameras, defaultRates=None):
+    """ Predicted seconds for one stage (None when the level has no rate for it) """
+    rate = stageRate(history, stage, level, defaultRates)
+    return None if rate is None else rate * cameras
+
+
+def chooseLevels(budget, cameras, groups, levels, history, defaultRates=None):
+    """ Pick a quality level for each group of stages ({group: [stage, ...]}, every stage of a
+        group runs at the group's level) so the predicted total fits the budget. The choice with
+        the most quality (sum of level ranks in 'levels', lowest first) wins, then the cheapest.
+        When nothing fits the cheapest choice is returned. Levels that cannot be predicted for
+        every stage of a group (no recorded runs and no default rate) are never picked.
+        Returns ({group: level}, predicted seconds, whether it fits) """
+    costs = {}
+    for group, stages in groups.items():
+        costs[group] = {}
+        for rank, level in enumerate(levels):
+            predicted = [predictCost(history, stage, level, cameras, defaultRates) for stage in stages]
+            if None not in predicted:
+                costs[group][rank] = sum(predicted)
+        if len(costs[group]) == 0:
+            raise Exception('Time Budget Error - no level of {} has a recorded or default rate'.format(group))
+
+    choices = []
+    for combination in itertools.product(*(sorted(costs[group]) for group in groups)):
+        chosen = {group: levels[rank] for group, rank in zip(groups, combination)}
+        cost = sum(costs[group][rank] for group, rank in zip(groups, combination))
+        choices.append((sum(combination), -cost, chosen))
+
+    fitting = [choice for choice in choices if -choice[1] <= budget]
+    if len(fitting) > 0:
+        quality, cost, chosen = max(fitting, key=lambda choice: choice[:2])
+        return chosen, -cost, True
+
+    quality, cost, chosen = max(choices, key=lambda choice: choice[1])
+    return chosen, -cost, False
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='CostModel.py',
+        description='Show the predicted stage run times and the levels a time budget allows.'
+    )
+    parser.add_argument('cameras', type=int, help='Number of cameras in the session.')
+    parser.add_argument('-b', '--budget', action='store', default=None, help='Time budget (e.g. 900, 45m, 1.5h).')
+    parser.add_argument('-f', '--history', action='store', default=DEFAULT_FILENAME, help='Timing history file.')
+    args = parser.parse_args()
+
+    # The default rates are part of the quality presets (which need Metashape)
+    try:
+        from MetaWork import PRESET_ORDER as levels, presetRates
+        defaultRates = presetRates()
+    except ImportError:
+        levels, defaultRates = ('quick', 'general', 'archival'), {}
+        print('Metashape is not available, only recorded runs are used', file=sys.stderr)
+
+    history = loadHistory(args.history)
+    for stage in STAGES:
+        costs = [predictCost(history, stage, level, args.cameras, defaultRates) for level in levels]
+        print('%-18s' % stage + ''.join('%13s' % ('-' if cost is None else '%.0fs' % cost) for cost in costs))
+
+    if args.budget is not None:
+        groups = {'align': ['align'], 'dense': ['depth'], 'model': ['model_depth_maps']}
+        chosen, predicted, fits = chooseLevels(parseDuration(args.budget), args.cameras, groups, levels, history, defaultRates)
+        print('%s: %s (%.0fs predicted)' % ('Fits' if fits else 'Over budget',
+              ', '.join('%s %s' % (group, level) for group, level in chosen.items()), predicted), file=sys.stderr)
@@ -0,0 +1,258 @@
+"""Minimal header-only reader for the EXIF/TIFF tags we index.
+
+Only the few bytes of each IFD that are needed are read, so this stays fast
+on multi-megabyte RAW files. TIFF based formats (TIFF, DNG, NEF, CR2, ARW,
+ORF, RW2, PEF, ...) and JPEG files are supported; anything else returns an
+empty result. readImageInfo() also reports the image size and bit depth
+(including for PNG files) and whether the image data is cut short.
+"""
+
+import os
+import struct
+
+# Byte size of each TIFF field type
+TIFF_TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 6: 1, 7: 1, 8: 2, 9: 4, 10: 8, 11: 4, 12: 8, 13: 4, 16: 8}
+
+# struct format of each TIFF field type we decode
+TIFF_TYPE_FORMATS = {1: 'B', 3: 'H', 4: 'I', 6: 'b', 8: 'h', 9: 'i', 11: 'f', 12: 'd', 13: 'I', 16: 'Q'}
+
+# Tags read from IFD0 and the EXIF IFD (tag -> result key)
+IFD0_TAGS = {
+    0x010F: 'make',
+    0x0110: 'model',
+    0x0132: 'dateTime',
+    0x8769: 'exifIFD'
+}
+EXIF_TAGS = {
+    0x829A: 'exposureTime',
+    0x829D: 'fNumber',
+    0x8827: 'iso',
+    0x9003: 'dateTimeOriginal',
+    0x920A: 'focalLength',
+    0xA431: 'serial',
+    0xA434: 'lensModel'
+}
+
+# Never follow more than this many entries in one IFD (guards against garbage)
+MAX_IFD_ENTRIES = 1024
+
+# Tags describing the image data layout (tag -> result key)
+LAYOUT_TAGS = {
+    0x0100: 'width',
+    0x0101: 'height',
+    0x0102: 'bits',
+    0x0111: 'stripOffsets',
+    0x0117: 'stripByteCounts',
+    0x0144: 'tileOffsets',
+    0x0145: 'tileByteCounts'
+}
+
+# JPEG start of frame markers (all except DHT, JPG and DAC)
+JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+# Bytes at the end of a file searched for the JPEG end of image marker (allows for padding)
+JPEG_TRAILER_SEARCH = 4096
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+PNG_IEND_CHUNK = b'\0\0\0\0IEND\xaeB`\x82'
+
+
+class TiffReader:
+    """ Reads tags from a TIFF structure starting at 'base' in an open file """
+
+    def __init__(self, fileHandle, base=0):
+        self.file = fileHandle
+        self.base = base
+
+        self.file.seek(base)
+        header = self.file.read(8)
+        if len(header) < 8 or header[:2] not in (b'II', b'MM'):
+            raise ValueError('Not a TIFF header')
+
+        # Accept any magic number as several RAW formats use their own
+        self.order = '<' if header[:2] == b'II' else '>'
+        self.firstIFD = struct.unpack(self.order + 'I', header[4:8])[0]
+
+    def readIFD(self, offset, wantedTags):
+        """ Read the wanted tags of the IFD at offset into a {tag: value} dict """
+        values = {}
+        self.file.seek(self.base + offset)
+        countBytes = self.file.read(2)
+        if len(countBytes) < 2:
+            return values
+
+        count = struct.unpack(self.order + 'H', countBytes)[0]
+        entries = self.file.read(12 * min(count, MAX_IFD_ENTRIES))
+        for index in range(len(entries) // 12):
+            tag, fieldType, valueCount = struct.unpack(self.order + 'HHI', entries[index * 12:index * 12 + 8])
+            if tag in wantedTags and fieldType in TIFF_TYPE_SIZES:
+                values[tag] = self.readValue(fieldType, valueCount, entries[index * 12 + 8:index * 12 + 12])
+
+        return values
+
+    def readValue(self, fieldType, valueCount, valueBytes):
+        # Values larger than 4 bytes are stored at an offset
+        size = TIFF_TYPE_SIZES[fieldType] * valueCount
+        if size > 4:
+            self.file.seek(self.base + struct.unpack(self.order + 'I', valueBytes)[0])
+            valueBytes = self.file.read(size)
+            if len(valueBytes) < size:
+                return None
+
+        if fieldType == 2:
+            return valueBytes[:size].split(b'\0', 1)[0].decode('ascii', 'replace').strip()
+        if fieldType in (5, 10):
+            numbers = struct.unpack(self.order + ('I' if fieldType == 5 else 'i') * (2 * valueCount), valueBytes[:size])
+            values = [numbers[i] / numbers[i + 1] if numbers[i + 1] else 0.0 for i in range(0, len(numbers), 2)]
+        elif fieldType in TIFF_TYPE_FORMATS:
+            values = list(struct.unpack(self.order + TIFF_TYPE_FORMATS[fieldType] * valueCount, valueBytes[:size]))
+        else:
+            return valueBytes[:size]
+
+        return values[0] if valueCount == 1 else values
+
+
+def readTiffTags(fileHandle, base=0):
+    """ Read the indexed tags from the TIFF structure at base """
+    reader = TiffReader(fileHandle, base)
+    results = {}
+    for tag, value in reader.readIFD(reader.firstIFD, IFD0_TAGS).items():
+        results[IFD0_TAGS[tag]] = value
+
+    # Follow the pointer to the EXIF IFD
+    exifOffset = results.pop('exifIFD', None)
+    if isinstance(exifOffset, int):
+        for tag, value in reader.readIFD(exifOffset, EXIF_TAGS).items():
+            results[EXIF_TAGS[tag]] = value
+
+    return results
+
+
+def findJpegExif(fileHandle):
+    """ Return the file offset of the TIFF structure in a JPEG APP1 segment """
+    fileHandle.seek(2)
+    while True:
+        marker = fileHandle.read(4)
+        if len(marker) < 4 or marker[0] != 0xFF:
+            return None
+
+        # Stop at start of scan (image data follows)
+        markerType = marker[1]
+        length = struct.unpack('>H', marker[2:4])[0]
+        if markerType == 0xDA:
+            return None
+
+        if markerType == 0xE1:
+            if fileHandle.read(6) == b'Exif\0\0':
+                return fileHandle.tell()
+            fileHandle.seek(-6, 1)
+
+        fileHandle.seek(length - 2, 1)
+
+
+def readExif(filename):
+    """ Read the indexed EXIF fields of an image, returning {} when unavailable """
+    try:
+        with open(filename, 'rb') as fileHandle:
+            start = fileHandle.read(4)
+            if start[:2] == b'\xFF\xD8':
+                base = findJpegExif(fileHandle)
+                if base is None:
+                    return {}
+                results = readTiffTags(fileHandle, base)
+            elif start[:2] in (b'II', b'MM'):
+                results = readTiffTags(fileHandle)
+            else:
+                return {}
+    except (OSError, ValueError, struct.error):
+        return {}
+
+    # Prefer the original capture time
+    if 'dateTimeOriginal' in results:
+        results['dateTime'] = results.pop('dateTimeOriginal')
+
+    return results
+
+
+def readTiffLayout(fileHandle, fileSize):
+    """ Size, bit depth and truncation of the first image in a TIFF structure """
+    fileHandle.seek(2)
+    magic = fileHandle.read(2)
+
+    # BigTIFF uses 64 bit offsets which TiffReader does not handle, so only identify it
+    if magic in (b'\0+', b'+\0'):
+        return {'format': 'bigtiff'}
+
+    reader = TiffReader(fileHandle)
+    layout = {LAYOUT_TAGS[tag]: value for tag, value in reader.readIFD(reader.firstIFD, LAYOUT_TAGS).items()}
+
+    def asList(value):
+        return value if isinstance(value, list) else ([] if value is None else [value])
+
+    # The image data ends with the furthest strip or tile
+    offsets = asList(layout.pop('stripOffsets', None)) + asList(layout.pop('tileOffsets', None))
+    counts = asList(layout.pop('stripByteCounts', None)) + asList(layout.pop('tileByteCounts', None))
+    dataEnd = max([offset + count for offset, count in zip(offsets, counts)], default=0)
+
+    bits = asList(layout.get('bits'))
+    return {'format': 'tiff', 'width': layout.get('width'), 'height': layout.get('height'),
+            'bits': max(bits) if bits else None, 'truncated': len(offsets) == 0 or dataEnd > fileSize}
+
+
+def readJpegLayout(fileHandle, fileSize):
+    """ Size, bit depth and truncation of a JPEG file """
+    info = {'format': 'jpeg', 'width': None, 'height': None, 'bits': None}
+    fileHandle.seek(2)
+    while True:
+        marker = fileHandle.read(4)
+        if len(marker) < 4 or marker[0] != 0xFF or marker[1] == 0xDA:
+            break
+
+        length = struct.unpack('>H', marker[2:4])[0]
+        if marker[1] in JPEG_SOF_MARKERS:
+            frame = fileHandle.read(5)
+            if len(frame) == 5:
+                info['bits'], info['height'], info['width'] = struct.unpack('>BHH', frame)
+            break
+
+        fileHandle.seek(length - 2, 1)
+
+    # A complete file has an end of image marker (possibly followed by padding)
+    fileHandle.seek(max(fileSize - JPEG_TRAILER_SEARCH, 0))
+    info['truncated'] = b'\xFF\xD9' not in fileHandle.read()
+    return info
+
+
+def readPngLayout(fileHandle, fileSize):
+    """ Size, bit depth and truncation of a PNG file """
+    fileHandle.seek(8)
+    header = fileHandle.read(17)
+    if len(header) < 17 or header[4:8] != b'IHDR':
+        raise ValueError('Missing PNG header')
+
+    width, height, bits = struct.unpack('>IIB', header[8:17])
+
+    # A complete file finishes with the IEND chunk
+    fileHandle.seek(max(fileSize - len(PNG_IEND_CHUNK), 0))
+    return {'format': 'png', 'width': width, 'height': height, 'bits': bits,
+            'truncated': fileHandle.read() != PNG_IEND_CHUNK}
+
+
+def readImageInfo(filename):
+    """ Read the format, width, height and bits per sample of an image from its
+        header and check that its data is not cut short, without decoding it.
+        Returns {} when the file is unreadable or of an unknown type """
+    try:
+        with open(filename, 'rb') as fileHandle:
+            fileSize = os.fstat(fileHandle.fileno()).st_size
+            start = fileHandle.read(8)
+            if start[:2] == b'\xFF\xD8':
+                return readJpegLayout(fileHandle, fileSize)
+            elif start[:2] in (b'II', b'MM'):
+                return readTiffLayout(fileHandle, fileSize)
+            elif start == PNG_SIGNATURE:
+                return readPngLayout(fileHandle, fileSize)
+    except (OSError, ValueError, struct.error):
+        pass
+
+    return {}
@@ -0,0 +1,118 @@
+"""Sharpness scoring of session images to find blurred or out-of-focus frames."""
+
+import os
+import sys
+import time
+import argparse
+import concurrent.futures
+
+import numpy as np
+import imageio
+from PIL import Image
+
+# Images are reduced so their longest side is at most this many pixels before scoring
+SCORE_MAX_SIZE = 1024
+
+# Number of threads scoring images
+DEFAULT_WORKERS = 8
+
+
+def loadGray(filename, maxSize=SCORE_MAX_SIZE):
+    """ Load an image as a float32 grayscale array no larger than about maxSize """
+    if filename.lower().endswith(('.jpg', '.jpeg')):
+        # Let the JPEG decoder skip the detail we are going to throw away
+        with Image.open(filename) as image:
+            image.draft('L', (maxSize, maxSize))
+            gray = np.asarray(image.convert('L'), dtype=np.float32)
+        fullRange = 255.0
+    else:
+        data = np.asarray(imageio.imread(filename))
+        fullRange = float(np.iinfo(data.dtype).max) if np.issubdtype(data.dtype, np.integer) else 1.0
+        gray = data[..., :3].mean(axis=-1, dtype=np.float32) if data.ndim == 3 else data.astype(np.float32)
+
+    # Block average down to the working size
+    factor = -(-max(gray.shape) // maxSize)
+    if factor > 1:
+        height, width = gray.shape[0] // factor * factor, gray.shape[1] // factor * factor
+        gray = gray[:height, :width].reshape(height // factor, factor, width // factor, factor).mean(axis=(1, 3))
+
+    # Scale by the full range of the pixel type (not the brightest pixel) so 8 and 16 bit
+    # images score alike and a highlight does not change the score of the rest of the frame
+    return gray / fullRange
+
+
+def sharpnessScore(filename, maxSize=SCORE_MAX_SIZE):
+    """ Variance of the Laplacian of the downscaled image (higher is sharper) """
+    gray = loadGray(filename, maxSize)
+    if min(gray.shape) < 3:
+        return 0.0
+
+    laplacian = (4 * gray[1:-1, 1:-1] - gray[:-2, 1:-1] - gray[2:, 1:-1]
+                 - gray[1:-1, :-2] - gray[1:-1, 2:])
+    return float(laplacian.var())
+
+
+def scoreImages(filenames, workers=None, maxSize=SCORE_MAX_SIZE):
+    """ Score every image in parallel, returning {filename: score} (None when unreadable).
+        Threads rather than processes: this runs inside PARSECParse, which has no
+        __main__ guard, so spawned worker processes would re-run the whole workflow
+        on import. Image decoding and the NumPy work release the GIL anyway """
+    def score(filename):
+        try:
+            return sharpnessScore(filename, maxSize)
+        except Exception:
+            return None
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers or DEFAULT_WORKERS) as executor:
+        return dict(zip(filenames, executor.map(score, filenames)))
+
+
+def findWeakImages(scores, threshold=None, percentile=None, medianFraction=None):
+    """ The images scoring below a cut-off, taken from (in order of precedence)
+        - threshold: an absolute score
+        - percentile: a percentile of all the scores
+        - medianFraction: a fraction of the median score
+        Unreadable images (score None) are always included """
+    values = np.array([score for score in scores.values() if score is not None])
+    cutoff = None
+    if threshold is not None:
+        cutoff = threshold
+    elif len(values) > 0 and percentile is not None:
+        cutoff = float(np.percentile(values, percentile))
+    elif len(values) > 0 and medianFraction is not None:
+        cutoff = float(np.median(values)) * medianFraction
+
+    return sorted(filename for filename, score in scores.items()
+                  if score is None or (cutoff is not None and score < cutoff)), cutoff
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='ImageQuality.py',
+        description='Score the sharpness of images and list the weakest ones.'
+    )
+    parser.add_argument('images', nargs='+', help='Images (or directories of images) to score.')
+    parser.add_argument('-t', '--threshold', action='store', type=float, default=None, help='Flag images scoring below this value.')
+    parser.add_argument('-p', '--percentile', action='store', type=float, default=None, help='Flag images scoring below this percentile.')
+    parser.add_argument('-f', '--medianFraction', action='store', type=float, default=0.3, help='Flag images scoring below this fraction of the median (default).')
+    parser.add_argument('-j', '--workers', action='store', type=int, default=None, help='Number of threads scoring images.')
+    args = parser.parse_args()
+
+    filenames = []
+    for name in args.images:
+        if os.path.isdir(name):
+            filenames += sorted(os.path.join(name, entry) for entry in os.listdir(name)
+                                if entry.lower().endswith(('.jpg', '.jpeg', '.png', '.tif', '.tiff')))
+        else:
+            filenames.append(name)
+
+    startTime = time.perf_counter()
+    scores = scoreImages(filenames, args.workers)
+    weak, cutoff = findWeakImages(scores, args.threshold, args.percentile, args.medianFraction)
+    elapsed = time.perf_counter() - startTime
+
+    for filename in filenames:
+        score = scores[filename]
+        print('%s\t%s%s' % (filename, '-' if score is None else '%.6f' % score, '\tWEAK' if filename in weak else ''))
+    print('%d images scored in %.2fs, %d below %s' % (len(filenames), elapsed, len(weak),
+                                                     '-' if cutoff is None else '%.6f' % cutoff), file=sys.stderr)
@@ -0,0 +1,155 @@
+"""Pre-flight checks of a session's images before they are loaded into Metashape."""
+
+import os
+import sys
+import time
+import hashlib
+import argparse
+import concurrent.futures
+from collections import Counter, namedtuple
+
+import ExifHeader
+
+# Result of validating a directory
+# - images: sorted paths of the usable images
+# - rejected: {path: reason} for images that should not be loaded
+# - unusual: {path: reason} for loaded images that differ from the rest of the session
+ValidationResult = namedtuple('ValidationResult', ['images', 'rejected', 'unusual'])
+
+# Number of threads reading headers in parallel
+DEFAULT_WORKERS = 8
+
+# Size and number of the blocks hashed to quickly tell apart files of the same size
+SAMPLE_BLOCK_SIZE = 65536
+SAMPLE_BLOCK_COUNT = 3
+
+
+def checkImage(entryPath, size):
+    """ Header-only check of one image, returns (info, reason it is rejected or None) """
+    if size == 0:
+        return {}, 'empty file'
+
+    info = ExifHeader.readImageInfo(entryPath)
+    if len(info) == 0:
+        return info, 'unreadable or unknown image header'
+
+    # BigTIFF headers are not parsed so there is nothing more to check
+    if info['format'] == 'bigtiff':
+        return info, None
+
+    if not info.get('width') or not info.get('height'):
+        return info, 'missing image dimensions'
+    if not info.get('bits'):
+        return info, 'missing bit depth'
+    if info.get('truncated'):
+        return info, 'image data is truncated'
+
+    return info, None
+
+
+def hashFile(entryPath, size, sampleOnly):
+    """ SHA-1 of a whole file or (sampleOnly) of a few blocks spread through it """
+    digest = hashlib.sha1()
+    with open(entryPath, 'rb') as fileHandle:
+        if sampleOnly:
+            for block in range(SAMPLE_BLOCK_COUNT):
+                fileHandle.seek(max(size - SAMPLE_BLOCK_SIZE, 0) * block // max(SAMPLE_BLOCK_COUNT - 1, 1))
+                digest.update(fileHandle.read(SAMPLE_BLOCK_SIZE))
+        else:
+            for chunk in iter(lambda: fileHandle.read(1 << 20), b''):
+                digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def findDuplicates(entries, executor):
+    """ Map each duplicate path to the (first sorted) path it duplicates. Only files of
+        equal size are sampled and only files with equal samples are fully hashed """
+    def matchingGroups(groups, keyFunction):
+        matched = []
+        for group in groups:
+            if len(group) < 2:
+                continue
+            keys = list(executor.map(keyFunction, group))
+            byKey = {}
+            for entry, key in zip(group, keys):
+                byKey.setdefault(key, []).append(entry)
+            matched += byKey.values()
+        return matched
+
+    bySize = {}
+    for entry in entries:
+        bySize.setdefault(entry[1], []).append(entry)
+
+    groups = matchingGroups(bySize.values(), lambda entry: hashFile(entry[0], entry[1], True))
+    groups = matchingGroups(groups, lambda entry: hashFile(entry[0], entry[1], False))
+
+    duplicates = {}
+    for group in groups:
+        if len(group) > 1:
+            original = min(entry[0] for entry in group)
+            for entry in group:
+                if entry[0] != original:
+                    duplicates[entry[0]] = original
+
+    return duplicates
+
+
+def validateImages(directory, extensions, workers=None):
+    """ Check every image in a directory with a matching extension and return a
+        ValidationResult with the sorted list of images that are safe to load """
+    entries = []
+    with os.scandir(directory) as scan:
+        for entry in scan:
+            if entry.is_file() and entry.name.lower().endswith(extensions):
+                entries.append((entry.path, entry.stat().st_size))
+
+    rejected = {}
+    infos = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers or DEFAULT_WORKERS) as executor:
+        for (entryPath, size), (info, reason) in zip(entries, executor.map(lambda entry: checkImage(*entry), entries)):
+            if reason is not None:
+                rejected[entryPath] = reason
+            else:
+                infos[entryPath] = info
+
+        # Duplicates of images that passed (keeping the first by name)
+        duplicates = findDuplicates([entry for entry in entries if entry[0] in infos], executor)
+        for entryPath, original in duplicates.items():
+            rejected[entryPath] = 'duplicate of ' + os.path.basename(original)
+            del infos[entryPath]
+
+    # Images whose size or depth differs from most of the session are loaded but reported
+    unusual = {}
+    shapes = Counter((info.get('width'), info.get('height'), info.get('bits')) for info in infos.values())
+    if len(shapes) > 1:
+        width, height, bits = shapes.most_common(1)[0][0]
+        for entryPath, info in infos.items():
+            if (info.get('width'), info.get('height'), info.get('bits')) != (width, height, bits):
+                unusual[entryPath] = '%sx%s at %s bits (most images are %dx%d at %d bits)' % (
+                    info.get('width'), info.get('height'), info.get('bits'), width, height, bits)
+
+    return ValidationResult(sorted(infos), rejected, unusual)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='ImageValidation.py',
+        description='Check the images of a session directory before loading them.'
+    )
+    parser.add_argument('directory', help='Session directory to check.')
+    parser.add_argument('-e', '--extensions', action='store', default='.jpg,.jpeg,.png,.tif,.tiff', help='Comma separated image extensions to check.')
+    parser.add_argument('-j', '--workers', action='store', type=int, default=None, help='Number of threads reading headers.')
+    args = parser.parse_args()
+
+    startTime = time.perf_counter()
+    result = validateImages(args.directory, tuple(args.extensions.lower().split(',')), args.workers)
+    elapsed = time.perf_counter() - startTime
+
+    for entryPath, reason in sorted(result.rejected.items()):
+        print('REJECTED %s: %s' % (os.path.basename(entryPath), reason))
+    for entryPath, reason in sorted(result.unusual.items()):
+        print('UNUSUAL  %s: %s' % (os.path.basename(entryPath), reason))
+    print('%d usable, %d rejected, %d unusual in %.2fs' % (len(result.images), len(result.rejected),
+                                                           len(result.unusual), elapsed), file=sys.stderr)
+    sys.exit(1 if len(result.rejected) > 0 else 0)
@@ -0,0 +1,169 @@
+"""Background-subtraction masks computed with NumPy and cached on disk."""
+
+import os
+import sys
+import json
+import time
+import argparse
+import concurrent.futures
+
+import numpy as np
+import imageio
+from numpy.lib.stride_tricks import sliding_window_view
+
+# Cache index stored in the mask directory
+INDEX_FILENAME = 'masks.json'
+
+# Mask file name for each camera (matches the template given to Metashape)
+MASK_SUFFIX = '_mask.png'
+
+# Defaults (tolerance is in 8 bit levels like Metashape's background masking)
+DEFAULT_TOLERANCE = 10
+DEFAULT_RADIUS = 2
+
+# Number of threads generating masks
+DEFAULT_WORKERS = 8
+
+
+def resolveTemplate(template, photoPath, label):
+    """ Fill in a Metashape style path template ({filename}, {fileext}, {camera}) for one photo """
+    filename, extension = os.path.splitext(os.path.basename(photoPath))
+    return (template.replace('{filename}', filename).replace('{fileext}', extension.lstrip('.'))
+            .replace('{camera}', label))
+
+
+def loadImage(filename):
+    """ Load an image as an 8 bit scale array with a channel axis """
+    data = np.asarray(imageio.imread(filename))
+    if data.ndim == 2:
+        data = data[:, :, np.newaxis]
+    if data.dtype == np.uint16:
+        return (data[:, :, :3] >> 8).astype(np.int16)
+    return data[:, :, :3].astype(np.int16)
+
+
+def erode(mask, radius):
+    """ Binary erosion with a square (2 * radius + 1) structuring element """
+    for axis in (0, 1):
+        padding = [(0, 0), (0, 0)]
+        padding[axis] = (radius, radius)
+        mask = sliding_window_view(np.pad(mask, padding, constant_values=True), 2 * radius + 1, axis=axis).all(axis=-1)
+    return mask
+
+
+def dilate(mask, radius):
+    """ Binary dilation with a square (2 * radius + 1) structuring element """
+    for axis in (0, 1):
+        padding = [(0, 0), (0, 0)]
+        padding[axis] = (radius, radius)
+        mask = sliding_window_view(np.pad(mask, padding, constant_values=False), 2 * radius + 1, axis=axis).any(axis=-1)
+    return mask
+
+
+def backgroundMask(image, background, tolerance=DEFAULT_TOLERANCE, radius=DEFAULT_RADIUS):
+    """ True where the image differs from its background plate by more than the tolerance
+        in any channel, cleaned up with an opening (drops speckles) and a closing (fills pin holes) """
+    if image.shape != background.shape:
+        raise Exception('Mask Error - image is {} but background is {}'.format(image.shape, background.shape))
+
+    mask = (np.abs(image - background) > tolerance).any(axis=-1)
+    if radius > 0:
+        mask = dilate(erode(mask, radius), radius)
+        mask = erode(dilate(mask, radius), radius)
+    return mask
+
+
+def cacheKey(photoPath, backgroundPath, tolerance, radius):
+    """ Everything a mask depends on (file sizes and modification times plus the settings) """
+    photoStat = os.stat(photoPath)
+    backgroundStat = os.stat(backgroundPath)
+    return [os.path.abspath(photoPath), photoStat.st_size, photoStat.st_mtime_ns,
+            os.path.abspath(backgroundPath), backgroundStat.st_size, backgroundStat.st_mtime_ns,
+            tolerance, radius]
+
+
+def writeMask(photoPath, backgroundPath, maskPath, tolerance, radius):
+    """ Generate one mask file (white is kept, black is masked out) """
+    mask = backgroundMask(loadImage(photoPath), loadImage(backgroundPath), tolerance, radius)
+    imageio.imwrite(maskPath, mask.astype(np.uint8) * 255)
+
+
+def generateMasks(tasks, maskDirectory, tolerance=DEFAULT_TOLERANCE, radius=DEFAULT_RADIUS, workers=None):
+    """ Make the masks for a list of (name, photo path, background path) tasks in maskDirectory
+        as '<name>_mask.png', skipping any whose inputs and settings have not changed.
+        Returns (generated names, cached names, {name: error}).
+        Masks are made on a thread pool, not a process pool, because MetaUtils calls
+        this from PARSECParse: that script has no __main__ guard, so every spawned
+        process would import it and start the workflow again """
+    os.makedirs(maskDirectory, exist_ok=True)
+    indexPath = os.path.join(maskDirectory, INDEX_FILENAME)
+    try:
+        with open(indexPath, 'r') as indexFile:
+            index = json.load(indexFile)
+    except (OSError, ValueError):
+        index = {}
+
+    # Split the work into cached and pending masks
+    cached, pending, errors = [], [], {}
+    for name, photoPath, backgroundPath in tasks:
+        maskPath = os.path.join(maskDirectory, name + MASK_SUFFIX)
+        try:
+            key = cacheKey(photoPath, backgroundPath, tolerance, radius)
+        except OSError as e:
+            errors[name] = str(e)
+            continue
+
+        if index.get(name) == key and os.path.exists(maskPath):
+            cached.append(name)
+        else:
+            pending.append((name, photoPath, backgroundPath, maskPath, key))
+
+    generated = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers or DEFAULT_WORKERS) as executor:
+        futures = {executor.submit(writeMask, photoPath, backgroundPath, maskPath, tolerance, radius): (name, key)
+                   for name, photoPath, backgroundPath, maskPath, key in pending}
+        for future in concurrent.futures.as_completed(futures):
+            name, key = futures[future]
+            try:
+                future.result()
+                index[name] = key
+                generated.append(name)
+            except Exception as e:
+                index.pop(name, None)
+                errors[name] = '%s: %s' % (type(e).__name__, e)
+
+    # Save the index atomically so an interrupted run never leaves it half written
+    with open(indexPath + '.tmp', 'w') as indexFile:
+        json.dump(index, indexFile, indent=1)
+    os.replace(indexPath + '.tmp', indexPath)
+
+    return sorted(generated), sorted(cached), errors
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='MaskGenerator.py',
+        description='Generate background-subtraction masks for a folder of images.'
+    )
+    parser.add_argument('images', help='Folder of images to mask.')
+    parser.add_argument('backgrounds', help='Background path template, e.g. "bg/{filename}.jpg".')
+    parser.add_argument('-o', '--output', action='store', default='masks', help='Folder for the mask files and cache index.')
+    parser.add_argument('-t', '--tolerance', action='store', type=int, default=DEFAULT_TOLERANCE, help='Difference (in 8 bit levels) counted as foreground.')
+    parser.add_argument('-r', '--radius', action='store', type=int, default=DEFAULT_RADIUS, help='Radius of the morphological cleanup (0 for none).')
+    parser.add_argument('-j', '--workers', action='store', type=int, default=None, help='Number of threads generating masks.')
+    args = parser.parse_args()
+
+    tasks = []
+    for entry in sorted(os.listdir(args.images)):
+        if entry.lower().endswith(('.jpg', '.jpeg', '.png', '.tif', '.tiff')):
+            name = os.path.splitext(entry)[0]
+            photoPath = os.path.join(args.images, entry)
+            tasks.append((name, photoPath, resolveTemplate(args.backgrounds, photoPath, name)))
+
+    startTime = time.perf_counter()
+    generated, cached, errors = generateMasks(tasks, args.output, args.tolerance, args.radius, args.workers)
+    for name, error in sorted(errors.items()):
+        print('%s: %s' % (name, error))
+    print('%d generated, %d cached, %d failed in %.2fs' % (len(generated), len(cached), len(errors),
+                                                          time.perf_counter() - startTime), file=sys.stderr)
+    sys.exit(1 if len(errors) > 0 else 0)
@@ -1,17 +1,30 @@
 """Reworking of MetaUtils as a Class"""
 
 import os
+import csv
+import time
 import numpy as np
 import re
+from collections import namedtuple
 
 import Metashape
 from CustomProgress import PBar
 
 from ProjectPrefs import ProjectPrefs
+from CageGeometry import CageGeometry
+from Checkpoints import Checkpoints
+import ImageValidation
+import ImageQuality
+import MaskGenerator
+import RigPairs
+import CalibrationStore
 
 import Logger
 logger = None
 
+# Result of a marker lookup (markers found in label order and the labels that were not)
+MarkerLookup = namedtuple('MarkerLookup', ['markers', 'missing'])
+
 """ This object contains general functions to help process a MetaShape
     document object It should be passed an existing document when
     created either already processed or a new document ready to be
@@ -25,6 +38,34 @@ class MetaUtils:
     # Common image file extensions
     IMAGE_FILE_EXTENSION_LIST = ('.jpg', '.jpeg', '.png', '.tif', '.tiff')
 
+    # Gradual selection defaults (Metashape.TiePoints.Filter criterion -> percentile of points kept)
+    GRADUAL_SELECTION_PERCENTILES = {
+        'ReprojectionError': 90,
+        'ReconstructionUncertainty': 90,
+        'ProjectionAccuracy': 90
+    }
+    GRADUAL_SELECTION_MAX_ITERATIONS = 5
+    GRADUAL_SELECTION_MIN_IMPROVEMENT = 0.02
+
+    # Cameras scoring below this fraction of the median sharpness are disabled (by default)
+    SHARPNESS_MEDIAN_FRACTION = 0.3
+
+    # Targets chunkCorrect() and setRegion() need and how many cameras must see each of them
+    # before subset marker detection stops
+    REQUIRED_MARKER_LABELS = CageGeometry.CORNER_LABELS + (CageGeometry.UP_LABEL,)
+    MARKER_MIN_PROJECTIONS = 3
+
+    # Adaptive marker detection adds every Nth camera per round (by default)
+    MARKER_ADAPTIVE_STEP = 8
+
+    # Pose priors are referenced in a local cartesian frame (the cage frame of the session they
+    # came from) with this accuracy (in the units of that frame) by default
+    LOCAL_CRS_WKT = 'LOCAL_CS["Local Coordinates (m)",LOCAL_DATUM["Local Datum",0],UNIT["metre",1,AUTHORITY["EPSG","9001"]]]'
+    POSE_PRIOR_ACCURACY = 0.01
+
+    # Columns of a pose prior (rig calibration) file: camera label, position and row-major rotation
+    POSE_PRIOR_COLUMNS = ('label', 'x', 'y', 'z', 'r00', 'r01', 'r02', 'r10', 'r11', 'r12', 'r20', 'r21', 'r22')
+
     """ Construct a new MetaUtils object with the given Metashape Document """
 
     def __init__(self, doc, path="", prefix=""):
@@ -38,6 +79,14 @@ class MetaUtils:
         self.imagePath = path
         self.projectName = prefix
 
+        # Label -> marker index (rebuilt when the markers change)
+        self.markerIndex = None
+        self.markerIndexState = None
+
+        # Cage geometry (rebuilt when the markers or chunk transform change)
+        self.cageGeometry = None
+        self.cageGeometryState = None
+
         # Check that we have a valid Document
         logger.debug("Verifying / loading doc")
         if self.doc is None:
@@ -55,6 +104,9 @@ class MetaUtils:
             else:
                 raise Exception('Could not find or make chunk in document.')
 
+        # Stages completed on the chunk (not resumed unless a workflow asks to)
+        self.checkpoints = Checkpoints(self.chunk)
+
         logger.debug("> doc is " + str(self.doc))
         logger.debug("> chunk is " + str(self.chunk))
 
@@ -154,25 +206,56 @@ class MetaUtils:
             self.doc.chunk = self.doc.addChunk()
             self.doc.save(doc_path)
 
+    # Forget the label -> marker index (call after changing markers other than through detectMarkers)
+    def invalidateMarkerIndex(self):
+        self.markerIndex = None
+        self.markerIndexState = None
+
+    # Label -> marker index, rebuilt if the chunk or its marker count changed
+    def getMarkerIndex(self):
+        state = (self.chunk.key, len(self.chunk.markers))
+        if self.markerIndex is None or self.markerIndexState != state:
+            counts = {}
+            for marker in self.chunk.markers:
+                counts[marker.label] = counts.get(marker.label, 0) + 1
+
+            # Ambiguous labels (used by more than one marker) are left out
+            self.markerIndex = {marker.label: marker for marker in self.chunk.markers if counts[marker.label] == 1}
+            self.markerIndexState = state
+
+        return self.markerIndex
+
+    # Retrieve markers by label, reporting which labels were not found
+    def lookupMarkers(self, labels):
+        index = self.getMarkerIndex()
+        markers = [index[label] for label in labels if label in index]
+        missing = [label for label in labels if label not in index]
+        return MarkerLookup(markers, missing)
+
     # Helper function to retrieve markes by label
     def findMarkers(self, labels):
         MetaUtils.ensureLoggerReady()
 
-        markers = []
-        for label in labels:
-            foundMarker = [marker for marker in self.chunk.markers if marker.label == label]
-            if len(foundMarker) == 1: markers.append(foundMarker[0])
+        markers, missing = self.lookupMarkers(labels)
 
         # Logs a warning if not all markers were found.
-        if len(markers) != len(labels):
+        if len(missing) > 0:
             logger.warn("Markers not found:")
-            foundLabels = [marker.label for marker in markers]
-            for label in labels:
-                if label not in foundLabels:
-                    logger.warn("\t" + label)
+            for label in missing:
+                logger.warn("\t" + label)
 
         return markers
 
+    # Geometry of the cage targets, computed once per marker/transform state
+    def getCageGeometry(self):
+        lookup = self.lookupMarkers(CageGeometry.CORNER_LABELS + (CageGeometry.UP_LABEL,))
+        state = CageGeometry.stateOf(lookup, self.chunk.transform)
+        if self.cageGeometry is None or self.cageGeometryState != state:
+            self.cageGeometry = CageGeometry(lookup, self.chunk.transform)
+            self.cageGeometryState = state
+
+        return self.cageGeometry
+
     # Automates correction processes for the chunk.
     def chunkCorrect(self):
         MetaUtils.ensureLoggerReady()
@@ -180,17 +263,11 @@ class MetaUtils:
         # Changes the dimensions of the chunk's reconstruction volume.
         logger.info("Leveling and orienting chunk")
 
-        # Compute a basis from markers in the scene
-        up, view, c = self.computeBasisFromCoplanerMarkers(
-            ['target 15', 'target 11', 'target 13', 'target 9']
-        )
-
-        # Use markers to find a known "upward" vector
-        upMarkers = self.findMarkers(['target 15', 'target 20'])
-        upward = (upMarkers[1].position - upMarkers[0].position).normalized()
-
-        # If up vector is opposite to the upward vector, flip it
-        if up * upward < 0: up = -up
+        # Basis from the coplanar cage markers (up is already flipped to match the up marker)
+        cage = self.getCageGeometry()
+        if cage.upward is None:
+            raise Exception('Cage Geometry Error - up marker "{}" not found or not placed'.format(CageGeometry.UP_LABEL))
+        up, view, c = cage.up, cage.view, cage.centroid
 
         # Compute rest of basis and apply to chunk
         t = Metashape.Vector.cross(view, up).normalized()
@@ -211,39 +288,11 @@ class MetaUtils:
         # Changes the dimensions of the chunk's reconstruction volume.
         logger.info("Limiting and orienting region")
 
-        # Find midpoint of volume
-        markers = self.findMarkers(['target 15', 'target 11', 'target 13', 'target 9'])
-        points = np.array([[marker.position.x, marker.position.y, marker.position.z] for marker in markers])
-        centroid = Metashape.Vector(np.mean(points, axis=0))
-
-        # Compute distance between the width markers
-        widthMarkers = self.findMarkers(['target 11', 'target 15'])
-        cageWidth = (widthMarkers[0].position - widthMarkers[1].position).norm()
-
         # Align region with chunk (presumes chunk has already been cleaned)
-        self.chunk.region.rot = self.chunk.transform.rotation.t()
-        yAxis = Metashape.Matrix.Rotation(self.chunk.region.rot).mulv(Metashape.Vector((0, 1, 0)))
-        if scaler > 0.75:
-            self.chunk.region.center = centroid
-        else:
-            # Slightly lower than centroid
-            adjust = cageWidth * 0.05
-            self.chunk.region.center = Metashape.Vector((
-                centroid.x - yAxis.x * adjust,
-                centroid.y - yAxis.y * adjust,
-                centroid.z - yAxis.z * adjust
-            ))
-
-        # Set size according to parameter
-        if scaler > 0.75:
-            self.chunk.region.size = Metashape.Vector((
-                cageWidth * scaler, cageWidth * scaler, cageWidth * scaler
-            ))
-        else:
-            # Don't let height be below 75%
-            self.chunk.region.size = Metashape.Vector((
-                cageWidth * scaler, cageWidth * 0.75, cageWidth * scaler
-            ))
+        center, size, rot = self.getCageGeometry().regionBox(scaler)
+        self.chunk.region.rot = rot
+        self.chunk.region.center = center
+        self.chunk.region.size = size
 
     def computeBasisFromCoplanerMarkers(self, markerLabels):
         MetaUtils.ensureLoggerReady()
@@ -273,30 +322,38 @@ class MetaUtils:
         ])
 
     def filterTiePoints(self):
-        # Compute distance between the width markers
-        widthMarkers = self.findMarkers(['target 11', 'target 15'])
-        cageWidth = (widthMarkers[0].position - widthMarkers[1].position).norm()
-
-        # Find midpoint of volume
-        markers = self.findMarkers(['target 15', 'target 11', 'target 13', 'target 9'])
-        points = np.array([[marker.position.x, marker.position.y, marker.position.z] for marker in markers])
-        centroid = Metashape.Vector(np.mean(points, axis=0))
-
-        # General size to limit
-        horizSize = 2.138 * cageWidth
-        vertSize = 1.145 * cageWidth
-
-        # Build bounding box region
+        # Build bounding box region around the cage
         BBRegion = self.chunk.region.copy()
-        BBRegion.size = Metashape.Vector([horizSize, vertSize, horizSize])
-        BBRegion.center = centroid
+        BBRegion.center, BBRegion.size = self.getCageGeometry().filterBox()
 
         # Select tie points outside bounding box
-        for tiePoint in self.chunk.tie_points.points:
-            MetaUtils.checkPoint(tiePoint, BBRegion)
+        selected = MetaUtils.selectPointsOutsideRegion(self.chunk.tie_points.points, BBRegion)
 
         # Remove selected tie points
         self.chunk.tie_points.removeSelectedPoints()
+        return selected
+
+    # Select the points outside the (oriented) region box and deselect the rest. Gives the same
+    # result as calling checkPoint() on every point but tests all of them in one NumPy transform.
+    @staticmethod
+    def selectPointsOutsideRegion(points, region):
+        if len(points) == 0:
+            return 0
+
+        # Pack the point coordinates (dropping the homogeneous w) and the box into arrays
+        coords = np.array([(coord.x, coord.y, coord.z) for coord in (point.coord for point in points)])
+        R = np.array([[region.rot.row(i)[j] for j in range(3)] for i in range(3)])
+        C = np.array([region.center.x, region.center.y, region.center.z])
+        halfSize = np.abs(np.array([region.size.x, region.size.y, region.size.z]) / 2.)
+
+        # Row vector form of R.t() * (v - C) for every point at once
+        outside = np.any(np.abs((coords - C) @ R) > halfSize, axis=1)
+
+        # Metashape has no bulk selection so this is the only per-point step left
+        for point, selected in zip(points, outside.tolist()):
+            point.selected = selected
+
+        return int(np.count_nonzero(outside))
 
     def checkPoint(point, region):
         R = region.rot		# Bounding box rotation matrix
@@ -326,15 +383,19 @@ class MetaUtils:
             logger.info("Skipping image loading (chunk already contains images)")
             return 0
 
-        # Build the list of image filenames
-        images = []
-
         logger.info("Loading Images")
 
-        # Loop over all files in image path and add if an image type
-        for filename in os.listdir(self.imagePath):
-            if filename.lower().endswith(MetaUtils.IMAGE_FILE_EXTENSION_LIST):
-                images.append(os.path.join(self.imagePath, filename))
+        # Check every image in the image path (headers only) and skip any bad ones
+        validation = ImageValidation.validateImages(self.imagePath, MetaUtils.IMAGE_FILE_EXTENSION_LIST)
+        for filename, reason in sorted(validation.rejected.items()):
+            logger.warning("Skipping image %s: %s" % (os.path.basename(filename), reason))
+        for filename, reason in sorted(validation.unusual.items()):
+            logger.warning("Unusual image %s: %s" % (os.path.basename(filename), reason))
+        images = validation.images
+
+        logger.info("%d images passed validation (%d skipped)" % (len(images), len(validation.rejected)))
+        if len(images) == 0:
+            raise Exception("No usable images found in " + self.imagePath)
 
         # From API "Add a list of photos to the chunk."
         elapsed = 0
@@ -346,6 +407,33 @@ class MetaUtils:
         logger.info("Done Loading Images")
         return elapsed
 
+    # Scores the sharpness of every camera's image and disables (does not remove) the weakest.
+    # - the cut-off is an absolute threshold, a percentile of the scores or (by default) a
+    #   fraction of the median score
+    # - returns the time taken, {camera label: score}, the cut-off and the disabled labels
+    def disableBlurredCameras(self, threshold=None, percentile=None, medianFraction=None):
+        MetaUtils.ensureLoggerReady()
+
+        if threshold is None and percentile is None and medianFraction is None:
+            medianFraction = MetaUtils.SHARPNESS_MEDIAN_FRACTION
+
+        logger.info("Scoring image sharpness")
+        startTime = time.perf_counter()
+        cameras = {camera.photo.path: camera for camera in self.chunk.cameras if camera.photo is not None}
+        scores = ImageQuality.scoreImages(list(cameras))
+        weak, cutoff = ImageQuality.findWeakImages(scores, threshold, percentile, medianFraction)
+
+        disabled = []
+        for filename in weak:
+            cameras[filename].enabled = False
+            disabled.append(cameras[filename].label)
+            logger.warning("Disabling camera %s (sharpness %s)" % (cameras[filename].label,
+                           "unreadable" if scores[filename] is None else "%.6f" % scores[filename]))
+        elapsed = time.perf_counter() - startTime
+
+        logger.info("Done Scoring Sharpness (%d of %d cameras disabled)" % (len(disabled), len(cameras)))
+        return elapsed, {cameras[filename].label: score for filename, score in scores.items()}, cutoff, disabled
+
     # Automates masking.
     def autoMask(self, PATH_TO_MASKS):
         MetaUtils.ensureLoggerReady()
@@ -371,8 +459,55 @@ class MetaUtils:
         logger.info("Done Masking")
         return elapsed
 
+    # Masks images against their backgrounds with MaskGenerator and imports the mask files.
+    # - masks are cached in maskDirectory so re-runs only regenerate masks whose photo,
+    #   background or settings changed
+    def nativeMask(self, PATH_TO_MASKS, maskDirectory=None, tolerance=MaskGenerator.DEFAULT_TOLERANCE,
+                   radius=MaskGenerator.DEFAULT_RADIUS):
+        MetaUtils.ensureLoggerReady()
+
+        # Ensure there are images to mask first
+        if len(self.chunk.cameras) <= 0:
+            raise Exception("Cannot mask before adding images")
+
+        maskDirectory = maskDirectory or os.path.join(".", self.projectName + "_masks")
+        logger.info("Generating Masks in " + maskDirectory)
+
+        # One task per camera named after its photo (so Metashape can find it with {filename})
+        cameras = {}
+        tasks = []
+        for camera in self.chunk.cameras:
+            if camera.photo is not None:
+                name = os.path.splitext(os.path.basename(camera.photo.path))[0]
+                cameras[name] = camera
+                tasks.append((name, camera.photo.path,
+                              MaskGenerator.resolveTemplate(PATH_TO_MASKS, camera.photo.path, camera.label)))
+
+        startTime = time.perf_counter()
+        generated, cached, errors = MaskGenerator.generateMasks(tasks, maskDirectory, tolerance, radius)
+        generateElapsed = time.perf_counter() - startTime
+        for name, error in sorted(errors.items()):
+            logger.warning("No mask for %s: %s" % (name, error))
+        logger.info("%d masks generated, %d cached (%.2fs)" % (len(generated), len(cached), generateElapsed))
+
+        # From API "Import masks for multiple cameras."
+        # - Mask files are white where the image is kept.
+        elapsed = 0
+        with PBar("Importing Masks") as pbar:
+            self.chunk.importMasks(path=os.path.join(maskDirectory, "{filename}" + MaskGenerator.MASK_SUFFIX),
+                                source=Metashape.MaskSourceFile,
+                                operation=Metashape.MaskOperationReplacement,
+                                cameras=[cameras[name] for name in generated + cached],
+                                progress=(lambda x: pbar.update(x)))
+            pbar.finish()
+            elapsed = pbar.getTime()
+
+        logger.info("Done Masking")
+        return generateElapsed + elapsed
+
     # Places markers on coded targets in images.
-    def detectMarkers(self, tolerance=50):
+    # - subset is a dict of detectMarkersOnSubset() options (None to detect on every camera)
+    def detectMarkers(self, tolerance=50, subset=None):
         MetaUtils.ensureLoggerReady()
 
         # If the chunk already has markers, don't redetect
@@ -381,14 +516,99 @@ class MetaUtils:
             return 0
 
         logger.info("Detecting markers (tolerance = %d)" % tolerance)
+        if subset is None:
+            elapsed = self.runMarkerDetection(tolerance)
+        else:
+            elapsed = self.detectMarkersOnSubset(tolerance, **subset)
+
+        self.invalidateMarkerIndex()
+
+        logger.info("Done Detecting Markers (found %d markers)" % len(self.chunk.markers))
+        return elapsed
+
+    # Runs Metashape's marker detection on some (or all) cameras, returning the time taken
+    def runMarkerDetection(self, tolerance=50, cameras=None):
+        options = {} if cameras is None else {'cameras': cameras}
         elapsed = 0
         with PBar("Detecting Markers") as pbar:
             self.chunk.detectMarkers(tolerance=tolerance, filter_mask=False, inverted=False,
-                noparity=False, maximum_residual=5, progress=(lambda x: pbar.update(x)))
+                noparity=False, maximum_residual=5, progress=(lambda x: pbar.update(x)), **options)
             pbar.finish()
             elapsed = pbar.getTime()
 
-        logger.info("Done Detecting Markers (found %d markers)" % len(self.chunk.markers))
+        return elapsed
+
+    # Cameras for subset marker detection in label order: the enabled cameras whose label matches
+    # the pattern, that are on one of the rings (see RigPairs) and/or every Nth of those
+    def selectMarkerCameras(self, pattern=None, rings=None, every=None):
+        cameras = sorted((camera for camera in self.chunk.cameras if camera.enabled), key=lambda camera: camera.label)
+        if pattern is not None:
+            expression = re.compile(pattern, re.IGNORECASE)
+            cameras = [camera for camera in cameras if expression.search(camera.label)]
+        if rings is not None:
+            topology = RigPairs.parseTopology([camera.label for camera in cameras])
+            cameras = [camera for camera in cameras if camera.label in topology and topology[camera.label][0] in rings]
+        if every is not None:
+            cameras = cameras[::max(every, 1)]
+
+        return cameras
+
+    # Order of the offsets of an every-Nth camera selection that fills in the gaps coarse to
+    # fine (e.g. 0, 4, 2, 6, 1, 5, 3, 7 for 8) so each round spreads over the whole session
+    @staticmethod
+    def coarseToFineOffsets(step):
+        offsets = [0]
+        span = step
+        while span > 1:
+            span //= 2
+            offsets += [offset + span for offset in offsets if offset + span < step]
+        return offsets + [offset for offset in range(step) if offset not in offsets]
+
+    # Required marker labels seen by fewer than minProjections cameras
+    def missingMarkers(self, labels=None, minProjections=None):
+        labels = labels or MetaUtils.REQUIRED_MARKER_LABELS
+        minProjections = minProjections or MetaUtils.MARKER_MIN_PROJECTIONS
+        index = self.getMarkerIndex()
+        return [label for label in labels
+                if label not in index or len(index[label].projections.keys()) < minProjections]
+
+    # Detects markers on a subset of the cameras (see selectMarkerCameras()), falling back to the
+    # remaining cameras only when the required targets are not seen often enough.
+    # - adaptive detects on every Nth camera of the subset per round (coarse to fine) and stops
+    #   as soon as the required targets have enough projections
+    def detectMarkersOnSubset(self, tolerance=50, pattern=None, rings=None, every=None, adaptive=False,
+                              minProjections=None):
+        MetaUtils.ensureLoggerReady()
+
+        if adaptive:
+            cameras = self.selectMarkerCameras(pattern, rings)
+            step = every or MetaUtils.MARKER_ADAPTIVE_STEP
+            batches = [cameras[offset::step] for offset in MetaUtils.coarseToFineOffsets(step)]
+        else:
+            batches = [self.selectMarkerCameras(pattern, rings, every)]
+
+        elapsed = 0
+        detected = set()
+        missing = list(MetaUtils.REQUIRED_MARKER_LABELS)
+        for batch in batches:
+            if len(batch) == 0:
+                continue
+            elapsed += self.runMarkerDetection(tolerance, batch)
+            detected.update(camera.key for camera in batch)
+
+            self.invalidateMarkerIndex()
+            missing = self.missingMarkers(minProjections=minProjections)
+            if len(missing) == 0:
+                logger.info("Required markers found on %d of %d cameras" % (len(detected), len(self.chunk.cameras)))
+                return elapsed
+
+        # Fall back to the cameras not searched yet
+        rest = [camera for camera in self.chunk.cameras if camera.enabled and camera.key not in detected]
+        logger.warning("Markers %s not found often enough on %d cameras, detecting on the remaining %d" % (
+            ", ".join(missing), len(detected), len(rest)))
+        if len(rest) > 0:
+            elapsed += self.runMarkerDetection(tolerance, rest)
+
         return elapsed
 
     # Places markers on coded targets in images.
@@ -405,6 +625,274 @@ class MetaUtils:
         logger.info("Done Optimizing Cameras")
         return elapsed
 
+    # Root mean square reprojection error over all tie points
+    def tiePointError(self):
+        pointFilter = Metashape.TiePoints.Filter()
+        pointFilter.init(self.chunk, criterion=Metashape.TiePoints.Filter.ReprojectionError)
+        values = np.array(pointFilter.values, dtype=float)
+        return float(np.sqrt(np.mean(values ** 2))) if values.size > 0 else 0.0
+
+    # Removes the worst tie points by gradual selection, re-optimizing the cameras after each pass.
+    # - percentiles keeps that percentile of points for each criterion (per pass)
+    # - stops when the RMS error improves by less than minImprovement (relative), when no more
+    #   than pointBudget points are left or after maxIterations passes
+    # - returns the total time and a list of per-pass results
+    def gradualSelection(self, percentiles=None, pointBudget=None, maxIterations=None, minImprovement=None):
+        MetaUtils.ensureLoggerReady()
+
+        percentiles = percentiles or MetaUtils.GRADUAL_SELECTION_PERCENTILES
+        maxIterations = maxIterations or MetaUtils.GRADUAL_SELECTION_MAX_ITERATIONS
+        minImprovement = MetaUtils.GRADUAL_SELECTION_MIN_IMPROVEMENT if minImprovement is None else minImprovement
+
+        logger.info("Gradual selection of tie points (%s)" % ", ".join(
+            "%s %g%%" % (criterion, percentile) for criterion, percentile in percentiles.items()))
+
+        iterations = []
+        previousError = self.tiePointError()
+        elapsed = 0
+        for iteration in range(maxIterations):
+            # Remove the points above the percentile of each criterion
+            with PBar("Gradual Selection %d" % (iteration + 1)) as pbar:
+                pointFilter = Metashape.TiePoints.Filter()
+                for step, (criterion, percentile) in enumerate(percentiles.items()):
+                    pointFilter.init(self.chunk, criterion=getattr(Metashape.TiePoints.Filter, criterion))
+                    values = np.array(pointFilter.values, dtype=float)
+                    if values.size > 0:
+                        pointFilter.removePoints(float(np.percentile(values, percentile)))
+                    pbar.update(100 * (step + 1) / len(percentiles))
+                pbar.finish()
+                filterElapsed = pbar.getTime()
+
+            pointCount = len(self.chunk.tie_points.points)
+            optimizeElapsed = self.optimizeCameras()
+            error = self.tiePointError()
+
+            iterations.append({'points': pointCount, 'error': error,
+                               'time': filterElapsed + optimizeElapsed})
+            elapsed += filterElapsed + optimizeElapsed
+            logger.info("Pass %d: %d tie points, RMS error %.4f (was %.4f)" % (
+                iteration + 1, pointCount, error, previousError))
+
+            # Stop once the error has converged or the point budget is reached
+            if pointBudget is not None and pointCount <= pointBudget:
+                logger.info("Tie point budget of %d reached" % pointBudget)
+                break
+            if previousError <= 0 or (previousError - error) / previousError < minImprovement:
+                logger.info("RMS error no longer improving")
+                break
+            previousError = error
+
+        logger.info("Done Gradual Selection")
+        return elapsed, iterations
+
+    # Pose of every aligned camera of a chunk in the chunk's coordinate frame (the cage frame
+    # once chunkCorrect() has run) as {label: (position, 3x3 rotation)}
+    @staticmethod
+    def chunkPoses(chunk):
+        T = chunk.transform.matrix
+        if T is None:
+            T = Metashape.Matrix.Diag((1, 1, 1, 1))
+
+        poses = {}
+        for camera in chunk.cameras:
+            if camera.transform is not None:
+                pose = T * camera.transform
+                poses[camera.label] = (T.mulp(camera.center), pose.rotation())
+
+        return poses
+
+    # Reads pose priors from a previous project (.psx) or a pose prior file written by
+    # exportPosePriors() as {label: (position, rotation or None)}
+    @staticmethod
+    def readPosePriors(source):
+        if source.lower().endswith('.psx'):
+            previous = Metashape.Document()
+            previous.open(source, read_only=True, ignore_lock=True)
+            if previous.chunk is None:
+                raise Exception('Pose Prior Error - "{}" has no chunk'.format(source))
+            return MetaUtils.chunkPoses(previous.chunk)
+
+        priors = {}
+        with open(source, 'r', newline='') as priorFile:
+            for row in csv.reader(priorFile):
+                if len(row) == 0 or row[0] == MetaUtils.POSE_PRIOR_COLUMNS[0]:
+                    continue
+                if len(row) < 4:
+                    raise Exception('Pose Prior Error - "{}" has a row without a position: {}'.format(source, row))
+
+                values = [float(value) for value in row[1:]]
+                rotation = None
+                if len(values) >= 12:
+                    rotation = Metashape.Matrix([values[3:6], values[6:9], values[9:12]])
+                priors[row[0]] = (Metashape.Vector(values[:3]), rotation)
+
+        return priors
+
+    # Writes the pose of every aligned camera to a pose prior file (run after chunkCorrect()
+    # so later sessions of the same rig can use it with loadPosePriors())
+    def exportPosePriors(self, filename):
+        MetaUtils.ensureLoggerReady()
+
+        poses = MetaUtils.chunkPoses(self.chunk)
+        with open(filename, 'w', newline='') as priorFile:
+            writer = csv.writer(priorFile)
+            writer.writerow(MetaUtils.POSE_PRIOR_COLUMNS)
+            for label, (position, rotation) in sorted(poses.items()):
+                writer.writerow([label] + list(position) + [rotation[row, column] for row in range(3) for column in range(3)])
+
+        logger.info("Exported %d camera poses to %s" % (len(poses), filename))
+        return len(poses)
+
+    # Sets the camera reference locations from the poses of a previous session of the same rig
+    # so matching can preselect pairs by location.
+    # - cameras are matched by label and otherwise by their position on the rig (see RigPairs)
+    # - seed also copies the full pose into each matched camera so alignment starts from it
+    # - returns the time taken, the number of cameras with a prior and the number seeded
+    def loadPosePriors(self, source, accuracy=None, seed=False):
+        MetaUtils.ensureLoggerReady()
+
+        logger.info("Loading camera pose priors from " + source)
+        startTime = time.perf_counter()
+        priors = MetaUtils.readPosePriors(source)
+
+        # Match the cameras by label, falling back to their rig position
+        byRig = {position: label for label, position in RigPairs.parseTopology(priors).items()}
+        cameras = [camera for camera in self.chunk.cameras if camera.enabled]
+        rigPositions = RigPairs.parseTopology([camera.label for camera in cameras])
+        matched = []
+        for camera in cameras:
+            label = camera.label if camera.label in priors else byRig.get(rigPositions.get(camera.label))
+            if label is not None:
+                matched.append((camera, priors[label]))
+
+        if len(matched) < len(cameras):
+            logger.warning("%d of %d cameras have no pose prior" % (len(cameras) - len(matched), len(cameras)))
+
+        # References are in the previous session's cage frame (and so is the chunk when seeding)
+        self.chunk.crs = Metashape.CoordinateSystem(MetaUtils.LOCAL_CRS_WKT)
+        self.chunk.camera_location_accuracy = Metashape.Vector([accuracy or MetaUtils.POSE_PRIOR_ACCURACY] * 3)
+        if seed:
+            self.chunk.transform.matrix = Metashape.Matrix.Diag((1, 1, 1, 1))
+
+        seeded = 0
+        for camera, (position, rotation) in matched:
+            camera.reference.location = position
+            camera.reference.location_enabled = True
+            if seed and rotation is not None:
+                camera.transform = Metashape.Matrix.Translation(position) * Metashape.Matrix.Rotation(rotation)
+                seeded += 1
+        elapsed = time.perf_counter() - startTime
+
+        logger.info("Done Loading Pose Priors (%d cameras referenced, %d seeded)" % (len(matched), seeded))
+        return elapsed, len(matched), seeded
+
+    # Calibration store key of each sensor whose cameras all share one body, lens and focal
+    # length as {sensor key: store key}
+    def sensorCalibrationKeys(self):
+        cameras = [camera for camera in self.chunk.cameras if camera.photo is not None and camera.sensor is not None]
+        identities = CalibrationStore.identifyCameras([camera.photo.path for camera in cameras])
+
+        keys = {}
+        for camera in cameras:
+            keys.setdefault(camera.sensor.key, set()).add(CalibrationStore.calibrationKey(*identities[camera.photo.path]))
+
+        return {sensor: group.pop() for sensor, group in keys.items() if len(group) == 1 and None not in group}
+
+    # Gives every camera body (serial number, lens and focal length) its own sensor so each is
+    # calibrated separately. Cameras without a serial number keep the sensor Metashape gave them.
+    # - returns {store key: sensor}
+    def groupSensorsBySerial(self):
+        MetaUtils.ensureLoggerReady()
+
+        cameras = [camera for camera in self.chunk.cameras if camera.photo is not None and camera.sensor is not None]
+        identities = CalibrationStore.identifyCameras([camera.photo.path for camera in cameras])
+
+        groups = {}
+        for camera in cameras:
+            key = CalibrationStore.calibrationKey(*identities[camera.photo.path])
+            if key is not None:
+                groups.setdefault((key, camera.sensor.key), []).append(camera)
+
+        # New sensors copy the settings of the sensor Metashape made for the group (sensors
+        # grouped on an earlier run are kept along with their calibration)
+        sensors = {}
+        for (key, sensorKey), group in sorted(groups.items(), key=lambda item: item[0][0]):
+            if key in sensors:
+                logger.warning("Cameras of %s have different image sizes, leaving %d on their own sensor" % (key, len(group)))
+                continue
+            if group[0].sensor.label == key:
+                sensors[key] = group[0].sensor
+                continue
+            sensor = self.chunk.addSensor(group[0].sensor)
+            sensor.label = key
+            for camera in group:
+                camera.sensor = sensor
+            sensors[key] = sensor
+
+        # Remove the sensors no longer used by any camera
+        used = set(camera.sensor.key for camera in self.chunk.cameras if camera.sensor is not None)
+        unused = [sensor for sensor in self.chunk.sensors if sensor.key not in used]
+        if len(unused) > 0:
+            self.chunk.remove(unused)
+
+        logger.info("Grouped %d cameras into %d sensors by serial number" % (
+            sum(len(group) for group in groups.values()), len(sensors)))
+        return sensors
+
+    # Seeds the sensor of each camera body with its calibration from the store (before alignment).
+    # - fixed keeps the stored calibrations as they are instead of refining them
+    # - returns the time taken, the seeded keys and the keys with nothing stored
+    def seedCalibrations(self, storePath, fixed=False):
+        MetaUtils.ensureLoggerReady()
+
+        logger.info("Seeding camera calibrations from " + storePath)
+        startTime = time.perf_counter()
+        store = CalibrationStore.loadStore(storePath)
+        sensors = self.groupSensorsBySerial()
+
+        seeded, missing = [], []
+        for key, sensor in sorted(sensors.items()):
+            stored = CalibrationStore.findCalibration(store, key, sensor.width, sensor.height)
+            if stored is None:
+                missing.append(key)
+                continue
+
+            calibration = Metashape.Calibration()
+            calibration.width = sensor.width
+            calibration.height = sensor.height
+            for parameter in CalibrationStore.CALIBRATION_PARAMETERS:
+                setattr(calibration, parameter, stored[parameter])
+            sensor.user_calib = calibration
+            sensor.fixed_calibration = fixed
+            seeded.append(key)
+
+        for key in missing:
+            logger.warning("No stored calibration for %s" % key)
+        elapsed = time.perf_counter() - startTime
+
+        logger.info("Done Seeding Calibrations (%d of %d sensors%s)" % (len(seeded), len(sensors), ", fixed" if fixed else ""))
+        return elapsed, seeded, missing
+
+    # Records the optimized calibration of every camera body's sensor in the store
+    def exportCalibrations(self, storePath):
+        MetaUtils.ensureLoggerReady()
+
+        store = CalibrationStore.loadStore(storePath)
+        error = self.tiePointError()
+        sensors = {sensor.key: sensor for sensor in self.chunk.sensors}
+        exported = 0
+        for sensorKey, key in sorted(self.sensorCalibrationKeys().items(), key=lambda item: item[1]):
+            sensor = sensors[sensorKey]
+            if sensor.calibration is None:
+                continue
+            values = {parameter: getattr(sensor.calibration, parameter) for parameter in CalibrationStore.CALIBRATION_PARAMETERS}
+            CalibrationStore.recordCalibration(store, key, sensor.width, sensor.height, values, error)
+            exported += 1
+
+        CalibrationStore.saveStore(storePath, store)
+        logger.info("Exported %d camera calibrations to %s" % (exported, storePath))
+        return exported
+
     # Displays marker info.
     def outputMarkers(self):
         MetaUtils.ensureLoggerReady()
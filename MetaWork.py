@@ -1,5 +1,7 @@
 """A script containing various Metashape workflows."""
 
+import json
+import time
 from datetime import timedelta
 
 import Metashape
@@ -7,6 +9,10 @@ from CustomProgress import PBar
 
 from ProjectPrefs import ProjectPrefs
 from MetaUtilsClass import MetaUtils
+from Checkpoints import Checkpoints
+import RigPairs
+import Partition
+import CostModel
 
 # Import the logging module and get a custom logger for this module
 import Logger
@@ -21,100 +27,271 @@ def ensureLoggerReady():
     if logger is None:
         logger = Logger.getLogger('MetaUtils')
 
+"""Quality Presets"""
+# Quality levels from the fastest to the best
+PRESET_ORDER = ('quick', 'general', 'archival')
+
+# Stage parameters of every quality level (a new level only needs a record in each table)
+# - name is used in log messages
+# - rates are the seconds per camera assumed for each cost model stage until it has been
+#   timed on this machine (see CostModel)
+# - match is passed to matchPhotos
+ALIGN_PRESETS = {
+    'quick': {'name': 'Quick', 'rates': {'align': 0.3},
+              'match': {'downscale': 8, 'keypoint_limit': 40000, 'tiepoint_limit': 20000}},
+    'general': {'name': 'General', 'rates': {'align': 1.5},
+                'match': {'downscale': 2, 'keypoint_limit': 40000, 'tiepoint_limit': 40000}},
+    'archival': {'name': 'Archival', 'rates': {'align': 4.0},
+                 'match': {'downscale': 0, 'keypoint_limit': 40000, 'tiepoint_limit': 10000}}
+}
+
+# - depthMaps is passed to buildDepthMaps
+# - neighbors is the max_neighbors of buildPointCloud
+DENSE_PRESETS = {
+    'quick': {'name': 'Quick', 'neighbors': 50, 'rates': {'depth': 0.5, 'dense': 0.8},
+              'depthMaps': {'downscale': 8, 'filter_mode': Metashape.AggressiveFiltering, 'max_neighbors': 50}},
+    'general': {'name': 'General', 'neighbors': 100, 'rates': {'depth': 2.0, 'dense': 3.0},
+                'depthMaps': {'downscale': 4, 'filter_mode': Metashape.AggressiveFiltering, 'max_neighbors': 100}},
+    'archival': {'name': 'Archival', 'neighbors': 100, 'rates': {'depth': 12.0, 'dense': 18.0},
+                 'depthMaps': {'downscale': 1, 'filter_mode': Metashape.MildFiltering, 'max_neighbors': 100}}
+}
+
+# - uv is passed to buildUV
+# - textureSize is the size of the (single) texture
+# - region is the region scale models are built in (see MetaUtils.setRegion())
+MODEL_PRESETS = {
+    'quick': {'name': 'Quick', 'region': 0.33, 'textureSize': 1024,
+              'rates': {'model_tie_points': 0.05, 'model_depth_maps': 0.3, 'model_dense_cloud': 0.3},
+              'uv': {'mapping_mode': Metashape.GenericMapping, 'page_count': 1, 'texture_size': 1024}},
+    'general': {'name': 'General', 'region': 0.5, 'textureSize': 4096,
+                'rates': {'model_tie_points': 0.2, 'model_depth_maps': 1.5, 'model_dense_cloud': 1.5}, 'uv': {}},
+    'archival': {'name': 'Archival', 'region': 0.66, 'textureSize': 8192,
+                 'rates': {'model_tie_points': 0.4, 'model_depth_maps': 4.0, 'model_dense_cloud': 4.0}, 'uv': {}}
+}
+
+# Level of every stage for each named workflow
+def presetStages(preset):
+    return {'align': preset, 'dense': preset, 'model': preset}
+
+# Default rates of every cost model stage and level ({stage: {level: seconds per camera}})
+def presetRates():
+    rates = {}
+    for table in (ALIGN_PRESETS, DENSE_PRESETS, MODEL_PRESETS):
+        for level, settings in table.items():
+            for stage, rate in settings.get('rates', {}).items():
+                rates.setdefault(stage, {})[level] = rate
+    return rates
+
+
 """Alignment Options"""
-# Automates Metashape GUI process "Add Photos", "Tool->Detect Markers",
-# "Workflow->Align Photos" with settings for quick results.
-def quickAlign(chunk, prefsFileName=None, refine=False):
+# Extra matchPhotos options restricting matching to the image pairs the rig layout
+# allows to overlap (see RigPairs).
+# - rigPairs is a dict of RigPairs.imagePairs() options or None to let Metashape preselect
+def rigMatchOptions(chunk, rigPairs=None):
+    if rigPairs is None:
+        return {}
+
     ensureLoggerReady()
-    # From API "Perform image matching for the chunk frame."
-    # - First step of the Metashape GUI "Workflow" process "Align Photos",
-    #   which generates the Sparse Cloud/Tie Points.
-    # - Keypoints and Tiepoints for this script is Agisoft's suggested default.
-    # - Accuracy below MediumAccuracy consistently results in failed camera
-    #   alignment.
-    # - HighAccuracy is used in this script as the results are better for and
-    #   the time added is negligible.
-    logger.info("Quickly aligning photos")
+    cameras = {camera.photo.path: camera for camera in chunk.cameras
+               if camera.enabled and camera.photo is not None}
+    pairs, unplaced = RigPairs.imagePairs(sorted(cameras), **rigPairs)
+    if len(unplaced) > 0:
+        logger.warning("%d cameras have no rig position and are matched against every camera" % len(unplaced))
+
+    logger.info("Matching %d rig pairs between %d cameras" % (len(pairs), len(cameras)))
+    return {'pairs': [(cameras[first].key, cameras[second].key) for first, second in sorted(pairs)]}
+
+# Extra matchPhotos options preselecting pairs by the camera reference locations (set by
+# MetaUtils.loadPosePriors()) when any enabled camera has one
+def priorMatchOptions(chunk):
+    for camera in chunk.cameras:
+        if camera.enabled and camera.reference.location is not None and camera.reference.location_enabled:
+            return {'reference_preselection': True, 'reference_preselection_mode': Metashape.ReferencePreselectionSource}
+
+    return {}
+
+# Matches every camera and keeps the poses seeded from pose priors: tie points are triangulated
+# from the seeded cameras and only the cameras without a seed are aligned to them.
+# - matchOptions are the matchPhotos settings of the calling quality preset
+def seededAlign(chunk, prefsFileName=None, **matchOptions):
+    ensureLoggerReady()
+
+    cameras = [camera for camera in chunk.cameras if camera.enabled]
+    unposed = [camera for camera in cameras if camera.transform is None]
+    logger.info("Seeded alignment of %d cameras (%d without a seed)" % (len(cameras), len(unposed)))
+
     elapsed1 = -1
     with PBar("Matching Photos") as pbar:
-        chunk.matchPhotos(
-            downscale=8, generic_preselection=True, filter_mask=True,
-            reset_matches=(not refine), mask_tiepoints=False,
-            keypoint_limit=(40000), tiepoint_limit=(20000),
-            progress=(lambda x: pbar.update(x))
-        )
+        chunk.matchPhotos(cameras=cameras, reset_matches=True, progress=(lambda x: pbar.update(x)), **matchOptions)
         pbar.finish()
         elapsed1 = pbar.getTime()
 
-    # From API "Perform photo alignment for the chunk."
-    # - Second step of the Metashape GUI "Workflow" process "Align Photos",
-    #   which generates the Sparse Cloud/Tie Points.
+    # From API "Rebuild point cloud for the chunk."
+    # - Tie points of the seeded cameras without running a full alignment
     elapsed2 = -1
-    with PBar("Aligning Cameras") as pbar:
-        chunk.alignCameras(reset_alignment=(not refine), progress=(lambda x: pbar.update(x)))
+    with PBar("Triangulating Points") as pbar:
+        if len(unposed) < len(cameras):
+            chunk.triangulateTiePoints(progress=(lambda x: pbar.update(x)))
         pbar.finish()
         elapsed2 = pbar.getTime()
 
-    # Print the timing
-    logger.info("Quick alignment complete: %s" % format_td(elapsed1 + elapsed2))
+    elapsed3 = 0
+    if len(unposed) > 0:
+        with PBar("Aligning Remaining") as pbar:
+            chunk.alignCameras(cameras=unposed, reset_alignment=False, progress=(lambda x: pbar.update(x)))
+            pbar.finish()
+            elapsed3 = pbar.getTime()
 
-    # Write the timing to the project preferences file
+    aligned = sum(1 for camera in cameras if camera.transform is not None)
+    logger.info("Seeded alignment complete: %s (%d of %d cameras aligned)" % (
+        format_td(elapsed1 + elapsed2 + elapsed3), aligned, len(cameras)))
+
+    # Save timing to project preferences file
     if prefsFileName is not None:
         prefs = ProjectPrefs(prefsFileName)
-        prefs.setPref('IMAGE_ALIGN', elapsed1 + elapsed2)
+        prefs.setPref('IMAGE_ALIGN', elapsed1 + elapsed2 + elapsed3)
         prefs.setPref('IMAGE_ALIGN_MATCHING', elapsed1)
-        prefs.setPref('IMAGE_ALIGN_BUNDLE_ADJUST', elapsed2)
+        prefs.setPref('IMAGE_ALIGN_BUNDLE_ADJUST', elapsed2 + elapsed3)
+        prefs.setPref('ALIGN_ALIGNED_CAMERAS', aligned)
         prefs.saveConfig()
 
-# Automates Metashape GUI process "Add Photos", "Tool->Detect Markers",
-# "Workflow->Align Photos" with settings for general results.
-def genAlign(chunk, prefsFileName=None, refine=False):
+# Cameras of each sensor in label order (the capture order of each rig camera)
+def sensorGroups(cameras):
+    groups = {}
+    for camera in sorted(cameras, key=lambda camera: camera.label):
+        groups.setdefault(None if camera.sensor is None else camera.sensor.key, []).append(camera)
+    return list(groups.values())
+
+# Picks the cameras aligned first by progressiveAlign: every step'th camera (in label
+# order) of each sensor, so the subset spreads over the whole capture of every rig camera
+def selectAlignmentSubset(cameras, step):
+    return [camera for group in sensorGroups(cameras) for camera in group[::max(step, 1)]]
+
+# Pairs (of camera keys) progressiveAlign matches the remaining cameras with: rig pairs that
+# have a remaining camera or, without rig pairs, the cameras of the same sensor up to step
+# away in label order (which includes the subset cameras on either side) and the subset
+# camera of every other sensor at the same place in its capture. So the remaining cameras
+# are matched against the solved core (and each other) instead of the whole session.
+def remainingPairs(cameras, subsetKeys, step, rigPairs=None):
+    if rigPairs is not None:
+        return [pair for pair in rigPairs if pair[0] not in subsetKeys or pair[1] not in subsetKeys]
+
+    step = max(step, 1)
+    groups = sensorGroups(cameras)
+    pairs = set()
+    for group in groups:
+        for index, camera in enumerate(group):
+            if camera.key in subsetKeys:
+                continue
+            others = group[max(index - step, 0):index] + group[index + 1:index + step + 1]
+            others += [other[index // step * step] for other in groups
+                       if other is not group and index // step * step < len(other)]
+            pairs.update(tuple(sorted((camera.key, other.key))) for other in others)
+
+    return sorted(pairs)
+
+# Matches and aligns a spread out subset of the cameras first and then adds the rest
+# incrementally against the solved core instead of aligning every camera at once.
+# - matchOptions are the matchPhotos settings of the calling quality preset
+def progressiveAlign(chunk, step, prefsFileName=None, **matchOptions):
     ensureLoggerReady()
-    # From API "Perform image matching for the chunk frame."
-    # - First step of the Metashape GUI "Workflow" process "Align Photos",
-    #   which generates the Sparse Cloud/Tie Points.
-    # - Keypoints and Tiepoints for this script is Agisoft's suggested default.
-    # - Accuracy below MediumAccuracy consistently results in failed camera
-    #   alignment.
-    # - HighAccuracy is used in this script as the results are better for and
-    #   the time added is negligible.
-    logger.info("Aligning photos for general quality")
+
+    cameras = [camera for camera in chunk.cameras if camera.enabled]
+    subset = selectAlignmentSubset(cameras, step)
+    subsetKeys = set(camera.key for camera in subset)
+    rest = [camera for camera in cameras if camera.key not in subsetKeys]
+    logger.info("Progressive alignment of %d cameras (%d in first pass)" % (len(cameras), len(subset)))
+
+    # Rig pairs are limited to the subset in the first phase (falling back to preselection
+    # when the subset is too sparse for any of them)
+    subsetOptions = dict(matchOptions)
+    if 'pairs' in matchOptions:
+        subsetOptions['pairs'] = [pair for pair in matchOptions['pairs']
+                                  if pair[0] in subsetKeys and pair[1] in subsetKeys]
+        if len(subsetOptions['pairs']) == 0:
+            del subsetOptions['pairs']
+
+    # Phase 1: match and align the subset from scratch
     elapsed1 = -1
-    with PBar("Matching Photos") as pbar:
-        chunk.matchPhotos(
-            downscale=2, generic_preselection=True, filter_mask=True,
-            reset_matches=(not refine), mask_tiepoints=False,
-            keypoint_limit=(40000), tiepoint_limit=(40000),
-            progress=(lambda x: pbar.update(x))
-        )
+    with PBar("Matching Subset") as pbar:
+        chunk.matchPhotos(cameras=subset, reset_matches=True, progress=(lambda x: pbar.update(x)), **subsetOptions)
         pbar.finish()
         elapsed1 = pbar.getTime()
 
-    # From API "Perform photo alignment for the chunk."
-    # - Second step of the Metashape GUI "Workflow" process "Align Photos",
-    #   which generates the Sparse Cloud/Tie Points.
     elapsed2 = -1
-    with PBar("Aligning Cameras") as pbar:
-        chunk.alignCameras(reset_alignment=(not refine), progress=(lambda x: pbar.update(x)))
+    with PBar("Aligning Subset") as pbar:
+        chunk.alignCameras(cameras=subset, reset_alignment=True, progress=(lambda x: pbar.update(x)))
         pbar.finish()
         elapsed2 = pbar.getTime()
 
-    # Print the timing
-    logger.info("General alignment complete: %s" % format_td(elapsed1 + elapsed2))
+    # Phase 2: match the remaining cameras against the solved core (keeping the subset's
+    # matches) and add them to the existing alignment
+    remainingOptions = dict(matchOptions)
+    remainingOptions['pairs'] = remainingPairs(cameras, subsetKeys, step, matchOptions.get('pairs'))
+    allPairs = len(cameras) * (len(cameras) - 1) // 2
+    logger.info("Matching %d remaining cameras in %d pairs (%.1f%% of all %d)" % (
+        len(rest), len(remainingOptions['pairs']), 100.0 * len(remainingOptions['pairs']) / max(allPairs, 1), allPairs))
+
+    elapsed3 = 0
+    elapsed4 = 0
+    if len(rest) > 0:
+        with PBar("Matching Remaining") as pbar:
+            chunk.matchPhotos(cameras=cameras, reset_matches=False, progress=(lambda x: pbar.update(x)), **remainingOptions)
+            pbar.finish()
+            elapsed3 = pbar.getTime()
 
-    # Save timing information to project preferences file
+        with PBar("Aligning Remaining") as pbar:
+            chunk.alignCameras(cameras=rest, reset_alignment=False, progress=(lambda x: pbar.update(x)))
+            pbar.finish()
+            elapsed4 = pbar.getTime()
+
+    # Cameras the neighbour pairs could not place are matched against every aligned camera
+    unaligned = [camera for camera in rest if camera.transform is None]
+    fallbackPairs = 0
+    if len(unaligned) > 0:
+        alignedCameras = [camera for camera in cameras if camera.transform is not None]
+        fallbackOptions = dict(matchOptions)
+        fallbackOptions['pairs'] = [(camera.key, other.key) for camera in unaligned for other in alignedCameras]
+        fallbackOptions['pairs'] += [(first.key, second.key) for index, first in enumerate(unaligned)
+                                     for second in unaligned[index + 1:]]
+        fallbackPairs = len(fallbackOptions['pairs'])
+        logger.warning("%d cameras did not align, matching them with every camera (%d pairs)" % (len(unaligned), fallbackPairs))
+
+        with PBar("Matching Unaligned") as pbar:
+            chunk.matchPhotos(cameras=cameras, reset_matches=False, progress=(lambda x: pbar.update(x)), **fallbackOptions)
+            pbar.finish()
+            elapsed3 += pbar.getTime()
+
+        with PBar("Aligning Unaligned") as pbar:
+            chunk.alignCameras(cameras=unaligned, reset_alignment=False, progress=(lambda x: pbar.update(x)))
+            pbar.finish()
+            elapsed4 += pbar.getTime()
+
+    aligned = sum(1 for camera in cameras if camera.transform is not None)
+    logger.info("Progressive alignment complete: %s (%d of %d cameras aligned)" % (
+        format_td(elapsed1 + elapsed2 + elapsed3 + elapsed4), aligned, len(cameras)))
+
+    # Save timing of each phase to project preferences file
     if prefsFileName is not None:
         prefs = ProjectPrefs(prefsFileName)
-        prefs.setPref('IMAGE_ALIGN', elapsed1 + elapsed2)
-        prefs.setPref('IMAGE_ALIGN_MATCHING', elapsed1)
-        prefs.setPref('IMAGE_ALIGN_BUNDLE_ADJUST', elapsed2)
+        prefs.setPref('IMAGE_ALIGN', elapsed1 + elapsed2 + elapsed3 + elapsed4)
+        prefs.setPref('IMAGE_ALIGN_MATCHING', elapsed1 + elapsed3)
+        prefs.setPref('IMAGE_ALIGN_BUNDLE_ADJUST', elapsed2 + elapsed4)
+        prefs.setPref('IMAGE_ALIGN_SUBSET_MATCHING', elapsed1)
+        prefs.setPref('IMAGE_ALIGN_SUBSET_BUNDLE_ADJUST', elapsed2)
+        prefs.setPref('IMAGE_ALIGN_REMAINING_MATCHING', elapsed3)
+        prefs.setPref('IMAGE_ALIGN_REMAINING_BUNDLE_ADJUST', elapsed4)
+        prefs.setPref('ALIGN_SUBSET_CAMERAS', len(subset))
+        prefs.setPref('ALIGN_REMAINING_PAIRS', len(remainingOptions['pairs']) + fallbackPairs)
+        prefs.setPref('ALIGN_ALIGNED_CAMERAS', aligned)
         prefs.saveConfig()
 
-
-# Automates Metashape GUI process "Add Photos", "Tool->Detect Markers",
-# "Workflow->Align Photos" with settings for archival results.
-def arcAlign(chunk, prefsFileName=None, refine=False):
+# Automates Metashape GUI process "Workflow->Align Photos" with the settings of a quality
+# level (see ALIGN_PRESETS).
+def presetAlign(chunk, preset, prefsFileName=None, refine=False, progressive=None, rigPairs=None, seeded=False):
     ensureLoggerReady()
+    settings = ALIGN_PRESETS[preset]
+
     # From API "Perform image matching for the chunk frame."
     # - First step of the Metashape GUI "Workflow" process "Align Photos",
     #   which generates the Sparse Cloud/Tie Points.
@@ -123,15 +300,26 @@ def arcAlign(chunk, prefsFileName=None, refine=False):
     #   alignment.
     # - HighAccuracy is used in this script as the results are better for and
     #   the time added is negligible.
-    logger.info("Aligning photos for archival quality")
+    logger.info("Aligning photos for %s quality" % preset)
+
+    # Restrict matching to the rig pairs (when requested) and preselect by pose priors (when loaded)
+    matchOptions = dict(settings['match'], generic_preselection=True, filter_mask=True, mask_tiepoints=False)
+    matchOptions.update(rigMatchOptions(chunk, rigPairs))
+    matchOptions.update(priorMatchOptions(chunk))
+
+    # Keep the poses seeded from pose priors (not when refining an existing alignment)
+    if seeded and not refine:
+        seededAlign(chunk, prefsFileName, **matchOptions)
+        return
+
+    # Align every Nth camera first and then the rest (not when refining an existing alignment)
+    if progressive is not None and not refine:
+        progressiveAlign(chunk, progressive, prefsFileName, **matchOptions)
+        return
+
     elapsed1 = -1
     with PBar("Matching Photos") as pbar:
-        chunk.matchPhotos(
-            downscale=0, generic_preselection=True, filter_mask=True,
-            reset_matches=(not refine), mask_tiepoints=False,
-            keypoint_limit=(40000), tiepoint_limit=(10000),
-            progress=(lambda x: pbar.update(x))
-        )
+        chunk.matchPhotos(reset_matches=(not refine), progress=(lambda x: pbar.update(x)), **matchOptions)
         pbar.finish()
         elapsed1 = pbar.getTime()
 
@@ -140,12 +328,12 @@ def arcAlign(chunk, prefsFileName=None, refine=False):
     #   which generates the Sparse Cloud/Tie Points.
     elapsed2 = -1
     with PBar("Aligning Cameras") as pbar:
-        chunk.alignCameras(progress=(lambda x: pbar.update(x)), reset_alignment=True)
+        chunk.alignCameras(reset_alignment=(not refine), progress=(lambda x: pbar.update(x)))
         pbar.finish()
         elapsed2 = pbar.getTime()
 
     # Print the timing
-    logger.info("Archival alignment complete: %s" % format_td(elapsed1 + elapsed))
+    logger.info("%s alignment complete: %s" % (settings['name'], format_td(elapsed1 + elapsed2)))
 
     # Save timing information to project preferences file
     if prefsFileName is not None:
@@ -156,141 +344,91 @@ def arcAlign(chunk, prefsFileName=None, refine=False):
         prefs.saveConfig()
 
 
-"""Dense Cloud Options"""
-# Automates Metashape GUI "Workflow->Dense Cloud" with settings for
-# general use.
-def quickDenseCloud(chunk, prefsFileName=None, refine=False, noCloud=False):
+"""Tie Point Options"""
+# Automates Metashape GUI "Model->Gradual Selection" followed by
+# "Tools->Optimize Cameras", repeated until the error stops improving.
+# - gradual is a dict of MetaUtils.gradualSelection() options (may be empty)
+def gradualFilter(MU, prefsFileName=None, gradual=None):
     ensureLoggerReady()
 
-    # From API "Generate depth maps for the chunk."
-    # - First step of the Metashape GUI "Workflow" process called "Dense Cloud".
-    # - max_neighbors parameter may save time and help with shadows (-1 is none).
-    elapsed1 = -1
-    logger.info("Building quick quality Dense Cloud")
-    with PBar("Building Depth Maps") as pbar:
-        chunk.buildDepthMaps(
-            downscale=8, filter_mode=Metashape.AggressiveFiltering,
-            max_neighbors=50, progress=(lambda x: pbar.update(x))
-        )
-        pbar.finish()
-        elapsed1 = pbar.getTime()
-
-    # From API "Generate dense cloud for the chunk."
-    # - Second step of the Metashape GUI "Workflow" process called "Dense Cloud".
-    elapsed2 = -1
-    if not noCloud:
-        with PBar("Building Point Cloud") as pbar:
-            chunk.buildPointCloud(
-                point_colors=True, keep_depth=True,
-                max_neighbors=50, progress=(lambda x: pbar.update(x))
-            )
-            pbar.finish()
-            elapsed2 = pbar.getTime()
-
-        logger.info("Done building dense cloud")
-    else:
-        elapsed2 = 0
-        logger.info("Skipping dense cloud")
-
-    logger.info("Quick Dense Cloud complete: %s" % format_td(elapsed1 + elapsed2))
+    elapsed, iterations = MU.gradualSelection(**(gradual or {}))
+    logger.info("Gradual selection complete: %s" % format_td(elapsed))
 
-    # Save timing information to project preferences file
+    # Save timing and per-pass results to project preferences file
     if prefsFileName is not None:
         prefs = ProjectPrefs(prefsFileName)
-        prefs.setPref('DENSE_CLOUD', elapsed1 + elapsed2)
-        prefs.setPref('DENSE_CLOUD_DEPTH_MAPS', elapsed1)
-        if not noCloud: prefs.setPref('DENSE_CLOUD_BUILD', elapsed2)
+        prefs.setPref('TIE_POINT_FILTER', elapsed)
+        prefs.setPref('TIE_POINT_FILTER_PASSES', json.dumps(iterations))
+        if len(iterations) > 0:
+            prefs.setPref('TIE_POINT_COUNT', iterations[-1]['points'])
         prefs.saveConfig()
 
-# Automates Metashape GUI "Workflow->Dense Cloud" with settings for
-# general use.
-def genDenseCloud(chunk, prefsFileName=None, refine=False, noCloud=False):
-    ensureLoggerReady()
-
-    # From API "Generate depth maps for the chunk."
-    # - First step of the Metashape GUI "Workflow" process called "Dense Cloud".
-    # - max_neighbors parameter may save time and help with shadows (-1 is none).
-    elapsed1 = -1
-    logger.info("Building general quality Dense Cloud")
-    with PBar("Building Depth Maps") as pbar:
-        chunk.buildDepthMaps(
-            downscale=4, filter_mode=Metashape.AggressiveFiltering,
-            max_neighbors=100, progress=(lambda x: pbar.update(x))
-        )
-        pbar.finish()
-        elapsed1 = pbar.getTime()
-
-    # From API "Generate dense cloud for the chunk."
-    # - Second step of the Metashape GUI "Workflow" process called "Dense Cloud".
-    elapsed2 = -1
-    if not noCloud:
-        with PBar("Building Point Cloud") as pbar:
-            chunk.buildPointCloud(
-                point_colors=True, keep_depth=True,
-                max_neighbors=100, progress=(lambda x: pbar.update(x))
-            )
-            pbar.finish()
-            elapsed2 = pbar.getTime()
-
-        logger.info("Done building dense cloud")
+# Optimizes the cameras, using gradual selection first when requested
+def optimizeAfterFilter(MU, prefsFileName=None, gradual=None):
+    if gradual is not None:
+        gradualFilter(MU, prefsFileName, gradual)
     else:
-        elapsed2 = 0
-        logger.info("Skipping dense cloud")
-
-    logger.info("General Dense Cloud complete: %s" % format_td(elapsed1 + elapsed2))
+        MU.optimizeCameras()
 
-    # Save timing information to project preferences file
-    if prefsFileName is not None:
-        prefs = ProjectPrefs(prefsFileName)
-        prefs.setPref('DENSE_CLOUD', elapsed1 + elapsed2)
-        prefs.setPref('DENSE_CLOUD_DEPTH_MAPS', elapsed1)
-        if not noCloud: prefs.setPref('DENSE_CLOUD_BUILD', elapsed2)
-        prefs.saveConfig()
+# Records the optimized camera calibrations in the calibration store (unless they were fixed)
+# - calibrations is a dict with the 'store' path and whether the calibrations are 'fixed' (or None)
+def updateCalibrationStore(MU, calibrations=None):
+    if calibrations is not None and not calibrations.get('fixed', False):
+        MU.exportCalibrations(calibrations['store'])
 
 
-# Automates Metashape GUI "Workflow->Dense Cloud" with settings for
-# archival use.
-def arcDenseCloud(chunk, prefsFileName=None, refine=False, noCloud=False):
+"""Dense Cloud Options"""
+# Automates Metashape GUI "Workflow->Dense Cloud" with the settings of a quality level
+# (see DENSE_PRESETS).
+# - checkpoints skips the steps already completed when resuming (see Checkpoints)
+def presetDenseCloud(chunk, preset, prefsFileName=None, refine=False, noCloud=False, checkpoints=None):
     ensureLoggerReady()
+    settings = DENSE_PRESETS[preset]
+    checkpoints = checkpoints or Checkpoints(chunk)
+    params = {'preset': preset}
 
     # From API "Generate depth maps for the chunk."
     # - First step of the Metashape GUI "Workflow" process called "Dense Cloud".
     # - max_neighbors parameter may save time and help with shadows (-1 is none).
-    elapsed1 = -1
-    logger.info("Building archival quality Dense Cloud")
-    with PBar("Generating Depth Maps") as pbar:
-        chunk.buildDepthMaps(
-            downscale=1, filter_mode=Metashape.MildFiltering,
-            max_neighbors=100, progress=(lambda x: pbar.update(x))
-        )
-        pbar.finish()
-        elapsed1 = pbar.getTime()
+    elapsed1 = None
+    logger.info("Building %s quality Dense Cloud" % preset)
+    if not checkpoints.isDone('depth_maps', params, ('depthMaps',)):
+        with PBar("Building Depth Maps") as pbar:
+            chunk.buildDepthMaps(progress=(lambda x: pbar.update(x)), **settings['depthMaps'])
+            pbar.finish()
+            elapsed1 = pbar.getTime()
+        checkpoints.complete('depth_maps', params, ('depthMaps',), elapsed1)
 
     # From API "Generate dense cloud for the chunk."
     # - Second step of the Metashape GUI "Workflow" process called "Dense Cloud".
-    elapsed2 = -1
-    if not noCloud:
-        with PBar("Generating Point Cloud") as pbar:
+    elapsed2 = None
+    if noCloud:
+        logger.info("Skipping dense cloud")
+    elif not checkpoints.isDone('point_cloud', params, ('pointCloud',)):
+        with PBar("Building Point Cloud") as pbar:
             chunk.buildPointCloud(
                 point_colors=True, keep_depth=True,
-                max_neighbors=100, progress=(lambda x: pbar.update(x))
+                max_neighbors=settings['neighbors'], progress=(lambda x: pbar.update(x))
             )
             pbar.finish()
             elapsed2 = pbar.getTime()
+        checkpoints.complete('point_cloud', params, ('pointCloud',), elapsed2)
 
         logger.info("Done building dense cloud")
-    else:
-        elapsed2 = 0
-        logger.info("Skipping dense cloud")
 
-    logger.info("Archival Dense Cloud complete: %s" % format_td(elapsed1 + elapsed2))
+    if elapsed1 is None and elapsed2 is None:
+        logger.info("%s Dense Cloud already complete" % settings['name'])
+        return
 
-    # Save timing information to project preferences file
+    elapsed = (elapsed1 or 0) + (elapsed2 or 0)
+    logger.info("%s Dense Cloud complete: %s" % (settings['name'], format_td(elapsed)))
+
+    # Save timing information to project preferences file (only for the steps that ran)
     if prefsFileName is not None:
         prefs = ProjectPrefs(prefsFileName)
-        prefs.setPref('DENSE_CLOUD', elapsed1 + elapsed2)
-        prefs.setPref('DENSE_CLOUD_DEPTH_MAPS', elapsed1)
-        if not noCloud: prefs.setPref('DENSE_CLOUD_BUILD', elapsed2)
+        prefs.setPref('DENSE_CLOUD', elapsed)
+        if elapsed1 is not None: prefs.setPref('DENSE_CLOUD_DEPTH_MAPS', elapsed1)
+        if elapsed2 is not None: prefs.setPref('DENSE_CLOUD_BUILD', elapsed2)
         prefs.saveConfig()
 
 
@@ -307,190 +445,156 @@ def getSourceNames(sourceData):
     return '', ''
 
 # Automates Metashape GUI "Workflow" process "Build Mesh" and
-# "Build Texture" with settings for quick results.
-def quickModel(chunk, sourceData=Metashape.TiePointsData, prefsFileName=None, refine=False):
-    ensureLoggerReady()
-
-    # Determine source data type
-    sourceString, sourceSuffix = getSourceNames(sourceData)
-
-    # From API "Generate model for the chunk frame."
-    # - Builds mesh to be used in the last steps.
-    logger.info("Quickly generating textured 3D model%s" % sourceString)
-    elapsed1 = -1
-    with PBar("Generating Model") as pbar:
-        chunk.buildModel(surface_type=Metashape.Arbitrary,
-                         interpolation=Metashape.EnabledInterpolation,
-                         face_count=Metashape.HighFaceCount,
-                         source_data=sourceData,
-                         vertex_colors=True, keep_depth=True,
-                         progress=(lambda x: pbar.update(x)))
-        pbar.finish()
-        elapsed1 = pbar.getTime()
-
-    # From API "Generate uv mapping for the model."
-    elapsed2 = -1
-    with PBar("Generating UV Coords") as pbar:
-        chunk.buildUV(
-            mapping_mode=Metashape.GenericMapping,
-            page_count=1, texture_size=1024,
-            progress=(lambda x: pbar.update(x)))
-        pbar.finish()
-        elapsed2 = pbar.getTime()
-
-    # From API "Generate texture for the chunk."
-    # - Generates a basic texture for the 3D model.
-    elapsed3 = -1
-    with PBar("Generating 1k Tex") as pbar:
-        chunk.buildTexture(texture_type=Metashape.Model.DiffuseMap,
-                           blending_mode=Metashape.MosaicBlending,
-                           source_data=Metashape.ImagesData,
-                           texture_size=1024, fill_holes=True,
-                           progress=(lambda x: pbar.update(x)))
-        pbar.finish()
-        elapsed3 = pbar.getTime()
-
-    logger.info("Quick 3D model%s complete: %s" % (sourceString,
-                format_td(elapsed1 + elapsed2 + elapsed3)))
-
-    # Save timing information to project preferences file
-    if prefsFileName is not None:
-        prefs = ProjectPrefs(prefsFileName)
-        prefs.setPref('BUILD_MODEL%s' % sourceSuffix, elapsed1 + elapsed2 + elapsed3)
-        prefs.setPref('BUILD_MODEL_MESH%s' % sourceSuffix, elapsed1)
-        prefs.setPref('BUILD_MODEL_UV%s' % sourceSuffix, elapsed2)
-        prefs.setPref('BUILD_MODEL_TEXTURE%s' % sourceSuffix, elapsed3)
-        prefs.saveConfig()
-
-
-# Automates Metashape GUI "Workflow" process "Build Mesh" and
-# "Build Texture" with settings for general use.
-def genModel(chunk, sourceData=Metashape.PointCloudData, prefsFileName=None, refine=False):
+# "Build Texture" with the settings of a quality level (see MODEL_PRESETS).
+# - the model is labelled with its source so a resumed run can find it again
+# - checkpoints skips the steps already completed when resuming (see Checkpoints)
+def presetModel(chunk, preset, sourceData=Metashape.PointCloudData, prefsFileName=None, refine=False, checkpoints=None):
     ensureLoggerReady()
+    settings = MODEL_PRESETS[preset]
+    checkpoints = checkpoints or Checkpoints(chunk)
+    params = {'preset': preset}
 
     # Determine source data type
     sourceString, sourceSuffix = getSourceNames(sourceData)
+    label = 'Model' + sourceString
+    stage = 'model' + sourceSuffix.lower()
 
     # From API "Generate model for the chunk frame."
     # - Builds mesh to be used in the last steps.
-    logger.info("Building general quality textured 3D model%s" % sourceString)
-    elapsed1 = -1
-    with PBar("Generating Model") as pbar:
-        chunk.buildModel(surface_type=Metashape.Arbitrary,
-                         interpolation=Metashape.EnabledInterpolation,
-                         face_count=Metashape.HighFaceCount,
-                         source_data=sourceData,
-                         vertex_colors=True, keep_depth=True,
-                         progress=(lambda x: pbar.update(x)))
-        pbar.finish()
-        elapsed1 = pbar.getTime()
+    # - Each step (re)builds the model only when the step before it is complete.
+    logger.info("Building %s quality textured 3D model%s" % (preset, sourceString))
+    elapsed1 = None
+    if checkpoints.isDone(stage + '_mesh', params, ('mesh:' + label,)):
+        chunk.model = checkpoints.findModel(label)
+    else:
+        # Drop the model an interrupted run left behind
+        if checkpoints.resume:
+            for model in [model for model in chunk.models if model.label == label]:
+                chunk.remove(model)
+
+        with PBar("Generating Model") as pbar:
+            chunk.buildModel(surface_type=Metashape.Arbitrary,
+                             interpolation=Metashape.EnabledInterpolation,
+                             face_count=Metashape.HighFaceCount,
+                             source_data=sourceData,
+                             vertex_colors=True, keep_depth=True,
+                             progress=(lambda x: pbar.update(x)))
+            pbar.finish()
+            elapsed1 = pbar.getTime()
+        chunk.model.label = label
+        checkpoints.complete(stage + '_mesh', params, ('mesh:' + label,), elapsed1, restartsLater=False)
 
     # From API "Generate uv mapping for the model."
-    elapsed2 = -1
-    with PBar("Generating UV Coords") as pbar:
-        chunk.buildUV(progress=(lambda x: pbar.update(x)))
-        pbar.finish()
-        elapsed2 = pbar.getTime()
+    elapsed2 = None
+    if not checkpoints.isDone(stage + '_uv', params, ('uv:' + label,)):
+        with PBar("Generating UV Coords") as pbar:
+            chunk.buildUV(progress=(lambda x: pbar.update(x)), **settings['uv'])
+            pbar.finish()
+            elapsed2 = pbar.getTime()
+        checkpoints.complete(stage + '_uv', params, ('uv:' + label,), elapsed2, restartsLater=False)
 
     # From API "Generate texture for the chunk."
-    # - Generates a 4k texture for the 3D model.
-    elapsed3 = -1
-    with PBar("Generating 4k Tex") as pbar:
-        chunk.buildTexture(texture_type=Metashape.Model.DiffuseMap,
-                           blending_mode=Metashape.MosaicBlending,
-                           source_data=Metashape.ImagesData,
-                           texture_size=(4096), fill_holes=True,
-                           progress=(lambda x: pbar.update(x)))
-        pbar.finish()
-        elapsed3 = pbar.getTime()
-
-    logger.info("General 3D model%s complete: %s" % (sourceString,
-               format_td(elapsed1 + elapsed2 + elapsed3)))
-
-    # Save timing information to project preferences file
-    if prefsFileName is not None:
-        prefs = ProjectPrefs(prefsFileName)
-        prefs.setPref('BUILD_MODEL%s' % sourceSuffix, elapsed1 + elapsed2 + elapsed3)
-        prefs.setPref('BUILD_MODEL_MESH%s' % sourceSuffix, elapsed1)
-        prefs.setPref('BUILD_MODEL_UV%s' % sourceSuffix, elapsed2)
-        prefs.setPref('BUILD_MODEL_TEXTURE%s' % sourceSuffix, elapsed3)
-        prefs.saveConfig()
-
-# Automates Metashape GUI "Workflow" process "Build Mesh" and
-# "Build Texture" with settings for archival use.
-def arcModel(chunk, sourceData=Metashape.PointCloudData, prefsFileName=None, refine=False):
-    ensureLoggerReady()
-
-    # Determine source data type
-    sourceString, sourceSuffix = getSourceNames(sourceData)
-
-    # From API "Generate model for the chunk frame."
-    # - Builds accurate mesh to be used in the last steps.
-    logger.info("Building archival quality textured 3D model%s" % sourceString)
-    elapsed1 = -1
-    with PBar("Generating Model") as pbar:
-        chunk.buildModel(surface_type=Metashape.Arbitrary,
-                         interpolation=Metashape.EnabledInterpolation,
-                         face_count=Metashape.HighFaceCount,
-                         source_data=sourceData,
-                         vertex_colors=True, keep_depth=True,
-                         progress=(lambda x: pbar.update(x)))
-        pbar.finish()
-        elapsed1 = pbar.getTime()
-
-    # From API "Generate uv mapping for the model."
-    elapsed2 = -1
-    with PBar("Generating UV Coords") as pbar:
-        chunk.buildUV(progress=(lambda x: pbar.update(x)))
-        pbar.finish()
-        elapsed2 = pbar.getTime()
+    # - Generates a single texture of the level's size for the 3D model.
+    elapsed3 = None
+    if not checkpoints.isDone(stage + '_texture', params, ('texture:' + label,)):
+        with PBar("Generating %dk Tex" % (settings['textureSize'] // 1024)) as pbar:
+            chunk.buildTexture(texture_type=Metashape.Model.DiffuseMap,
+                               blending_mode=Metashape.MosaicBlending,
+                               source_data=Metashape.ImagesData,
+                               texture_size=settings['textureSize'], fill_holes=True,
+                               progress=(lambda x: pbar.update(x)))
+            pbar.finish()
+            elapsed3 = pbar.getTime()
+        checkpoints.complete(stage + '_texture', params, ('texture:' + label,), elapsed3, restartsLater=False)
 
-    # From API "Generate texture for the chunk."
-    # - Generates a 16k texture for the 3D model.
-    elapsed3 = -1
-    with PBar("Generating 8k Tex") as pbar:
-        chunk.buildTexture(texture_type=Metashape.Model.DiffuseMap,
-                           blending_mode=Metashape.MosaicBlending,
-                           source_data=Metashape.ImagesData,
-                           texture_size=(8192), fill_holes=True,
-                           progress=(lambda x: pbar.update(x)))
-        pbar.finish()
-        elapsed3 = pbar.getTime()
+    if elapsed1 is None and elapsed2 is None and elapsed3 is None:
+        logger.info("%s 3D model%s already complete" % (settings['name'], sourceString))
+        return
 
-    logger.info("Archival 3D model%s complete: %s" % (sourceString,
-               format_td(elapsed1 + elapsed2 + elapsed3)))
+    elapsed = (elapsed1 or 0) + (elapsed2 or 0) + (elapsed3 or 0)
+    logger.info("%s 3D model%s complete: %s" % (settings['name'], sourceString, format_td(elapsed)))
 
-    # Save timing information to project preferences file
+    # Save timing information to project preferences file (only for the steps that ran)
     if prefsFileName is not None:
         prefs = ProjectPrefs(prefsFileName)
-        prefs.setPref('BUILD_MODEL%s' % sourceSuffix, elapsed1 + elapsed2 + elapsed3)
-        prefs.setPref('BUILD_MODEL_MESH%s' % sourceSuffix, elapsed1)
-        prefs.setPref('BUILD_MODEL_UV%s' % sourceSuffix, elapsed2)
-        prefs.setPref('BUILD_MODEL_TEXTURE%s' % sourceSuffix, elapsed3)
+        prefs.setPref('BUILD_MODEL%s' % sourceSuffix, elapsed)
+        if elapsed1 is not None: prefs.setPref('BUILD_MODEL_MESH%s' % sourceSuffix, elapsed1)
+        if elapsed2 is not None: prefs.setPref('BUILD_MODEL_UV%s' % sourceSuffix, elapsed2)
+        if elapsed3 is not None: prefs.setPref('BUILD_MODEL_TEXTURE%s' % sourceSuffix, elapsed3)
         prefs.saveConfig()
 
 
 """Workflow Options"""
-def metaInit(PATH_TO_IMAGES, PROJECT_NAME, PATH_TO_MASKS=None, prefsFileName=None, markerTolerance=50):
+# - sharpness is a dict of MetaUtils.disableBlurredCameras() options (None to keep every camera)
+# - nativeMasks generates (cached) masks with MaskGenerator instead of Metashape
+# - priors is a dict of MetaUtils.loadPosePriors() options (None to align without references)
+# - calibrations is a dict with the calibration 'store' path and whether to keep them 'fixed'
+#   (None to calibrate every sensor from scratch)
+# - markerSubset is a dict of MetaUtils.detectMarkersOnSubset() options (None to detect on every camera)
+# - resume skips the stages an earlier run completed with the same options (see Checkpoints)
+def metaInit(PATH_TO_IMAGES, PROJECT_NAME, PATH_TO_MASKS=None, prefsFileName=None, markerTolerance=50, sharpness=None, nativeMasks=False, priors=None, calibrations=None, markerSubset=None, resume=False):
     # Creating an instance will initialize the doc, the logger and the paths
     MU = MetaUtils(None, PATH_TO_IMAGES, PROJECT_NAME)
+    checkpoints = MU.checkpoints
+    checkpoints.resume = resume
 
     # Creates an image list and adds them to the current chunk.
     loadElapsed = MU.loadImages()
 
+    # Disables blurred or out of focus cameras before anything is matched
+    sharpElapsed = None
+    if sharpness is not None and not checkpoints.isDone('sharpness', sharpness, ('enabled',)):
+        sharpElapsed, scores, cutoff, disabled = MU.disableBlurredCameras(**sharpness)
+        checkpoints.complete('sharpness', sharpness, ('enabled',), sharpElapsed)
+
+    # References (and optionally seeds) the camera poses from a previous session
+    priorElapsed = None
+    if priors is not None and not checkpoints.isDone('priors', priors, ('references',)):
+        priorElapsed, referenced, seededCount = MU.loadPosePriors(**priors)
+        checkpoints.complete('priors', priors, ('references',), priorElapsed)
+
+    # Gives each camera body its own sensor seeded with its stored calibration
+    calibrationElapsed = None
+    if calibrations is not None and not checkpoints.isDone('calibrations', calibrations, ('sensors',)):
+        calibrationElapsed, calibrated, uncalibrated = MU.seedCalibrations(calibrations['store'], calibrations.get('fixed', False))
+        checkpoints.complete('calibrations', calibrations, ('sensors',), calibrationElapsed)
+
     # Places markers on coded targets in images.
-    markersElapsed = MU.detectMarkers(markerTolerance)
+    markersElapsed = MU.detectMarkers(markerTolerance, markerSubset)
 
     # Creates masks.
     maskElapsed = None
-    if PATH_TO_MASKS is not None:
-        maskElapsed = MU.autoMask(PATH_TO_MASKS)
+    maskOptions = {'path': PATH_TO_MASKS, 'native': nativeMasks}
+    if PATH_TO_MASKS is not None and not checkpoints.isDone('masks', maskOptions, ('masks',)):
+        if nativeMasks:
+            maskElapsed = MU.nativeMask(PATH_TO_MASKS)
+        else:
+            maskElapsed = MU.autoMask(PATH_TO_MASKS)
+        checkpoints.complete('masks', maskOptions, ('masks',), maskElapsed)
 
     if prefsFileName is not None:
         prefs = ProjectPrefs(prefsFileName)
         prefs.setPref('INIT', loadElapsed + markersElapsed +
-                      (0 if maskElapsed is None else maskElapsed))
+                      (0 if maskElapsed is None else maskElapsed) +
+                      (0 if sharpElapsed is None else sharpElapsed) +
+                      (0 if priorElapsed is None else priorElapsed) +
+                      (0 if calibrationElapsed is None else calibrationElapsed))
         prefs.setPref('INIT_IMAGE_LOAD', loadElapsed)
+        if sharpElapsed is not None:
+            prefs.setPref('INIT_SHARPNESS', sharpElapsed)
+            prefs.setPref('SHARPNESS_SCORES', json.dumps(scores))
+            prefs.setPref('SHARPNESS_CUTOFF', cutoff)
+            prefs.setPref('SHARPNESS_DISABLED', json.dumps(disabled))
+        if priorElapsed is not None:
+            prefs.setPref('INIT_POSE_PRIORS', priorElapsed)
+            prefs.setPref('POSE_PRIOR_SOURCE', priors['source'])
+            prefs.setPref('POSE_PRIOR_CAMERAS', referenced)
+            prefs.setPref('POSE_PRIOR_SEEDED', seededCount)
+        if calibrationElapsed is not None:
+            prefs.setPref('INIT_CALIBRATION', calibrationElapsed)
+            prefs.setPref('CALIBRATION_STORE', calibrations['store'])
+            prefs.setPref('CALIBRATION_SEEDED', json.dumps(calibrated))
+            prefs.setPref('CALIBRATION_MISSING', json.dumps(uncalibrated))
         prefs.setPref('INIT_DETECT_MARKERS', markersElapsed)
         if maskElapsed is not None:
             prefs.setPref('INIT_APPLY_MASKS', maskElapsed)
@@ -499,200 +603,287 @@ def metaInit(PATH_TO_IMAGES, PROJECT_NAME, PATH_TO_MASKS=None, prefsFileName=Non
     # Return the initialized MetaUtils object
     return MU
 
-# Quick photogrammetry processing.
-def metaQuick(PATH_TO_IMAGES, PROJECT_NAME, PATH_TO_MASKS=None, prefsFileName=None, markerTolerance=50, refine=False, modelTie=True, modelDepth=False, modelCloud=False):
+# Cost model stage name of each stage run (see CostModel)
+def costStageNames(modelTie, modelDepth, modelCloud):
+    groups = {'align': ['align'], 'dense': [], 'model': []}
+    if modelDepth or modelCloud:
+        groups['dense'].append('dense' if modelCloud else 'depth')
+    for enabled, sourceData in ((modelTie, Metashape.TiePointsData), (modelDepth, Metashape.DepthMapsData), (modelCloud, Metashape.PointCloudData)):
+        if enabled:
+            groups['model'].append('model' + getSourceNames(sourceData)[1].lower())
+    return groups
+
+# Picks the level of each stage so the predicted run time fits the time budget (in seconds)
+def budgetStages(timeBudget, cameras, modelTie, modelDepth, modelCloud, prefsFileName=None):
     ensureLoggerReady()
-    logger.info("Starting quick processing")
 
-    # Initialize the MetaUtils object and project
-    MU = metaInit(PATH_TO_IMAGES, PROJECT_NAME, PATH_TO_MASKS, prefsFileName, markerTolerance)
-    MU.doc.save()
-
-    # Aligns photos and corrects the chunk
-    quickAlign(MU.chunk, prefsFileName, refine)
-    MU.chunkCorrect()
-    MU.setRegion(1.1)
-    MU.filterTiePoints()
-    MU.optimizeCameras()
-    MU.doc.save()
+    history = CostModel.loadHistory()
+    stages, predicted, fits = CostModel.chooseLevels(timeBudget, cameras, costStageNames(modelTie, modelDepth, modelCloud),
+                                                     PRESET_ORDER, history, presetRates())
+    if fits:
+        logger.info("Time budget %s: %s (predicted %s)" % (format_td(timeBudget),
+                    ", ".join("%s %s" % (stage, level) for stage, level in stages.items()), format_td(predicted)))
+    else:
+        logger.warning("Time budget %s is too short, using the fastest stages (predicted %s)" % (
+                       format_td(timeBudget), format_td(predicted)))
 
-    # Generate the dense cloud (if needed)
-    if modelDepth or modelCloud:
-        quickDenseCloud(MU.chunk, prefsFileName, refine, not modelCloud)
-        MU.doc.save()
+    if prefsFileName is not None:
+        prefs = ProjectPrefs(prefsFileName)
+        prefs.setPref('TIME_BUDGET', timeBudget)
+        prefs.setPref('TIME_BUDGET_PREDICTED', predicted)
+        prefs.setPref('TIME_BUDGET_STAGES', json.dumps(stages))
+        prefs.saveConfig()
 
-    # Creates a quick model.
-    MU.setRegion(0.33)
-    if modelTie:
-        quickModel(MU.chunk, Metashape.TiePointsData, prefsFileName, refine)
-        MU.doc.save()
-    if modelDepth:
-        quickModel(MU.chunk, Metashape.DepthMapsData, prefsFileName, refine)
-        MU.doc.save()
-    if modelCloud:
-        quickModel(MU.chunk, Metashape.PointCloudData, prefsFileName, refine)
-        MU.doc.save()
+    return stages
 
-    logger.info("Quick processing done")
+# Records how long a stage took in the timing history used to predict time budgeted runs
+def recordStage(stage, level, cameras, startTime):
+    CostModel.recordTiming(stage, level, cameras, time.perf_counter() - startTime)
 
-# General photogrammetry processing.
-def metaGeneral(PATH_TO_IMAGES, PROJECT_NAME, PATH_TO_MASKS=None, prefsFileName=None, markerTolerance=50, refine=False, modelTie=False, modelDepth=True, modelCloud=False):
+# Photogrammetry processing with the quality level of each stage given by stages (see
+# presetStages()) or picked to fit timeBudget (in seconds, counting from the start).
+# - resume skips the stages an earlier run completed with the same settings, so a failed
+#   run only repeats the stage that failed (see Checkpoints)
+def metaWorkflow(PATH_TO_IMAGES, PROJECT_NAME, PATH_TO_MASKS=None, prefsFileName=None, markerTolerance=50, stages=None, refine=False, modelTie=False, modelDepth=True, modelCloud=False, gradual=None, sharpness=None, nativeMasks=False, progressive=None, rigPairs=None, priors=None, calibrations=None, markerSubset=None, timeBudget=None, resume=False):
     ensureLoggerReady()
-    logger.info("Starting general quality processing")
+    startTime = time.perf_counter()
+    stages = stages or presetStages('general')
+    logger.info("Starting %s processing%s" % ("time budgeted" if timeBudget is not None else stages['align'],
+                " (resuming)" if resume else ""))
 
     # Initialize the MetaUtils object and project
-    MU = metaInit(PATH_TO_IMAGES, PROJECT_NAME, PATH_TO_MASKS, prefsFileName, markerTolerance)
+    MU = metaInit(PATH_TO_IMAGES, PROJECT_NAME, PATH_TO_MASKS, prefsFileName, markerTolerance, sharpness, nativeMasks, priors, calibrations, markerSubset, resume)
     MU.doc.save()
+    cameras = sum(1 for camera in MU.chunk.cameras if camera.enabled)
+    checkpoints = MU.checkpoints
 
-    # Aligns photos and corrects the chunk.
-    genAlign(MU.chunk, prefsFileName, refine)
-    MU.chunkCorrect()
-    MU.setRegion(1.1)
-    MU.filterTiePoints()
-    MU.optimizeCameras()
+    # Fit the rest of the run into what is left of the time budget
+    if timeBudget is not None:
+        stages = budgetStages(timeBudget - (time.perf_counter() - startTime), cameras, modelTie, modelDepth, modelCloud, prefsFileName)
+
+    # Keep the cameras seeded from pose priors instead of aligning from scratch
+    seeded = priors is not None and priors.get('seed', False)
+
+    # Aligns photos and corrects the chunk (stage timings are only recorded when nothing was skipped)
+    stageStart, skipped = time.perf_counter(), len(checkpoints.skipped)
+    checkpoints.run('align', {'preset': stages['align'], 'refine': refine, 'progressive': progressive, 'rigPairs': rigPairs, 'seeded': seeded},
+                    ('cameras',), lambda: presetAlign(MU.chunk, stages['align'], prefsFileName, refine, progressive, rigPairs, seeded))
     MU.doc.save()
+    checkpoints.run('correct', {}, ('transform',), MU.chunkCorrect)
+    checkpoints.run('region', {'scale': 1.1}, ('region',), lambda: MU.setRegion(1.1), restartsLater=False)
+    def filterAndOptimize():
+        MU.filterTiePoints()
+        optimizeAfterFilter(MU, prefsFileName, gradual)
+        updateCalibrationStore(MU, calibrations)
+    checkpoints.run('filter', {'gradual': gradual}, ('tiePoints',), filterAndOptimize)
+    MU.doc.save()
+    if len(checkpoints.skipped) == skipped:
+        recordStage('align', stages['align'], cameras, stageStart)
 
-    # Generate the dense cloud.
+    # Generate the dense cloud (if needed)
     if modelDepth or modelCloud:
-        genDenseCloud(MU.chunk, prefsFileName, refine, not modelCloud)
+        stageStart, skipped = time.perf_counter(), len(checkpoints.skipped)
+        presetDenseCloud(MU.chunk, stages['dense'], prefsFileName, refine, not modelCloud, checkpoints)
         MU.doc.save()
+        if len(checkpoints.skipped) == skipped:
+            recordStage('dense' if modelCloud else 'depth', stages['dense'], cameras, stageStart)
+
+    # Creates the models.
+    region = MODEL_PRESETS[stages['model']]['region']
+    checkpoints.run('model_region', {'scale': region}, ('region',), lambda: MU.setRegion(region), restartsLater=False)
+    for enabled, sourceData in ((modelTie, Metashape.TiePointsData), (modelDepth, Metashape.DepthMapsData), (modelCloud, Metashape.PointCloudData)):
+        if enabled:
+            stageStart, skipped = time.perf_counter(), len(checkpoints.skipped)
+            presetModel(MU.chunk, stages['model'], sourceData, prefsFileName, refine, checkpoints)
+            MU.doc.save()
+            if len(checkpoints.skipped) == skipped:
+                recordStage('model' + getSourceNames(sourceData)[1].lower(), stages['model'], cameras, stageStart)
 
-    # Creates a general model.
-    MU.setRegion(0.5)
-    if modelTie:
-        genModel(MU.chunk, Metashape.TiePointsData, prefsFileName, refine)
-        MU.doc.save()
+    if resume and prefsFileName is not None:
+        prefs = ProjectPrefs(prefsFileName)
+        prefs.setPref('RESUMED_STAGES', json.dumps(checkpoints.skipped))
+        prefs.saveConfig()
 
-    if modelDepth:
-        genModel(MU.chunk, Metashape.DepthMapsData, prefsFileName, refine)
-        MU.doc.save()
+    logger.info("Processing done: %s" % format_td(time.perf_counter() - startTime))
 
-    if modelCloud:
-        genModel(MU.chunk, Metashape.PointCloudData, prefsFileName, refine)
-        MU.doc.save()
+# Quick photogrammetry processing.
+def metaQuick(PATH_TO_IMAGES, PROJECT_NAME, PATH_TO_MASKS=None, prefsFileName=None, markerTolerance=50, refine=False, modelTie=True, modelDepth=False, modelCloud=False, gradual=None, sharpness=None, nativeMasks=False, progressive=None, rigPairs=None, priors=None, calibrations=None, markerSubset=None, timeBudget=None, resume=False):
+    metaWorkflow(PATH_TO_IMAGES, PROJECT_NAME, PATH_TO_MASKS, prefsFileName, markerTolerance, presetStages('quick'), refine, modelTie, modelDepth, modelCloud, gradual, sharpness, nativeMasks, progressive, rigPairs, priors, calibrations, markerSubset, timeBudget, resume)
 
-    logger.info("General quality processing done")
+# General photogrammetry processing.
+def metaGeneral(PATH_TO_IMAGES, PROJECT_NAME, PATH_TO_MASKS=None, prefsFileName=None, markerTolerance=50, refine=False, modelTie=False, modelDepth=True, modelCloud=False, gradual=None, sharpness=None, nativeMasks=False, progressive=None, rigPairs=None, priors=None, calibrations=None, markerSubset=None, timeBudget=None, resume=False):
+    metaWorkflow(PATH_TO_IMAGES, PROJECT_NAME, PATH_TO_MASKS, prefsFileName, markerTolerance, presetStages('general'), refine, modelTie, modelDepth, modelCloud, gradual, sharpness, nativeMasks, progressive, rigPairs, priors, calibrations, markerSubset, timeBudget, resume)
 
 # Archival photogrammetry processing.
-def metaArchival(PATH_TO_IMAGES, PROJECT_NAME, PATH_TO_MASKS=None, prefsFileName=None, markerTolerance=50, refine=False, modelTie=False, modelDepth=True, modelCloud=False):
+def metaArchival(PATH_TO_IMAGES, PROJECT_NAME, PATH_TO_MASKS=None, prefsFileName=None, markerTolerance=50, refine=False, modelTie=False, modelDepth=True, modelCloud=False, gradual=None, sharpness=None, nativeMasks=False, progressive=None, rigPairs=None, priors=None, calibrations=None, markerSubset=None, timeBudget=None, resume=False):
+    metaWorkflow(PATH_TO_IMAGES, PROJECT_NAME, PATH_TO_MASKS, prefsFileName, markerTolerance, presetStages('archival'), refine, modelTie, modelDepth, modelCloud, gradual, sharpness, nativeMasks, progressive, rigPairs, priors, calibrations, markerSubset, timeBudget, resume)
+
+
+def metaCustom(PATH_TO_IMAGES, PROJECT_NAME, PATH_TO_MASKS=None, prefsFileName=None, args={}, gradual=None, sharpness=None, nativeMasks=False, progressive=None, rigPairs=None, priors=None, calibrations=None, markerSubset=None):
     ensureLoggerReady()
-    logger.info("Starting archival quality processing")
+    logger.info("Starting custom workflow")
 
     # Initialize the MetaUtils object and project
-    MU = metaInit(PATH_TO_IMAGES, PROJECT_NAME, PATH_TO_MASKS, prefsFileName, markerTolerance)
+    MU = metaInit(PATH_TO_IMAGES, PROJECT_NAME, PATH_TO_MASKS, prefsFileName, (50 if args.tolerance is None else args.tolerance), sharpness, nativeMasks, priors, calibrations, markerSubset)
     MU.doc.save()
 
-    # Aligns photos and corrects the chunk.
-    arcAlign(MU.chunk, prefsFileName, refine)
-    MU.chunkCorrect()
-    MU.setRegion(1.1)
-    MU.filterTiePoints()
-    MU.optimizeCameras()
-    MU.doc.save()
+    # Keep the cameras seeded from pose priors instead of aligning from scratch
+    seeded = priors is not None and priors.get('seed', False)
 
-    # Creates a dense cloud for archival use.
-    if modelDepth or modelCloud:
-        arcDenseCloud(MU.chunk, prefsFileName, refine, not modelCloud)
-        MU.doc.save()
-
-    # Creates an archival quality model.
-    MU.setRegion(0.66)
-    if modelTie:
-        arcModel(MU.chunk, Metashape.TiePointsData, prefsFileName, refine)
-        MU.doc.save()
+    # Each stage runs at every level selected on the command line (lowest first)
+    for preset, selected in (('quick', args.quickAlign), ('general', args.genAlign), ('archival', args.arcAlign)):
+        if selected:
+            presetAlign(MU.chunk, preset, prefsFileName, progressive=progressive, rigPairs=rigPairs, seeded=seeded)
+            MU.doc.save()
+            MU.chunkCorrect()
+            MU.setRegion(1.1)
+            MU.filterTiePoints()
+            optimizeAfterFilter(MU, prefsFileName, gradual)
+            updateCalibrationStore(MU, calibrations)
+            MU.doc.save()
 
-    if modelDepth:
-        arcModel(MU.chunk, Metashape.DepthMapsData, prefsFileName, refine)
-        MU.doc.save()
+    for preset, selected in (('quick', args.quickDense), ('general', args.genDense), ('archival', args.arcDense)):
+        if selected:
+            presetDenseCloud(MU.chunk, preset, prefsFileName)
+            MU.doc.save()
 
-    if modelCloud:
-        arcModel(MU.chunk, Metashape.PointCloudData, prefsFileName, refine)
-        MU.doc.save()
+    for preset, selected in (('quick', args.quickMod), ('general', args.genMod), ('archival', args.arcMod)):
+        if selected:
+            MU.setRegion(MODEL_PRESETS[preset]['region'])
+            for enabled, sourceData in ((args.modelTie, Metashape.TiePointsData), (args.modelCloud, Metashape.PointCloudData), (args.modelDepth, Metashape.DepthMapsData)):
+                if enabled:
+                    presetModel(MU.chunk, preset, sourceData, prefsFileName)
+                    MU.doc.save()
 
-    logger.info("Archival processing done")
+    logger.info("Custom workflow done")
 
 
-def metaCustom(PATH_TO_IMAGES, PROJECT_NAME, PATH_TO_MASKS=None, prefsFileName=None, args={}):
+"""Partitioned Processing"""
+# Saves each part of the chunk's cameras as its own project ('./<PROJECT_NAME>_part<N>.psx')
+# copied from the chunk, so the parts keep its markers, masks and sensors. Returns the part names.
+def splitPartitions(MU, PROJECT_NAME, parts):
     ensureLoggerReady()
-    logger.info("Starting custom workflow")
 
-    # Initialize the MetaUtils object and project
-    MU = metaInit(PATH_TO_IMAGES, PROJECT_NAME, PATH_TO_MASKS, prefsFileName, (50 if args.tolerance is None else args.tolerance))
-    MU.doc.save()
+    mainPath = MU.doc.path
+    names = []
+    for index, labels in enumerate(parts):
+        name = '%s_part%d' % (PROJECT_NAME, index + 1)
+        keep = set(labels)
+        part = MU.chunk.copy(keypoints=False)
+        part.label = name
+        part.remove([camera for camera in part.cameras if camera.label not in keep])
+        MU.doc.save('./' + name + '.psx', chunks=[part])
+        MU.doc.remove([part])
+        names.append(name)
+        logger.info("Saved %s with %d cameras" % (name, len(keep)))
+
+    # Saving the parts moved the document, put it back
+    MU.doc.save(mainPath)
+    return names
+
+# Appends the processed part projects, aligns them on their markers and merges them into one
+# chunk that replaces the original. Cameras in the overlap of two parts are only kept once.
+def mergePartitions(MU, names):
+    ensureLoggerReady()
 
-    if args.quickAlign:
-        quickAlign(MU.chunk, prefsFileName)
-        MU.doc.save()
-        MU.chunkCorrect()
-        MU.setRegion(1.1)
-        MU.filterTiePoints()
-        MU.optimizeCameras()
-        MU.doc.save()
+    original = MU.chunk
+    for name in names:
+        MU.doc.append('./' + name + '.psx')
+    parts = MU.doc.chunks[-len(names):]
 
-    if args.genAlign:
-        genAlign(MU.chunk, prefsFileName)
-        MU.doc.save()
-        MU.chunkCorrect()
-        MU.setRegion(1.1)
-        MU.filterTiePoints()
-        MU.optimizeCameras()
-        MU.doc.save()
+    # From API "Align specified set of chunks."
+    # - Marker based (method 1) as every part sees the coded cage targets
+    elapsed1 = -1
+    with PBar("Aligning Parts") as pbar:
+        MU.doc.alignChunks(chunks=[part.key for part in parts], reference=parts[0].key, method=1,
+                           fit_scale=True, progress=(lambda x: pbar.update(x)))
+        pbar.finish()
+        elapsed1 = pbar.getTime()
 
-    if args.arcAlign:
-        arcAlign(MU.chunk, prefsFileName)
-        MU.doc.save()
-        MU.chunkCorrect()
-        MU.setRegion(1.1)
-        MU.filterTiePoints()
-        MU.optimizeCameras()
-        MU.doc.save()
+    # From API "Merge specified set of chunks."
+    elapsed2 = -1
+    with PBar("Merging Parts") as pbar:
+        MU.doc.mergeChunks(chunks=[part.key for part in parts], merge_markers=True, merge_tiepoints=True,
+                           merge_depth_maps=True, merge_point_clouds=True, progress=(lambda x: pbar.update(x)))
+        pbar.finish()
+        elapsed2 = pbar.getTime()
 
-    if args.quickDense:
-        genDenseCloud(MU.chunk, prefsFileName)
-        MU.doc.save()
+    merged = MU.doc.chunks[-1]
+    seen = set()
+    duplicates = []
+    for camera in merged.cameras:
+        if camera.label in seen:
+            duplicates.append(camera)
+        seen.add(camera.label)
+    if len(duplicates) > 0:
+        merged.remove(duplicates)
+
+    # The merged chunk replaces the original and the parts
+    merged.label = original.label
+    MU.doc.remove(parts + [original])
+    MU.doc.chunk = merged
+    MU.chunk = merged
+    MU.invalidateMarkerIndex()
+
+    logger.info("Merged %d parts into %d cameras (%d overlapping removed)" % (len(names), len(merged.cameras), len(duplicates)))
+    return elapsed1 + elapsed2
+
+# Partitioned photogrammetry processing: overlapping parts of the session (turntable sectors or
+# rings) are aligned and get their depth maps in parallel worker processes, each with its own
+# project, and are then merged back together on the coded markers.
+# - preset is 'quick', 'general' or 'archival'
+# - partition is a dict of Partition.partitionCameras() options plus the number of 'workers'
+#   processing parts at the same time (every part at once by default)
+def metaPartitioned(PATH_TO_IMAGES, PROJECT_NAME, PATH_TO_MASKS=None, prefsFileName=None, markerTolerance=50, preset='general', partition=None, modelTie=False, modelDepth=True, modelCloud=False, sharpness=None, nativeMasks=False, calibrations=None, markerSubset=None):
+    ensureLoggerReady()
+    logger.info("Starting partitioned %s processing" % preset)
 
-    if args.genDense:
-        genDenseCloud(MU.chunk, prefsFileName)
-        MU.doc.save()
+    partition = dict(partition or {})
+    workers = partition.pop('workers', None)
 
-    if args.arcDense:
-        arcDenseCloud(MU.chunk, prefsFileName)
-        MU.doc.save()
+    # Initialize the MetaUtils object and project
+    MU = metaInit(PATH_TO_IMAGES, PROJECT_NAME, PATH_TO_MASKS, prefsFileName, markerTolerance, sharpness, nativeMasks, None, calibrations, markerSubset)
+    MU.doc.save()
 
-    if args.quickMod:
-        MU.setRegion(0.33)
-        if args.modelTie:
-            quickModel(MU.chunk, Metashape.TiePointsData, prefsFileName)
-            MU.doc.save()
-        if args.modelCloud:
-            quickModel(MU.chunk, Metashape.PointCloudData, prefsFileName)
-            MU.doc.save()
-        if args.modelDepth:
-            quickModel(MU.chunk, Metashape.DepthMapsData, prefsFileName)
-            MU.doc.save()
+    # Splits the cameras into part projects
+    startTime = time.perf_counter()
+    cameras = {camera.photo.path: camera.label for camera in MU.chunk.cameras
+               if camera.enabled and camera.photo is not None}
+    parts = [[cameras[filename] for filename in group]
+             for group in Partition.partitionCameras(sorted(cameras), **partition)]
+    names = splitPartitions(MU, PROJECT_NAME, parts)
+    splitElapsed = time.perf_counter() - startTime
+
+    # Processes every part in its own worker process
+    logger.info("Processing %d parts with %s workers" % (len(names), workers or len(names)))
+    startTime = time.perf_counter()
+    results = Partition.runWorkers(names, preset, modelDepth, modelCloud, workers)
+    processElapsed = time.perf_counter() - startTime
+    failed = [name for name, code in results.items() if code != 0]
+    if len(failed) > 0:
+        raise Exception('Partition Error - processing failed for {} (see their logs)'.format(', '.join(failed)))
+    logger.info("Parts processed: %s" % format_td(processElapsed))
+
+    # Merges the parts and corrects the merged chunk
+    mergeElapsed = mergePartitions(MU, names)
+    MU.chunkCorrect()
+    MU.setRegion(1.1)
+    MU.doc.save()
 
-    if args.genMod:
-        MU.setRegion(0.5)
-        if args.modelTie:
-            genModel(MU.chunk, Metashape.TiePointsData, prefsFileName)
-            MU.doc.save()
-        if args.modelCloud:
-            genModel(MU.chunk, Metashape.PointCloudData, prefsFileName)
-            MU.doc.save()
-        if args.modelDepth:
-            genModel(MU.chunk, Metashape.DepthMapsData, prefsFileName)
-            MU.doc.save()
+    if prefsFileName is not None:
+        prefs = ProjectPrefs(prefsFileName)
+        prefs.setPref('PARTITION_COUNT', len(names))
+        prefs.setPref('PARTITION_CAMERAS', json.dumps([len(labels) for labels in parts]))
+        prefs.setPref('PARTITION_SPLIT', splitElapsed)
+        prefs.setPref('PARTITION_PROCESS', processElapsed)
+        prefs.setPref('PARTITION_MERGE', mergeElapsed)
+        prefs.saveConfig()
 
-    if args.arcMod:
-        MU.setRegion(0.66)
-        if args.modelTie:
-            arcModel(MU.chunk, Metashape.TiePointsData, prefsFileName)
-            MU.doc.save()
-        if args.modelCloud:
-            arcModel(MU.chunk, Metashape.PointCloudData, prefsFileName)
-            MU.doc.save()
-        if args.modelDepth:
-            arcModel(MU.chunk, Metashape.DepthMapsData, prefsFileName)
+    # Creates the models from the merged data
+    MU.setRegion(MODEL_PRESETS[preset]['region'])
+    for enabled, sourceData in ((modelTie, Metashape.TiePointsData), (modelDepth, Metashape.DepthMapsData), (modelCloud, Metashape.PointCloudData)):
+        if enabled:
+            presetModel(MU.chunk, preset, sourceData, prefsFileName)
             MU.doc.save()
 
-    logger.info("Custom workflow done")
+    logger.info("Partitioned processing done")
@@ -9,6 +9,7 @@ import MetaWork
 import Metashape
 import sys
 import argparse
+import CostModel
 
 from ProjectPrefs import ProjectPrefs
 
@@ -27,6 +28,7 @@ parser = argparse.ArgumentParser(
 # Options for the main program
 parser.add_argument('-i', '--images', action='store', help='Path to the folder containing subject images.')
 parser.add_argument('-m', '--masks', action='store', help='Path to the images for background subtraction with filename pattern.')
+parser.add_argument('-nm', '--nativeMasks', action='store_true', default=False, help='Generate background masks with NumPy (cached between runs) instead of Metashape.')
 parser.add_argument('-p', '--project', action='store', help='Project name applied as a prefix to log and MetaShape file names.')
 parser.add_argument('-l', '--load', action='store', help='Loads paths from the specified config file (previously created).', metavar="PROJECT")
 subparsers = parser.add_subparsers(title='Workflow', dest='workflow', description='Select a workflow to run.', metavar='WORKFLOW', required=True)
@@ -88,6 +90,65 @@ utility_group.add_argument('-fa', '--filterAggressive', action='store_true', hel
 utility_group.add_argument('-fn', '--filterNormal', action='store_true', help='Normally filter the sparse cloud/tie points.')
 utility_group.add_argument('-fl', '--filterLight', action='store_true', help='Lightly filter the sparse cloud/tie points.')
 utility_group.add_argument('-oc', '--optimizeCameras', action='store_true', help='Optimize the camera fitting (best used after -fa, -fn, or -fl).')
+utility_group.add_argument('-gs', '--gradualSelection', action='store_true', help='Filter tie points by gradual selection and optimize the cameras until the error converges.')
+utility_group.add_argument('-ec', '--exportCalibrations', action='store_true', help='Record the optimized camera calibrations in the calibration store (-cs).')
+utility_group.add_argument('-ep', '--exportPoses', action='store', default=None, metavar='FILE', help='Export the aligned camera poses as pose priors for later sessions (best used after -cc).')
+
+# Progressive alignment option (shared by every aligning workflow)
+for command in (quick_command, general_command, archival_command, custom_command):
+    command.add_argument('-pa', '--progressive', action='store', type=int, default=None, metavar='N', help='Align every Nth camera first and then add the rest to that alignment.')
+
+# Time budget option (shared by the fixed workflows)
+for command in (quick_command, general_command, archival_command):
+    command.add_argument('-tb', '--timeBudget', '--time-budget', dest='timeBudget', action='store', default=None, metavar='TIME', help='Pick the best quality of each stage predicted to finish within this time (e.g. 900, 45m, 1.5h).')
+
+# Resume option (shared by the fixed workflows)
+for command in (quick_command, general_command, archival_command):
+    command.add_argument('-re', '--resume', action='store_true', default=False, help='Skip the stages an earlier run of this project completed with the same settings.')
+
+# Partitioned processing options (shared by the fixed workflows)
+for command in (quick_command, general_command, archival_command):
+    command.add_argument('-np', '--partitions', action='store', type=int, default=None, metavar='N', help='Split the cameras into N overlapping parts processed in parallel and merged on the markers.')
+    command.add_argument('-nb', '--partitionBy', action='store', choices=('step', 'ring'), default='step', help='Split into turntable sectors (step) or groups of rings (ring).')
+    command.add_argument('-no', '--partitionOverlap', action='store', type=int, default=1, help='Steps or rings each part shares with its neighbours.')
+    command.add_argument('-nw', '--partitionWorkers', action='store', type=int, default=None, help='Number of parts processed at the same time (all by default).')
+
+# Rig topology pairs option (shared by every aligning workflow)
+for command in (quick_command, general_command, archival_command, custom_command):
+    command.add_argument('-rp', '--rigPairs', action='store_true', default=False, help='Only match image pairs that are neighbours in the rig layout.')
+    command.add_argument('-rx', '--rigPattern', action='store', default=None, help='Filename regex with ring, camera and step groups (EXIF serial and time otherwise).')
+    command.add_argument('-rk', '--rigNeighbours', action='store', type=int, default=None, help='Rig neighbours paired along each axis.')
+
+# Pose prior options (shared by every aligning workflow)
+for command in (quick_command, general_command, archival_command, custom_command):
+    command.add_argument('-pp', '--posePriors', action='store', default=None, metavar='FILE', help='Reference camera positions from a previous project (.psx) or exported pose prior file.')
+    command.add_argument('-pe', '--priorAccuracy', action='store', type=float, default=None, help='Accuracy of the pose prior positions (default %g).' % MetaUtils.POSE_PRIOR_ACCURACY)
+    command.add_argument('-ps', '--seedPoses', action='store_true', default=False, help='Start the alignment from the pose priors instead of from scratch.')
+
+# Calibration store options (shared by every workflow)
+for command in (quick_command, general_command, archival_command, custom_command, utility_command):
+    command.add_argument('-cs', '--calibrationStore', action='store', default=None, metavar='FILE', help='Seed each camera body from (and record its optimized calibration in) this calibration store.')
+    command.add_argument('-cf', '--fixCalibration', action='store_true', default=False, help='Keep the stored calibrations fixed instead of refining them.')
+
+# Subset marker detection options (shared by every workflow)
+for command in (quick_command, general_command, archival_command, custom_command, utility_command):
+    command.add_argument('-mp', '--markerPattern', action='store', default=None, help='Only detect markers on cameras whose label matches this regex.')
+    command.add_argument('-mr', '--markerRings', action='store', default=None, help='Only detect markers on cameras of these rings (e.g. 1,3).')
+    command.add_argument('-mn', '--markerEvery', action='store', type=int, default=None, metavar='N', help='Only detect markers on every Nth camera (per round with -ma).')
+    command.add_argument('-ma', '--markerAdaptive', action='store_true', default=False, help='Detect markers on more cameras until the cage targets are found.')
+
+# Sharpness screening options (shared by every workflow)
+for command in (quick_command, general_command, archival_command, custom_command, utility_command):
+    command.add_argument('-sh', '--sharpness', action='store_true', default=False, help='Disable blurred cameras (below 30%% of the median sharpness unless -st or -sp is given).')
+    command.add_argument('-st', '--sharpThreshold', action='store', type=float, default=None, help='Disable cameras with a sharpness score below this value.')
+    command.add_argument('-sp', '--sharpPercentile', action='store', type=float, default=None, help='Disable cameras with a sharpness score below this percentile.')
+
+# Gradual selection options (shared by every workflow)
+for command in (quick_command, general_command, archival_command, custom_command):
+    command.add_argument('-gs', '--gradualSelection', action='store_true', default=False, help='Filter tie points by gradual selection before optimizing cameras.')
+for command in (quick_command, general_command, archival_command, custom_command, utility_command):
+    command.add_argument('-gp', '--gradualPercentiles', action='store', default=None, help='Percentiles of tie points kept for reprojection error, reconstruction uncertainty and projection accuracy (e.g. 90,90,90).')
+    command.add_argument('-pb', '--pointBudget', action='store', type=int, default=None, help='Stop gradual selection once no more than this many tie points are left.')
 
 # Parse the command line arguments.
 args = parser.parse_args()
@@ -148,32 +209,102 @@ MODEL_DEPTH = (False if args.modelDepth is None else args.modelDepth)
 MODEL_DENSE = (False if args.modelCloud is None else args.modelCloud)
 args.tolerance = (50 if args.tolerance is None else int(args.tolerance))
 
+# Sharpness screening options (None when disabled)
+SHARPNESS = None
+if args.sharpness or args.sharpThreshold is not None or args.sharpPercentile is not None:
+    SHARPNESS = {'threshold': args.sharpThreshold, 'percentile': args.sharpPercentile}
+
+# Rig pair options (None when disabled)
+RIG_PAIRS = None
+if args.workflow != 'utility' and (args.rigPairs or args.rigPattern is not None or args.rigNeighbours is not None):
+    RIG_PAIRS = {'pattern': args.rigPattern}
+    if args.rigNeighbours is not None:
+        RIG_PAIRS['neighbours'] = args.rigNeighbours
+
+# Pose prior options (None when disabled)
+PRIORS = None
+if args.workflow != 'utility' and args.posePriors is not None:
+    PRIORS = {'source': args.posePriors, 'accuracy': args.priorAccuracy, 'seed': args.seedPoses}
+
+# Calibration store options (None when disabled)
+CALIBRATIONS = None
+if args.calibrationStore is not None:
+    CALIBRATIONS = {'store': args.calibrationStore, 'fixed': args.fixCalibration}
+
+# Subset marker detection options (None to detect on every camera)
+MARKER_SUBSET = None
+if args.markerPattern is not None or args.markerRings is not None or args.markerEvery is not None or args.markerAdaptive:
+    MARKER_SUBSET = {'pattern': args.markerPattern, 'every': args.markerEvery, 'adaptive': args.markerAdaptive}
+    if args.markerRings is not None:
+        MARKER_SUBSET['rings'] = [int(ring) for ring in args.markerRings.split(',')]
+
+# Partitioned processing options (None to process the chunk in one process)
+PARTITION = None
+if args.workflow in ('quick', 'general', 'archival') and args.partitions is not None:
+    PARTITION = {'by': args.partitionBy, 'parts': args.partitions, 'overlap': args.partitionOverlap,
+                 'pattern': args.rigPattern, 'workers': args.partitionWorkers}
+
+    # The part workers only align and build depth maps with the preset's settings
+    unsupported = [flag for flag, used in (
+        ('-r/--refine', args.refine), ('-pa/--progressive', args.progressive is not None),
+        ('-rp/--rigPairs', args.rigPairs), ('-rk/--rigNeighbours', args.rigNeighbours is not None),
+        ('-pp/--posePriors', args.posePriors is not None), ('-ps/--seedPoses', args.seedPoses),
+        ('-pe/--priorAccuracy', args.priorAccuracy is not None), ('-gs/--gradualSelection', args.gradualSelection),
+        ('-tb/--timeBudget', args.timeBudget is not None), ('-re/--resume', args.resume)) if used]
+    if len(unsupported) > 0:
+        parser.error('%s cannot be used with -np/--partitions' % ', '.join(unsupported))
+
+# Time budget in seconds (None to use the workflow's quality)
+TIME_BUDGET = None
+if args.workflow in ('quick', 'general', 'archival') and args.timeBudget is not None:
+    TIME_BUDGET = CostModel.parseDuration(args.timeBudget)
+
+# Gradual selection options (None when disabled)
+GRADUAL = None
+if args.gradualSelection:
+    GRADUAL = {'pointBudget': args.pointBudget}
+    if args.gradualPercentiles is not None:
+        percentiles = [float(value) for value in args.gradualPercentiles.split(',')]
+        if len(percentiles) != len(MetaUtils.GRADUAL_SELECTION_PERCENTILES):
+            print('Gradual selection needs %d percentiles' % len(MetaUtils.GRADUAL_SELECTION_PERCENTILES))
+            sys.exit(-1)
+        GRADUAL['percentiles'] = dict(zip(MetaUtils.GRADUAL_SELECTION_PERCENTILES, percentiles))
+
 # Runs metaQuick from MetaWork using the current project.ini info
 match args.workflow:
     # Standard Workflows
     case 'quick':
         if not MODEL_SPARSE and not MODEL_DEPTH and not MODEL_DENSE:
             MODEL_SPARSE = True
-        MetaWork.metaQuick(PATH_TO_IMAGES, PROJECT_NAME, PATH_TO_MASKS, PREFS_FILENAME, args.tolerance, REFINE_ONLY, MODEL_SPARSE, MODEL_DEPTH, MODEL_DENSE)
+        if PARTITION is not None:
+            MetaWork.metaPartitioned(PATH_TO_IMAGES, PROJECT_NAME, PATH_TO_MASKS, PREFS_FILENAME, args.tolerance, 'quick', PARTITION, MODEL_SPARSE, MODEL_DEPTH, MODEL_DENSE, SHARPNESS, args.nativeMasks, CALIBRATIONS, MARKER_SUBSET)
+        else:
+            MetaWork.metaQuick(PATH_TO_IMAGES, PROJECT_NAME, PATH_TO_MASKS, PREFS_FILENAME, args.tolerance, REFINE_ONLY, MODEL_SPARSE, MODEL_DEPTH, MODEL_DENSE, GRADUAL, SHARPNESS, args.nativeMasks, args.progressive, RIG_PAIRS, PRIORS, CALIBRATIONS, MARKER_SUBSET, TIME_BUDGET, args.resume)
     case 'general':
         if not MODEL_SPARSE and not MODEL_DEPTH and not MODEL_DENSE:
             MODEL_DEPTH = True
-        MetaWork.metaGeneral(PATH_TO_IMAGES, PROJECT_NAME, PATH_TO_MASKS, PREFS_FILENAME, args.tolerance, REFINE_ONLY, MODEL_SPARSE, MODEL_DEPTH, MODEL_DENSE)
+        if PARTITION is not None:
+            MetaWork.metaPartitioned(PATH_TO_IMAGES, PROJECT_NAME, PATH_TO_MASKS, PREFS_FILENAME, args.tolerance, 'general', PARTITION, MODEL_SPARSE, MODEL_DEPTH, MODEL_DENSE, SHARPNESS, args.nativeMasks, CALIBRATIONS, MARKER_SUBSET)
+        else:
+            MetaWork.metaGeneral(PATH_TO_IMAGES, PROJECT_NAME, PATH_TO_MASKS, PREFS_FILENAME, args.tolerance, REFINE_ONLY, MODEL_SPARSE, MODEL_DEPTH, MODEL_DENSE, GRADUAL, SHARPNESS, args.nativeMasks, args.progressive, RIG_PAIRS, PRIORS, CALIBRATIONS, MARKER_SUBSET, TIME_BUDGET, args.resume)
     case 'archival':
         if not MODEL_SPARSE and not MODEL_DEPTH and not MODEL_DENSE:
             MODEL_DEPTH = True
-        MetaWork.metaArchival(PATH_TO_IMAGES, PROJECT_NAME, PATH_TO_MASKS, PREFS_FILENAME, args.tolerance, REFINE_ONLY, MODEL_SPARSE, MODEL_DEPTH, MODEL_DENSE)
+        if PARTITION is not None:
+            MetaWork.metaPartitioned(PATH_TO_IMAGES, PROJECT_NAME, PATH_TO_MASKS, PREFS_FILENAME, args.tolerance, 'archival', PARTITION, MODEL_SPARSE, MODEL_DEPTH, MODEL_DENSE, SHARPNESS, args.nativeMasks, CALIBRATIONS, MARKER_SUBSET)
+        else:
+            MetaWork.metaArchival(PATH_TO_IMAGES, PROJECT_NAME, PATH_TO_MASKS, PREFS_FILENAME, args.tolerance, REFINE_ONLY, MODEL_SPARSE, MODEL_DEPTH, MODEL_DENSE, GRADUAL, SHARPNESS, args.nativeMasks, args.progressive, RIG_PAIRS, PRIORS, CALIBRATIONS, MARKER_SUBSET, TIME_BUDGET, args.resume)
 
     # Do a custom workflow
     case 'custom':
         if not MODEL_SPARSE and not MODEL_DEPTH and not MODEL_DENSE:
             MODEL_DEPTH = True
-        MetaWork.metaCustom(PATH_TO_IMAGES, PROJECT_NAME, PATH_TO_MASKS, PREFS_FILENAME, args)
+        MetaWork.metaCustom(PATH_TO_IMAGES, PROJECT_NAME, PATH_TO_MASKS, PREFS_FILENAME, args, GRADUAL, SHARPNESS, args.nativeMasks, args.progressive, RIG_PAIRS, PRIORS, CALIBRATIONS, MARKER_SUBSET)
 
     # Apply simple utility steps to existing project
     case 'utility':
         # Initialize the MetaUtils class
-        MU = MetaWork.metaInit(PATH_TO_IMAGES, PROJECT_NAME, PATH_TO_MASKS, PREFS_FILENAME, args.tolerance)
+        MU = MetaWork.metaInit(PATH_TO_IMAGES, PROJECT_NAME, PATH_TO_MASKS, PREFS_FILENAME, args.tolerance, SHARPNESS, args.nativeMasks, None, None, MARKER_SUBSET)
         MU.doc.save()
 
         # Apply any enabled utility steps
@@ -211,3 +342,16 @@ match args.workflow:
         if args.optimizeCameras:
             MU.optimizeCameraFitting()
             MU.doc.save()
+
+        if args.gradualSelection:
+            MetaWork.gradualFilter(MU, PREFS_FILENAME, GRADUAL)
+            MU.doc.save()
+
+        if args.exportCalibrations:
+            if CALIBRATIONS is None:
+                print('Exporting calibrations needs a calibration store (-cs)')
+                sys.exit(-1)
+            MU.exportCalibrations(CALIBRATIONS['store'])
+
+        if args.exportPoses is not None:
+            MU.exportPosePriors(args.exportPoses)
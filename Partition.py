@@ -0,0 +1,120 @@
+"""Partitioned processing: overlapping parts of a session aligned in parallel worker processes.
+
+The cameras are split along one axis of the rig grid (see RigPairs) into
+turntable sectors or groups of rings. Each part is saved as its own project
+and aligned (and its depth maps built) by a separate Metashape process, then
+the parts are merged back together on their shared coded markers (see
+MetaWork.metaPartitioned()). Run as a script this module is that worker.
+"""
+
+import os
+import sys
+import argparse
+import subprocess
+import concurrent.futures
+
+import RigPairs
+
+# Quality presets a part can be processed with
+PRESETS = ('quick', 'general', 'archival')
+
+# Defaults
+DEFAULT_AXIS = 'step'
+DEFAULT_PARTS = 4
+DEFAULT_OVERLAP = 1
+
+# Region around the cage the parts are limited to before building depth maps
+PART_REGION_SCALE = 1.1
+
+
+def partitionCameras(filenames, by=DEFAULT_AXIS, parts=DEFAULT_PARTS, overlap=DEFAULT_OVERLAP, pattern=None):
+    """ Split camera image filenames into parts along one rig axis ('step' gives turntable
+        sectors and 'ring' groups of rings). The rig positions come from the filename pattern
+        or the EXIF data (see RigPairs.placeImages()). Each part also takes 'overlap' positions
+        of its neighbours so adjacent parts share cameras (and see the same markers). Images
+        without a rig position go in every part. Returns a list of filename lists """
+    if by not in RigPairs.AXES:
+        raise Exception('Partition Error - cannot partition by "{}" (use one of {})'.format(by, ', '.join(RigPairs.AXES)))
+
+    axis = RigPairs.AXES.index(by)
+    topology = RigPairs.placeImages(filenames, pattern)
+    values = sorted(set(position[axis] for position in topology.values()))
+    if len(values) == 0:
+        raise Exception('Partition Error - no camera image has a rig position (from its filename or EXIF data)')
+
+    wrap = by in RigPairs.DEFAULT_WRAP_AXES
+    parts = max(1, min(parts, len(values)))
+    groups = []
+    for part in range(parts):
+        start, end = part * len(values) // parts, (part + 1) * len(values) // parts
+        indices = range(start - overlap, end + overlap)
+        if wrap:
+            selected = set(values[index % len(values)] for index in indices)
+        else:
+            selected = set(values[index] for index in indices if 0 <= index < len(values))
+        groups.append([filename for filename in filenames if filename not in topology or topology[filename][axis] in selected])
+
+    return groups
+
+
+def workerCommand(name, preset, depth=False, cloud=False):
+    """ Command line running this module as the worker for one part project """
+    command = [sys.executable, os.path.abspath(__file__), name, '--preset', preset]
+    if depth:
+        command.append('--depth')
+    if cloud:
+        command.append('--cloud')
+    return command
+
+
+def runWorkers(names, preset, depth=False, cloud=False, workers=None):
+    """ Process every part project in its own worker process, at most 'workers' at a time.
+        Returns {name: exit code} """
+    def run(name):
+        return subprocess.run(workerCommand(name, preset, depth, cloud)).returncode
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers or len(names)) as executor:
+        return dict(zip(names, executor.map(run, names)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='Partition.py',
+        description='Align (and build depth maps for) one part project of a partitioned session.'
+    )
+    parser.add_argument('project', help='Name of the part project (./<project>.psx).')
+    parser.add_argument('-q', '--preset', action='store', choices=PRESETS, default='general', help='Quality preset to process the part with.')
+    parser.add_argument('-d', '--depth', action='store_true', default=False, help='Build depth maps after aligning.')
+    parser.add_argument('-c', '--cloud', action='store_true', default=False, help='Build depth maps and a dense point cloud after aligning.')
+    args = parser.parse_args()
+
+    # Each worker logs to its own files
+    import Logger
+    Logger.init('./', args.project)
+    logger = Logger.getLogger()
+
+    import Metashape
+    import MetaWork
+    from MetaUtilsClass import MetaUtils
+    MetaUtils.CHECK_VER(Metashape.app.version)
+    MetaUtils.USE_GPU()
+
+    prefsFileName = args.project + '.ini'
+
+    MU = MetaUtils(None, '.', args.project)
+    MetaWork.presetAlign(MU.chunk, args.preset, prefsFileName)
+    MU.doc.save()
+
+    # Limit the part to the cage when it sees enough of the cage markers
+    try:
+        MU.chunkCorrect()
+        MU.setRegion(PART_REGION_SCALE)
+        MU.filterTiePoints()
+        MU.optimizeCameras()
+    except Exception as e:
+        logger.warning("Keeping the default region for %s: %s" % (args.project, e))
+    MU.doc.save()
+
+    if args.depth or args.cloud:
+        MetaWork.presetDenseCloud(MU.chunk, args.preset, prefsFileName, False, not args.cloud)
+        MU.doc.save()
@@ -12,14 +12,55 @@ class ProjectPrefs:
         'PROJECT_NAME': {'section': 'PROJECT'},
         'PATH_TO_MASKS': {'section': 'PATHS'},
 
+        'WHITE_BALANCE': {'section': 'DEVELOP'},
+        'WHITE_BALANCE_SOURCE': {'section': 'DEVELOP'},
+
+        'ALIGN_SUBSET_CAMERAS': {'section': 'ALIGNMENT'},
+        'ALIGN_REMAINING_PAIRS': {'section': 'ALIGNMENT'},
+        'ALIGN_ALIGNED_CAMERAS': {'section': 'ALIGNMENT'},
+        'POSE_PRIOR_SOURCE': {'section': 'ALIGNMENT'},
+        'POSE_PRIOR_CAMERAS': {'section': 'ALIGNMENT'},
+        'POSE_PRIOR_SEEDED': {'section': 'ALIGNMENT'},
+        'CALIBRATION_STORE': {'section': 'ALIGNMENT'},
+        'CALIBRATION_SEEDED': {'section': 'ALIGNMENT'},
+        'CALIBRATION_MISSING': {'section': 'ALIGNMENT'},
+        'PARTITION_COUNT': {'section': 'ALIGNMENT'},
+        'PARTITION_CAMERAS': {'section': 'ALIGNMENT'},
+
+        'TIME_BUDGET': {'section': 'BUDGET'},
+        'TIME_BUDGET_PREDICTED': {'section': 'BUDGET'},
+        'TIME_BUDGET_STAGES': {'section': 'BUDGET'},
+
+        'RESUMED_STAGES': {'section': 'RESUME'},
+
+        'TIE_POINT_COUNT': {'section': 'TIE_POINTS'},
+        'TIE_POINT_FILTER_PASSES': {'section': 'TIE_POINTS'},
+
+        'SHARPNESS_SCORES': {'section': 'QUALITY'},
+        'SHARPNESS_CUTOFF': {'section': 'QUALITY'},
+        'SHARPNESS_DISABLED': {'section': 'QUALITY'},
+
         'INIT': {'section': 'TIMING'},
         'INIT_IMAGE_LOAD': {'section': 'TIMING'},
+        'INIT_SHARPNESS': {'section': 'TIMING'},
+        'INIT_POSE_PRIORS': {'section': 'TIMING'},
+        'INIT_CALIBRATION': {'section': 'TIMING'},
         'INIT_DETECT_MARKERS': {'section': 'TIMING'},
         'INIT_APPLY_MASKS': {'section': 'TIMING'},
 
         'IMAGE_ALIGN': {'section': 'TIMING'},
         'IMAGE_ALIGN_MATCHING': {'section': 'TIMING'},
         'IMAGE_ALIGN_BUNDLE_ADJUST': {'section': 'TIMING'},
+        'IMAGE_ALIGN_SUBSET_MATCHING': {'section': 'TIMING'},
+        'IMAGE_ALIGN_SUBSET_BUNDLE_ADJUST': {'section': 'TIMING'},
+        'IMAGE_ALIGN_REMAINING_MATCHING': {'section': 'TIMING'},
+        'IMAGE_ALIGN_REMAINING_BUNDLE_ADJUST': {'section': 'TIMING'},
+
+        'TIE_POINT_FILTER': {'section': 'TIMING'},
+
+        'PARTITION_SPLIT': {'section': 'TIMING'},
+        'PARTITION_PROCESS': {'section': 'TIMING'},
+        'PARTITION_MERGE': {'section': 'TIMING'},
 
         'DENSE_CLOUD': {'section': 'TIMING'},
         'DENSE_CLOUD_DEPTH_MAPS': {'section': 'TIMING'},
@@ -0,0 +1,262 @@
+"""Micro-benchmarks for the RawUtils hot paths on synthetic images."""
+
+# Concurrency methods (each case runs in its own process to measure its peak memory)
+import concurrent.futures
+import multiprocessing
+
+# For working with files and directories
+import os
+from os import path
+
+# For command line parsing, timing and results
+import sys
+import json
+import time
+import argparse
+import platform
+import resource
+import subprocess
+import tempfile
+
+import numpy
+import tifffile
+
+# Utility objects and functions for Raw processing
+import RawUtils
+
+# Benchmark resolutions (megapixels -> width, height)
+RESOLUTION_LIST = {
+  12: (4000, 3000),
+  24: (6000, 4000),
+  45: (8192, 5464),
+  100: (11648, 8736)
+}
+
+# Every benchmark case (name -> description)
+CASE_LIST = {
+  'simulate_bayer': 'RawUtils.simulate_bayer_filter on a 16 bit RGB TIFF',
+  'develop_half': 'RawUtils.develop_raw at half size on a synthetic DNG',
+  'develop_full': 'RawUtils.develop_raw at full size on a synthetic DNG',
+  'write_tiff': 'RawUtils.write_tiff of an 8 bit RGB image (deflate level 1)'
+}
+
+''' Make a smooth test pattern with some noise so compression behaves realistically '''
+def synthetic_image(width, height, channels, maxValue, seed=0):
+  generator = numpy.random.default_rng(seed)
+  rows = numpy.linspace(0.1, 0.9, height, dtype='float32')[:, numpy.newaxis]
+  cols = numpy.linspace(0.2, 0.8, width, dtype='float32')[numpy.newaxis, :]
+  image = numpy.empty((height, width, channels), dtype='uint16' if maxValue > 255 else 'uint8')
+  for channel in range(channels):
+    plane = (rows * (channel + 1) + cols) % 1.0
+    plane += generator.normal(0, 0.01, size=(height, width)).astype('float32')
+    image[:, :, channel] = numpy.clip(plane, 0, 1) * maxValue
+  return image[:, :, 0] if channels == 1 else image
+
+''' Write a minimal 12 bit RGGB DNG that LibRaw can develop '''
+def write_synthetic_dng(filename, width, height):
+  extraTags = [
+    (33421, 'H', 2, (2, 2)),                    # CFARepeatPatternDim
+    (33422, 'B', 4, (0, 1, 1, 2)),              # CFAPattern (RGGB)
+    (50706, 'B', 4, (1, 4, 0, 0)),              # DNGVersion
+    (50708, 's', 0, 'PARSEC Synthetic'),        # UniqueCameraModel
+    (50717, 'H', 1, 4095),                      # WhiteLevel
+    (50721, '2i', 9, (1, 1, 0, 1, 0, 1,         # ColorMatrix1 (identity)
+                      0, 1, 1, 1, 0, 1,
+                      0, 1, 0, 1, 1, 1)),
+    (50728, '2I', 3, (1, 2, 1, 1, 1, 2)),       # AsShotNeutral
+    (50778, 'H', 1, 21)                         # CalibrationIlluminant1 (D65)
+  ]
+  tifffile.imwrite(filename, synthetic_image(width, height, 1, 4095), photometric=32803,
+                   extratags=extraTags)
+
+''' Create the input file a case needs at the given resolution '''
+def make_input(case, megapixels, workDirectory):
+  width, height = RESOLUTION_LIST[megapixels]
+  if case == 'simulate_bayer':
+    filename = path.join(workDirectory, 'rgb_%d.tif' %(megapixels))
+    if not path.exists(filename):
+      tifffile.imwrite(filename, synthetic_image(width, height, 3, 65535))
+  elif case.startswith('develop'):
+    filename = path.join(workDirectory, 'raw_%d.dng' %(megapixels))
+    if not path.exists(filename):
+      write_synthetic_dng(filename, width, height)
+  else:
+    filename = None
+  return filename
+
+# Develop settings the linear cache must reproduce exactly (halfSize, bitDepth, other options)
+PARITY_SETTING_LIST = (
+  (True, 8, {}),
+  (False, 8, {}),
+  (False, 16, {}),
+  (False, 8, { 'brightnessScale': 1.7 }),
+  (False, 16, { 'brightnessScale': 0.6 }),
+  (False, 8, { 'autoWhiteBalance': True }),
+  (False, 8, { 'customWhiteBalance': (2.0, 1.0, 1.5, 1.0) })
+)
+
+''' Compare cached develops against RawUtils.develop_raw for every parity setting,
+    returning the largest absolute difference in output values of each '''
+def check_cache_parity(inputFile, workDirectory):
+  cacheDirectory = path.join(workDirectory, 'parity_cache')
+  directFile = path.join(workDirectory, 'parity_direct.tif')
+  cachedFile = path.join(workDirectory, 'parity_cached.tif')
+
+  differences = []
+  for halfSize, bitDepth, options in PARITY_SETTING_LIST:
+    RawUtils.develop_raw(inputFile, directFile, True, halfSize=halfSize, bitDepth=bitDepth, **options)
+    RawUtils.cached_develop_raw(inputFile, cachedFile, True, halfSize=halfSize, bitDepth=bitDepth,
+                                cacheDirectory=cacheDirectory, **options)
+    direct = tifffile.imread(directFile).astype('int32')
+    cached = tifffile.imread(cachedFile).astype('int32')
+    differences.append(int(numpy.abs(direct - cached).max()))
+
+  for filename in [directFile, cachedFile] + [path.join(cacheDirectory, name) for name in os.listdir(cacheDirectory)]:
+    os.remove(filename)
+  os.rmdir(cacheDirectory)
+  return differences
+
+''' Peak resident memory of this process in bytes
+    (VmHWM is reset by exec, unlike ru_maxrss which a spawned child inherits from its parent) '''
+def peak_rss():
+  try:
+    with open('/proc/self/status', 'r') as status:
+      for line in status:
+        if line.startswith('VmHWM:'):
+          return int(line.split()[1]) * 1024
+  except OSError:
+    pass
+
+  # ru_maxrss is in kilobytes on Linux (bytes on macOS)
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if platform.system() == 'Darwin' else 1024)
+
+''' Run one case in this (fresh) process and return its timings and peak RSS '''
+def run_case(case, megapixels, inputFile, workDirectory, repeat):
+  width, height = RESOLUTION_LIST[megapixels]
+  outputFile = path.join(workDirectory, 'out_%s_%d.tif' %(case, megapixels))
+  imageData = synthetic_image(width, height, 3, 255) if case == 'write_tiff' else None
+  baselineRss = peak_rss()
+
+  timings = []
+  for _ in range(repeat):
+    startTime = time.perf_counter()
+    if case == 'simulate_bayer':
+      RawUtils.simulate_bayer_filter(inputFile, outputFile, True)
+    elif case == 'develop_half':
+      RawUtils.develop_raw(inputFile, outputFile, True, halfSize=True)
+    elif case == 'develop_full':
+      RawUtils.develop_raw(inputFile, outputFile, True, halfSize=False)
+    elif case == 'write_tiff':
+      RawUtils.write_tiff(outputFile, imageData, 'deflate', 1)
+    timings.append(time.perf_counter() - startTime)
+
+  outputBytes = path.getsize(outputFile)
+  os.remove(outputFile)
+
+  peakRss = peak_rss()
+  return {
+    'case': case,
+    'megapixels': megapixels,
+    'seconds': timings,
+    'best': min(timings),
+    'megapixelsPerSecond': width * height / 1e6 / min(timings),
+    'outputBytes': outputBytes,
+    'peakRssMB': peakRss / 2**20,
+    'peakRssAboveInputMB': (peakRss - baselineRss) / 2**20
+  }
+
+''' Run a function in a freshly spawned process so its memory use is its own '''
+def run_isolated(function, *args):
+  with concurrent.futures.ProcessPoolExecutor(max_workers=1,
+                                              mp_context=multiprocessing.get_context('spawn')) as executor:
+    return executor.submit(function, *args).result()
+
+''' Identify the code being measured '''
+def git_commit():
+  try:
+    return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                          cwd=path.dirname(path.abspath(__file__))).stdout.strip() or None
+  except OSError:
+    return None
+
+''' Print how each case compares to a previous results file '''
+def print_comparison(results, previousFile):
+  with open(previousFile, 'r') as previous:
+    baseline = { (result['case'], result['megapixels']): result for result in json.load(previous)['results'] }
+
+  print('\nCompared to %s:' %(previousFile))
+  for result in results:
+    before = baseline.get((result['case'], result['megapixels']))
+    if before is not None:
+      print('  %-15s %4d MP  %6.2fx speed  %+8.1f MB peak RSS' %(
+        result['case'], result['megapixels'], before['best'] / result['best'],
+        result['peakRssMB'] - before['peakRssMB']))
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(
+    prog='RawBenchmark.py',
+    description='Time the RawUtils hot paths on synthetic images and store the results as JSON.'
+  )
+  parser.add_argument('-s', '--sizes', action='store', default='12,24,45,100', help='Comma separated megapixel sizes (%s).' %(', '.join(str(size) for size in RESOLUTION_LIST)))
+  parser.add_argument('-c', '--cases', action='store', default=','.join(CASE_LIST), help='Comma separated cases (%s).' %(', '.join(CASE_LIST)))
+  parser.add_argument('-r', '--repeat', action='store', type=int, default=3, help='Runs of each case (the best is reported).')
+  parser.add_argument('-o', '--output', action='store', default='bench_results.json', help='JSON file to store the results in.')
+  parser.add_argument('--compare', action='store', default=None, help='Previous results JSON file to compare against.')
+  parser.add_argument('--parity', action='store_true', default=False, help='Only check that cached develops match RawUtils.develop_raw (on the smallest size).')
+  parser.add_argument('--workDir', action='store', default=None, help='Folder for the synthetic inputs (kept between runs when given).')
+  args = parser.parse_args()
+
+  sizes = [int(size) for size in args.sizes.split(',')]
+  cases = args.cases.split(',')
+  for case in cases:
+    if case not in CASE_LIST:
+      print('Unknown case "%s"' %(case))
+      sys.exit(-1)
+
+  workDirectory = args.workDir or tempfile.mkdtemp(prefix='rawbench_')
+  os.makedirs(workDirectory, exist_ok=True)
+
+  # Check the linear cache reproduces a direct develop instead of timing anything
+  if args.parity:
+    inputFile = make_input('develop_full', min(sizes), workDirectory)
+    differences = check_cache_parity(inputFile, workDirectory)
+    for (halfSize, bitDepth, options), difference in zip(PARITY_SETTING_LIST, differences):
+      print('%-5s %2d bit %-45s max difference %d' %('half' if halfSize else 'full', bitDepth,
+                                                      options or 'defaults', difference))
+    if args.workDir is None:
+      os.remove(inputFile)
+      os.rmdir(workDirectory)
+    sys.exit(-1 if max(differences) > 0 else 0)
+
+  results = []
+  print('%-15s %6s %9s %9s %10s' %('case', 'MP', 'best s', 'MP/s', 'peak MB'))
+  for megapixels in sizes:
+    for case in cases:
+      inputFile = run_isolated(make_input, case, megapixels, workDirectory)
+      result = run_isolated(run_case, case, megapixels, inputFile, workDirectory, args.repeat)
+      results.append(result)
+      print('%-15s %6d %9.3f %9.1f %10.1f' %(case, megapixels, result['best'],
+                                              result['megapixelsPerSecond'], result['peakRssMB']))
+      sys.stdout.flush()
+
+  # Clean up generated inputs unless the work folder was requested
+  if args.workDir is None:
+    for filename in os.listdir(workDirectory):
+      os.remove(path.join(workDirectory, filename))
+    os.rmdir(workDirectory)
+
+  with open(args.output, 'w') as outputFile:
+    json.dump({
+      'commit': git_commit(),
+      'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+      'platform': platform.platform(),
+      'python': platform.python_version(),
+      'cpus': os.cpu_count(),
+      'versions': { 'numpy': numpy.__version__, 'tifffile': tifffile.__version__,
+                    'rawpy': RawUtils.rawpy.__version__ },
+      'results': results
+    }, outputFile, indent=1)
+  print('Results saved to %s' %(args.output))
+
+  if args.compare is not None:
+    print_comparison(results, args.compare)
@@ -1,37 +1,303 @@
+"""A command line tool to batch develop a folder of RAW images to TIFF."""
+
 # Concurrency methods
 import concurrent.futures
+import multiprocessing
 
 # For working with files and directories
 import os
 from os import path
 
+# For command line parsing, timing and file digests
+import sys
+import time
+import argparse
+import hashlib
+
 # Utility objects and functions for Raw processing
 import RawUtils
+from RawManifest import RawManifest
+from ProjectPrefs import ProjectPrefs
+from SessionIndex import SessionIndex
+import RawPipeline
+
+# Session white balance cache written beside the output directory (as
+# '<output>.session_prefs.ini', like the develop manifest) when no project
+# preferences file is given
+SESSION_PREFS_SUFFIX = '.session_prefs.ini'
+
+''' Develop a list of raw files in a worker process and report on each one (along
+    with the state of its source for the manifest, hashed when hashSources is set) '''
+def process_raw_files(fileInfoList, developOptions, hashSources=False):
+  # Previews come from the embedded thumbnail when possible
+  options = dict(developOptions)
+  if options.pop('preview', False):
+    developFunction = RawUtils.preview_develop_raw
+  elif options.get('cacheDirectory') is not None:
+    developFunction = RawUtils.cached_develop_raw
+  else:
+    developFunction = RawUtils.develop_raw
+
+  results = []
+  for fileInfo in fileInfoList:
+    startTime = time.perf_counter()
+    source = None
+    try:
+      stat = os.stat(fileInfo['inFile'])
+      sourceHash = RawManifest.hashFile(fileInfo['inFile']) if hashSources else None
+      developFunction(fileInfo['inFile'], fileInfo['outFile'], True, **options)
+      source = RawManifest.sourceState(stat, sourceHash)
+      error = None
+    except Exception as e:
+      error = '%s: %s' %(type(e).__name__, e)
+
+    results.append({ 'inFile': fileInfo['inFile'], 'outFile': fileInfo['outFile'],
+                     'bytes': fileInfo['bytes'], 'error': error, 'source': source,
+                     'elapsed': time.perf_counter() - startTime })
+
+  return results
+
+''' Build list of all raw files in a directory along with their output filenames '''
+def find_raw_files(inDirectory, outDirectory, extension='.tif'):
+  rawFiles = []
+  with os.scandir(inDirectory) as entries:
+    for entry in entries:
+      # Determine if this is a raw file (ends with a recognized extension)
+      if entry.is_file() and entry.name.lower().endswith(RawUtils.RAW_FILE_EXTENSION_LIST):
+        # Construct the full filename for the output file
+        outputFile = path.splitext(path.join(outDirectory, entry.name))[0] + extension
+        rawFiles.append({ 'inFile': entry.path, 'outFile': outputFile,
+                          'bytes': entry.stat().st_size })
+
+  rawFiles.sort(key=lambda fileInfo: fileInfo['inFile'])
+  return rawFiles
+
+''' Print the outcome of each developed file as it completes '''
+def report_results(results, summary, developOptions, manifest=None):
+  for result in results:
+    if result['error'] is None:
+      summary['succeeded'] += 1
+      summary['bytes'] += result['bytes']
+      if manifest is not None:
+        manifest.recordDevelop(result, developOptions)
+      print('[ OK ] %s (%.2fs)' %(path.basename(result['inFile']), result['elapsed']))
+    else:
+      summary['failed'].append(result['inFile'])
+      print('[FAIL] %s - %s' %(path.basename(result['inFile']), result['error']))
+  sys.stdout.flush()
+
+''' Develop all raw files in a process pool with bounded in-flight work '''
+def develop_batch(rawFiles, developOptions, processes=None, chunksize=1, maxInFlight=None,
+                  manifest=None):
+  # Group files into chunks (one task per chunk) and limit how many chunks are queued
+  chunks = [rawFiles[i:i + chunksize] for i in range(0, len(rawFiles), chunksize)]
+  processes = processes or os.cpu_count() or 1
+  maxInFlight = maxInFlight or 2 * processes
+
+  summary = { 'succeeded': 0, 'failed': [], 'bytes': 0 }
+  startTime = time.perf_counter()
+  try:
+    develop_chunks(chunks, developOptions, processes, maxInFlight, summary, manifest)
+  finally:
+    # Keep the record of whatever was developed even if the batch is interrupted
+    if manifest is not None:
+      manifest.saveManifest()
+
+  summary['elapsed'] = time.perf_counter() - startTime
+  return summary
+
+''' Submit chunks of files to a process pool and report results as they complete '''
+def develop_chunks(chunks, developOptions, processes, maxInFlight, summary, manifest):
+  hashSources = manifest is not None and manifest.useHash
+
+  # NOTE: rawpy (LibRaw with OpenMP) can deadlock in forked workers so always spawn
+  with concurrent.futures.ProcessPoolExecutor(max_workers=processes,
+                                              mp_context=multiprocessing.get_context('spawn')) as executor:
+    pending = {}
+    nextChunk = 0
+    while nextChunk < len(chunks) or pending:
+      # Top up the queue of submitted work
+      while nextChunk < len(chunks) and len(pending) < maxInFlight:
+        future = executor.submit(process_raw_files, chunks[nextChunk], developOptions, hashSources)
+        pending[future] = chunks[nextChunk]
+        nextChunk += 1
+
+      # Collect whatever has finished (worker crashes fail every file in the chunk)
+      done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+      for future in done:
+        chunk = pending.pop(future)
+        try:
+          results = future.result()
+        except Exception as e:
+          results = [{ 'inFile': fileInfo['inFile'], 'outFile': fileInfo['outFile'],
+                       'bytes': fileInfo['bytes'], 'elapsed': 0,
+                       'error': 'worker failed - %s: %s' %(type(e).__name__, e) }
+                     for fileInfo in chunk]
+        report_results(results, summary, developOptions, manifest)
+
+''' Develop all raw files through the overlapped read/decode/write pipeline '''
+def develop_pipelined(rawFiles, developOptions, readers=2, processes=None, writers=2,
+                      queueDepth=None, manifest=None):
+  summary = { 'succeeded': 0, 'failed': [], 'bytes': 0 }
+  try:
+    report = RawPipeline.develop_pipeline(
+      rawFiles, developOptions, lambda results: report_results(results, summary, developOptions, manifest),
+      readers, processes, writers, queueDepth, manifest is not None and manifest.useHash)
+  finally:
+    # Keep the record of whatever was developed even if the batch is interrupted
+    if manifest is not None:
+      manifest.saveManifest()
+
+  RawPipeline.print_pipeline_report(report)
+  summary['elapsed'] = report['elapsed']
+  return summary
+
+''' Digest of the path, size and modification time of each file '''
+def files_digest(filenames):
+  hasher = hashlib.sha1()
+  for filename in filenames:
+    try:
+      stat = os.stat(filename)
+      state = '%d %d' %(stat.st_size, stat.st_mtime_ns)
+    except OSError:
+      state = 'missing'
+    hasher.update(('%s %s\n' %(path.abspath(filename), state)).encode('utf-8'))
+  return hasher.hexdigest()
+
+''' Solve one white balance for the whole session, reusing the value cached in
+    the project preferences (or the session's own file beside the output
+    directory) when it was solved the same way '''
+def session_white_balance(rawFiles, outDirectory, prefsFileName=None, grayCard=None,
+                          grayCardRegion=None, sampleCount=16, resolve=False):
+  # Identify the exact frames the solve reads so a different camera, time range or
+  # retake solves again instead of reusing another session's white balance
+  if grayCard is not None:
+    source = 'gray card %s %s %s' %(path.abspath(grayCard), grayCardRegion, files_digest([grayCard]))
+  else:
+    samples = RawUtils.sample_frames([fileInfo['inFile'] for fileInfo in rawFiles], sampleCount)
+    source = 'sample of %d frames %s' %(len(samples), files_digest(samples))
+
+  # Check for a cached solve
+  if prefsFileName is None:
+    prefsFileName = path.normpath(outDirectory) + SESSION_PREFS_SUFFIX
+  prefs = ProjectPrefs(prefsFileName)
+  if not resolve:
+    cached = prefs.getPref('WHITE_BALANCE')
+    if cached and prefs.getPref('WHITE_BALANCE_SOURCE') == source:
+      print('Using cached session white balance %s' %(cached))
+      return tuple(float(value) for value in cached.split(','))
+
+  startTime = time.perf_counter()
+  whiteBalance = RawUtils.estimate_white_balance(
+    [fileInfo['inFile'] for fileInfo in rawFiles], grayCard, grayCardRegion, sampleCount)
+  print('Solved session white balance %s from %s in %.2fs' %(
+    ', '.join('%.4f' %(value) for value in whiteBalance), source, time.perf_counter() - startTime))
+
+  # Failing to cache the solve only costs solving it again next time
+  prefs.setPref('WHITE_BALANCE', ','.join(repr(value) for value in whiteBalance))
+  prefs.setPref('WHITE_BALANCE_SOURCE', source)
+  try:
+    prefs.saveConfig()
+  except OSError as e:
+    print('Could not cache the session white balance in %s - %s' %(prefsFileName, e))
+
+  return whiteBalance
+
+''' Print the final throughput of a batch '''
+def print_summary(summary):
+  elapsed = max(summary['elapsed'], 1e-9)
+  print('\nDeveloped %d file(s), %d failed in %.2fs (%.2f files/s, %.2f MB/s)' %(
+    summary['succeeded'], len(summary['failed']), summary['elapsed'],
+    summary['succeeded'] / elapsed, summary['bytes'] / (1024 * 1024) / elapsed))
+  for filename in summary['failed']:
+    print('  failed: %s' %(filename))
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(
+    prog='RawExpose.py',
+    description='Batch develop a folder of RAW images to TIFF files.'
+  )
+  parser.add_argument('-i', '--input', action='store', required=True, help='Folder containing the RAW images.')
+  parser.add_argument('-o', '--output', action='store', required=True, help='Folder to write developed TIFF images to.')
+  parser.add_argument('-j', '--processes', action='store', type=int, default=None, help='Number of worker processes (default: one per CPU).')
+  parser.add_argument('-c', '--chunksize', action='store', type=int, default=1, help='Number of files sent to a worker per task.')
+  parser.add_argument('-q', '--maxInFlight', action='store', type=int, default=None, help='Maximum number of tasks queued at once (default: twice the process count).')
+  parser.add_argument('-p', '--preview', action='store_true', default=False, help='Write JPEG previews from the embedded thumbnails (half size develop when missing).')
+  parser.add_argument('-s', '--minimumSize', action='store', type=int, default=0, help='Smallest usable thumbnail (longest edge in pixels) for previews.')
+  parser.add_argument('-f', '--fullSize', action='store_true', default=False, help='Develop at full resolution instead of half size.')
+  parser.add_argument('-b', '--brightness', action='store', type=float, default=1.0, help='Brightness scale applied while developing.')
+  parser.add_argument('-a', '--autoWB', action='store_true', default=False, help='Use automatic instead of camera white balance.')
+  parser.add_argument('-C', '--camera', action='store', default=None, help='Only develop frames from this camera serial number or model (uses the session index).')
+  parser.add_argument('--after', action='store', default=None, help='Only develop frames captured at or after this time (YYYY-MM-DD HH:MM:SS).')
+  parser.add_argument('--before', action='store', default=None, help='Only develop frames captured at or before this time (YYYY-MM-DD HH:MM:SS).')
+  parser.add_argument('-S', '--sessionWB', action='store_true', default=False, help='Solve one white balance for the whole session and use it for every file.')
+  parser.add_argument('-g', '--grayCard', action='store', default=None, help='RAW frame of a gray card to solve the session white balance from.')
+  parser.add_argument('-G', '--grayCardRegion', action='store', default=None, help='Gray card area as left,top,width,height fractions of the frame.')
+  parser.add_argument('-n', '--wbSamples', action='store', type=int, default=16, help='Frames sampled for the session white balance without a gray card.')
+  parser.add_argument('-r', '--resolveWB', action='store_true', default=False, help='Solve the session white balance again even if one is cached.')
+  parser.add_argument('--prefs', action='store', default=None, help='Project preferences file used to cache the session white balance (default: <output>%s beside the output folder).' %(SESSION_PREFS_SUFFIX))
+  parser.add_argument('-z', '--compression', action='store', default='deflate', choices=list(RawUtils.TIFF_COMPRESSION_LIST), help='Compression of the output TIFF files.')
+  parser.add_argument('-l', '--level', action='store', type=int, default=1, help='Compression level (deflate and zstd only).')
+  parser.add_argument('-d', '--bitDepth', action='store', type=int, default=8, choices=[8, 16], help='Bits per channel of the output TIFF files.')
+  parser.add_argument('-P', '--pipeline', action='store_true', default=False, help='Overlap reading, demosaicing and writing in separate stages.')
+  parser.add_argument('-R', '--readers', action='store', type=int, default=2, help='Number of prefetch threads in pipeline mode.')
+  parser.add_argument('-W', '--writers', action='store', type=int, default=2, help='Number of writer threads in pipeline mode.')
+  parser.add_argument('-k', '--cache', action='store', default=None, help='Folder of memory-mapped linear decodes; re-renders with a new brightness or bit depth skip the RAW decode (a new white balance decodes again).')
+  parser.add_argument('-F', '--force', action='store_true', default=False, help='Redevelop every file, ignoring the develop manifest.')
+  parser.add_argument('-H', '--hash', action='store_true', default=False, help='Also record and compare a content hash of each source file.')
+  args = parser.parse_args()
+  if args.pipeline and (args.readers <= 0 or args.writers <= 0):
+    parser.error('--readers and --writers must be at least 1')
+
+  # Ensure output directory exists
+  os.makedirs(args.output, exist_ok=True)
+
+  rawFiles = find_raw_files(args.input, args.output, '.jpg' if args.preview else '.tif')
+
+  # Narrow down the frames using the session index
+  if args.camera is not None or args.after is not None or args.before is not None:
+    with SessionIndex(args.input) as index:
+      index.update()
+      selected = set(index.queryPaths(args.camera, args.after, args.before))
+    rawFiles = [fileInfo for fileInfo in rawFiles if fileInfo['inFile'] in selected]
+
+  # A session white balance replaces camera/auto white balance for every file
+  customWhiteBalance = None
+  if args.sessionWB or args.grayCard is not None:
+    grayCardRegion = None
+    if args.grayCardRegion is not None:
+      grayCardRegion = tuple(float(value) for value in args.grayCardRegion.split(','))
+    customWhiteBalance = session_white_balance(rawFiles, args.output, args.prefs, args.grayCard,
+                                               grayCardRegion, args.wbSamples, args.resolveWB)
+
+  developOptions = {
+    'preview': args.preview,
+    'halfSize': not args.fullSize,
+    'brightnessScale': args.brightness,
+    'autoWhiteBalance': args.autoWB,
+    'customWhiteBalance': customWhiteBalance,
+    'compression': args.compression,
+    'compressionLevel': args.level,
+    'bitDepth': args.bitDepth
+  }
+  if args.preview:
+    developOptions['minimumSize'] = args.minimumSize
+  elif args.cache is not None:
+    developOptions['cacheDirectory'] = args.cache
+
+  # Only develop files whose source or develop parameters changed since the last run
+  manifest = RawManifest(args.output, args.hash)
+  if not args.force:
+    foundCount = len(rawFiles)
+    rawFiles = [fileInfo for fileInfo in rawFiles if manifest.needsDevelop(fileInfo, developOptions)]
+    print('Skipping %d unchanged raw file(s)' %(foundCount - len(rawFiles)))
 
-def process_raw_file(fileInfo):
-  # Develop the raw file
-  RawUtils.quick_develop_raw(fileInfo['inFile'], fileInfo['outFile'], True)
-  print ('.', end='')
-
-# Hard-coded directories for testing
-IN_DIRECTORY = './TestData/001 Daisy-Yoshi/Raw'
-OUT_DIRECTORY = './TestData/001 Daisy-Yoshi/Processed'
-
-# Ensure output directory exists
-os.makedirs(OUT_DIRECTORY, exist_ok=True)
-
-# Build list of all raw files in directory
-rawFiles = []
-for filename in os.listdir(IN_DIRECTORY):
-  # Determine if this is a raw file (ends with a recognized extension)
-  if filename.lower().endswith(RawUtils.RAW_FILE_EXTENSION_LIST):
-    # Construct the full filenames for both input and output file
-    inputFile = path.join(IN_DIRECTORY, filename)
-    outputFile = path.join(OUT_DIRECTORY, filename)
-    outputFile = path.splitext(outputFile)[0] + '.tif'
-    rawFiles.append({ 'inFile': inputFile, 'outFile': outputFile })
-
-# run process_raw_file() once for each entry in the array concurrently
-with concurrent.futures.ProcessPoolExecutor() as executor:
-  executor.map(process_raw_file, rawFiles)
-print('\ndone')
+  print('Developing %d raw file(s) from %s' %(len(rawFiles), args.input))
+  if args.pipeline and not args.preview and args.cache is None:
+    summary = develop_pipelined(rawFiles, developOptions, args.readers, args.processes,
+                                args.writers, args.maxInFlight, manifest)
+  else:
+    summary = develop_batch(rawFiles, developOptions, args.processes, max(args.chunksize, 1),
+                            args.maxInFlight, manifest)
+  print_summary(summary)
+  sys.exit(1 if summary['failed'] else 0)
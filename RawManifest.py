@@ -0,0 +1,119 @@
+"""Tracks which RAW files have been developed and with what parameters."""
+
+import os
+import json
+import hashlib
+from os import path
+
+class RawManifest:
+  # Manifest file is written beside the output directory as '<output>.manifest.json'
+  MANIFEST_SUFFIX = '.manifest.json'
+  MANIFEST_VERSION = 1
+
+  # Size of each read when hashing source files
+  HASH_BLOCK_SIZE = 4 * 1024 * 1024
+
+  # Develop options that never change the developed image (the linear cache renders
+  # exactly what a direct develop does) and, for anything but previews, the thumbnail size
+  UNRECORDED_OPTION_LIST = ('cacheDirectory',)
+  PREVIEW_OPTION_LIST = ('minimumSize',)
+
+  # Create a new manifest for the given output directory (reading any existing one)
+  def __init__(self, outDirectory, useHash=False):
+    self.outDirectory = outDirectory
+    self.manifestFileName = path.normpath(outDirectory) + RawManifest.MANIFEST_SUFFIX
+    self.useHash = useHash
+    self.entries = {}
+    self.readManifest()
+
+  def readManifest(self):
+    # Try to read the manifest file allowing failure (treated as empty)
+    try:
+      with open(self.manifestFileName, 'r') as manifestFile:
+        contents = json.load(manifestFile)
+      if contents.get('version') == RawManifest.MANIFEST_VERSION:
+        self.entries = contents.get('files', {})
+    except (OSError, ValueError):
+      self.entries = {}
+
+  def saveManifest(self):
+    # Write to a temporary file first so an interrupted save never loses the manifest
+    tempFileName = self.manifestFileName + '.tmp'
+    with open(tempFileName, 'w') as manifestFile:
+      json.dump({ 'version': RawManifest.MANIFEST_VERSION, 'files': self.entries },
+                manifestFile, indent=1, sort_keys=True)
+    os.replace(tempFileName, self.manifestFileName)
+
+  @staticmethod
+  def hashFile(filename):
+    hasher = hashlib.sha1()
+    with open(filename, 'rb') as sourceFile:
+      for block in iter(lambda: sourceFile.read(RawManifest.HASH_BLOCK_SIZE), b''):
+        hasher.update(block)
+    return hasher.hexdigest()
+
+  @staticmethod
+  def hashBytes(data):
+    return hashlib.sha1(data).hexdigest()
+
+  # State of a source as it was developed, built by the worker developing it from a stat
+  # taken before the develop (so a file changed meanwhile is not recorded as current)
+  @staticmethod
+  def sourceState(stat, sourceHash=None):
+    return { 'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'hash': sourceHash }
+
+  # Entries are keyed by output file name relative to the output directory
+  def entryKey(self, fileInfo):
+    return path.relpath(fileInfo['outFile'], self.outDirectory)
+
+  # Check if a file must be (re)developed: the output is missing or came from another
+  # source (e.g. IMG_1.CR2 and IMG_1.NEF both write IMG_1.tif), the parameters changed
+  # or the source changed size, modification time (and hash if enabled)
+  def needsDevelop(self, fileInfo, developOptions):
+    entry = self.entries.get(self.entryKey(fileInfo))
+    if entry is None or not path.exists(fileInfo['outFile']):
+      return True
+
+    if entry['source'] != path.abspath(fileInfo['inFile']):
+      return True
+
+    if entry['params'] != RawManifest.paramsRecord(developOptions):
+      return True
+
+    stat = os.stat(fileInfo['inFile'])
+    if entry['size'] != stat.st_size:
+      return True
+
+    # Unchanged timestamps are trusted, otherwise fall back to the content hash
+    if entry['mtime'] != stat.st_mtime_ns:
+      if not self.useHash or entry.get('hash') is None:
+        return True
+      if entry['hash'] != RawManifest.hashFile(fileInfo['inFile']):
+        return True
+      entry['mtime'] = stat.st_mtime_ns
+
+    return False
+
+  # Record a successfully developed file from its result (which carries the sourceState()
+  # its worker took, so the source is never read again here)
+  def recordDevelop(self, result, developOptions):
+    source = result['source']
+    self.entries[self.entryKey(result)] = {
+      'source': path.abspath(result['inFile']),
+      'size': source['size'],
+      'mtime': source['mtime'],
+      'hash': source['hash'] if self.useHash else None,
+      'params': RawManifest.paramsRecord(developOptions)
+    }
+
+  # Reduce develop options to a JSON comparable record
+  @staticmethod
+  def paramsRecord(developOptions):
+    record = {}
+    for name, value in developOptions.items():
+      if name in RawManifest.UNRECORDED_OPTION_LIST:
+        continue
+      if name in RawManifest.PREVIEW_OPTION_LIST and not developOptions.get('preview', False):
+        continue
+      record[name] = list(value) if isinstance(value, tuple) else value
+    return record
@@ -0,0 +1,250 @@
+"""Overlapped read / demosaic / write pipeline for developing RAW files."""
+
+# Concurrency methods
+import concurrent.futures
+import multiprocessing
+import threading
+import queue
+
+# For timing and reading raw data from memory
+import io
+import os
+import time
+
+# Utility objects and functions for Raw processing
+import RawUtils
+from RawManifest import RawManifest
+
+# Develop options used by each stage (anything else is ignored)
+DECODE_OPTION_LIST = ('brightnessScale', 'autoWhiteBalance', 'customWhiteBalance', 'halfSize', 'bitDepth')
+WRITE_OPTION_LIST = ('compression', 'compressionLevel', 'bitDepth')
+
+# Seconds between samples of the queue depths
+QUEUE_SAMPLE_INTERVAL = 0.05
+
+''' Demosaic raw file bytes in a worker process (returns the image and time taken) '''
+def decode_raw_bytes(rawBytes, decodeOptions):
+  startTime = time.perf_counter()
+  rgbData = RawUtils.decode_raw(io.BytesIO(rawBytes), **decodeOptions)
+  return rgbData, time.perf_counter() - startTime
+
+''' Tracks the depth of each queue and how long each stage spends working '''
+class PipelineStats:
+  def __init__(self, queues):
+    self.queues = queues
+    self.depthTotals = { name: 0 for name in queues }
+    self.depthMax = { name: 0 for name in queues }
+    self.sampleCount = 0
+    self.busyTime = { 'read': 0.0, 'decode': 0.0, 'write': 0.0 }
+    self.lock = threading.Lock()
+    self.stopEvent = threading.Event()
+    self.thread = threading.Thread(target=self.sampleDepths, daemon=True)
+
+  def sampleDepths(self):
+    while not self.stopEvent.wait(QUEUE_SAMPLE_INTERVAL):
+      with self.lock:
+        self.sampleCount += 1
+        for name, stageQueue in self.queues.items():
+          depth = stageQueue.qsize()
+          self.depthTotals[name] += depth
+          self.depthMax[name] = max(self.depthMax[name], depth)
+
+  def addBusyTime(self, stage, seconds):
+    with self.lock:
+      self.busyTime[stage] += seconds
+
+  def start(self):
+    self.thread.start()
+
+  def stop(self):
+    self.stopEvent.set()
+    self.thread.join()
+
+  # Summarize as { queue: (average depth, max depth, capacity) } and the busy time of each stage
+  def report(self):
+    samples = max(self.sampleCount, 1)
+    depths = { name: (self.depthTotals[name] / samples, self.depthMax[name], stageQueue.maxsize)
+               for name, stageQueue in self.queues.items() }
+    return { 'queues': depths, 'busy': dict(self.busyTime) }
+
+''' Develop raw files with reads, demosaicing and writes all running at once:
+    - 'readers' threads prefetch raw bytes into the read queue
+    - a pool of 'processes' demosaics them (at most 'queueDepth' in flight)
+    - 'writers' threads compress and write the results from the write queue
+    onResults is called with a list of per-file results as files finish (each with the
+    state of its source from before it was read, hashed from the prefetched bytes when
+    hashSources is set so the source is read only once). Errors with one
+    file are reported in its result; any other error (e.g. raised by onResults) stops the
+    pipeline and is raised again once every stage has finished '''
+def develop_pipeline(rawFiles, developOptions, onResults, readers=2, processes=None, writers=2,
+                     queueDepth=None, hashSources=False):
+  if readers <= 0 or writers <= 0:
+    raise Exception('RAW Pipeline Error - at least one reader and one writer are needed (got %d and %d)'
+                    %(readers, writers))
+
+  processes = processes or multiprocessing.cpu_count()
+  queueDepth = queueDepth or 2 * processes
+  decodeOptions = { name: developOptions[name] for name in DECODE_OPTION_LIST if name in developOptions }
+  writeOptions = { name: developOptions[name] for name in WRITE_OPTION_LIST if name in developOptions }
+
+  # Bounded queues between the stages (the decode queue holds pending futures)
+  # - None is the end marker every stage passes on (even after a failure) so no
+  #   stage is left blocked on a queue
+  readQueue = queue.Queue(maxsize=queueDepth)
+  decodeQueue = queue.Queue(maxsize=queueDepth)
+  writeQueue = queue.Queue(maxsize=queueDepth)
+  stats = PipelineStats({ 'read': readQueue, 'decode': decodeQueue, 'write': writeQueue })
+
+  fileIterator = iter(rawFiles)
+  fileLock = threading.Lock()
+  resultLock = threading.Lock()
+
+  # The first unexpected error of any stage (after it every stage only drains its input)
+  failures = []
+  abortEvent = threading.Event()
+
+  def fail(e):
+    with resultLock:
+      failures.append(e)
+    abortEvent.set()
+
+  def nextFile():
+    with fileLock:
+      return next(fileIterator, None)
+
+  def reportResult(fileInfo, error, startTime):
+    with resultLock:
+      onResults([{ 'inFile': fileInfo['inFile'], 'outFile': fileInfo['outFile'],
+                   'bytes': fileInfo['bytes'], 'error': error, 'source': fileInfo.get('source'),
+                   'elapsed': time.perf_counter() - startTime }])
+
+  # Stage 1: prefetch raw bytes
+  def readStage():
+    try:
+      fileInfo = nextFile()
+      while fileInfo is not None and not abortEvent.is_set():
+        startTime = time.perf_counter()
+        try:
+          stat = os.stat(fileInfo['inFile'])
+          with open(fileInfo['inFile'], 'rb') as rawFile:
+            rawBytes = rawFile.read()
+          sourceHash = RawManifest.hashBytes(rawBytes) if hashSources else None
+          fileInfo = dict(fileInfo, source=RawManifest.sourceState(stat, sourceHash))
+          readQueue.put((fileInfo, startTime, rawBytes, None))
+        except Exception as e:
+          readQueue.put((fileInfo, startTime, None, '%s: %s' %(type(e).__name__, e)))
+        stats.addBusyTime('read', time.perf_counter() - startTime)
+        fileInfo = nextFile()
+    except Exception as e:
+      fail(e)
+    finally:
+      readQueue.put(None)
+
+  # Stage 2a: hand prefetched bytes to the process pool
+  def dispatchStage(executor):
+    finishedReaders = 0
+    try:
+      while finishedReaders < readers:
+        item = readQueue.get()
+        if item is None:
+          finishedReaders += 1
+          continue
+        if abortEvent.is_set():
+          continue
+
+        fileInfo, startTime, rawBytes, error = item
+        future = None
+        if error is None:
+          future = executor.submit(decode_raw_bytes, rawBytes, decodeOptions)
+        decodeQueue.put((fileInfo, startTime, future, error))
+    except Exception as e:
+      fail(e)
+      while finishedReaders < readers:
+        if readQueue.get() is None:
+          finishedReaders += 1
+    finally:
+      decodeQueue.put(None)
+
+  # Stage 2b: collect demosaiced images in submission order
+  def collectStage():
+    try:
+      item = decodeQueue.get()
+      while item is not None:
+        fileInfo, startTime, future, error = item
+        if abortEvent.is_set():
+          if future is not None:
+            future.cancel()
+        else:
+          rgbData = None
+          if future is not None:
+            try:
+              rgbData, decodeTime = future.result()
+              stats.addBusyTime('decode', decodeTime)
+            except Exception as e:
+              error = '%s: %s' %(type(e).__name__, e)
+          writeQueue.put((fileInfo, startTime, rgbData, error))
+        item = decodeQueue.get()
+    except Exception as e:
+      fail(e)
+      while decodeQueue.get() is not None:
+        pass
+    finally:
+      for _ in range(writers):
+        writeQueue.put(None)
+
+  # Stage 3: write the developed images
+  def writeStage():
+    item = writeQueue.get()
+    while item is not None:
+      fileInfo, startTime, rgbData, error = item
+      if not abortEvent.is_set():
+        try:
+          if error is None:
+            writeStart = time.perf_counter()
+            try:
+              RawUtils.write_tiff(fileInfo['outFile'], rgbData, **writeOptions)
+            except Exception as e:
+              error = '%s: %s' %(type(e).__name__, e)
+            stats.addBusyTime('write', time.perf_counter() - writeStart)
+          reportResult(fileInfo, error, startTime)
+        except Exception as e:
+          fail(e)
+      del rgbData
+      item = writeQueue.get()
+
+  startTime = time.perf_counter()
+  stats.start()
+  try:
+    # NOTE: rawpy (LibRaw with OpenMP) can deadlock in forked workers so always spawn
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes,
+                                                mp_context=multiprocessing.get_context('spawn')) as executor:
+      readerThreads = [threading.Thread(target=readStage, daemon=True) for _ in range(readers)]
+      writerThreads = [threading.Thread(target=writeStage, daemon=True) for _ in range(writers)]
+      threads = readerThreads + writerThreads + [
+        threading.Thread(target=dispatchStage, args=(executor,), daemon=True),
+        threading.Thread(target=collectStage, daemon=True)
+      ]
+      for thread in threads:
+        thread.start()
+      for thread in threads:
+        thread.join()
+  finally:
+    stats.stop()
+
+  if len(failures) > 0:
+    raise failures[0]
+
+  report = stats.report()
+  report['elapsed'] = time.perf_counter() - startTime
+  return report
+
+''' Print the queue depths and stage busy times of a pipeline run '''
+def print_pipeline_report(report):
+  print('\nPipeline queues (average / max / capacity):')
+  for name, (average, maximum, capacity) in report['queues'].items():
+    print('  %-7s %6.1f / %3d / %3d' %(name, average, maximum, capacity))
+
+  # A full queue means the stage after it is the bottleneck, an empty one the stage before it
+  print('Stage busy time (summed over workers):')
+  for name, seconds in report['busy'].items():
+    print('  %-7s %8.2fs' %(name, seconds))
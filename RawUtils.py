@@ -1,10 +1,14 @@
-# For working with directories
+# For working with directories and cache metadata
+import os
+import json
+import hashlib
 from os import path
 
-# Import the rawpy and imageio packages
-# NOTE: These must be installed with pip
+# Import the rawpy, imageio and tifffile packages
+# NOTE: These must be installed with pip (tifffile is installed along with imageio)
 import rawpy
 import imageio
+import tifffile
 
 # For dealing with arrays of colors (used by imageio)
 import numpy
@@ -17,8 +21,51 @@ RAW_FILE_EXTENSION_LIST = (
   '.sr2', '.srf', '.srw', '.x3f', '.tif'
 )
 
+# Compression choices for TIFF output (name used here -> tifffile compression)
+# NOTE: 'lzw' and 'zstd' also need the imagecodecs package installed with pip
+TIFF_COMPRESSION_LIST = { 'none': None, 'deflate': 'zlib', 'lzw': 'lzw', 'zstd': 'zstd' }
+
+# Edge length of the square tiles TIFF output is written in (must be even so
+# every tile starts on the same site of a bayer pattern)
+TIFF_TILE_SIZE = 256
+
+# Largest image data written as a classic TIFF before switching to BigTIFF
+TIFF_CLASSIC_LIMIT = 2**32 - 2**25
+
+# Supported colour filter array layouts, each naming the colour at every site of
+# the repeating 2x2 tile in row-major order (so 'RGGB' is R G over G B)
+BAYER_PATTERN_LIST = ('RGGB', 'BGGR', 'GRBG', 'GBRG')
+
+# Gamma curve (power, toe slope) of every develop (LibRaw's default BT.709 curve)
+RENDER_GAMMA = (2.222, 4.5)
+
+''' Sample an RGB image through a Bayer colour filter array into a single plane '''
+def mosaic_bayer(rgbData, pattern='RGGB', out=None):
+  # Confirm the requested layout is one we know about
+  pattern = pattern.upper()
+  if pattern not in BAYER_PATTERN_LIST:
+    raise Exception('Bayer Simulation Error - unknown CFA pattern "%s" (expected one of %s)'
+                    %(pattern, ', '.join(BAYER_PATTERN_LIST)))
+
+  # Allocate the bayer plane or confirm the one provided can hold this image
+  shape = (rgbData.shape[0], rgbData.shape[1])
+  if out is None:
+    out = numpy.empty(shape, dtype='uint16')
+  elif out.shape != shape or out.dtype != numpy.uint16:
+    raise Exception('Bayer Simulation Error - output buffer is %s %s but %s uint16 is required'
+                    %(out.shape, out.dtype, shape))
+
+  # Copy each site of the 2x2 tile across the whole image with one strided slice
+  for site, color in enumerate(pattern):
+    row, col = divmod(site, 2)
+    out[row::2, col::2] = rgbData[row::2, col::2, 'RGB'.index(color)]
+
+  return out
+
+''' Simulate a RAW capture by writing an RGB image through a Bayer filter '''
 def simulate_bayer_filter(filename_in, filename_out, overwrite=False, metadataSource='example.dng',
-                          customWhiteBalance=None):
+                          customWhiteBalance=None, pattern='RGGB', out=None, compression='deflate',
+                          compressionLevel=9, bigTiff=None, tileSize=TIFF_TILE_SIZE, cacheFile=None):
   # Confirm the input file does exist
   if not path.exists(filename_in):
     raise Exception('RAW Conversion Error - "%s" does not exist' %(filename_in))
@@ -31,28 +78,34 @@ def simulate_bayer_filter(filename_in, filename_out, overwrite=False, metadataSo
   if not type(customWhiteBalance) is tuple or not len(customWhiteBalance) == 4:
     customWhiteBalance = (1.0, 1.0, 1.0, 1.0)
 
-  # Load in original image and allocate array to store bayer image
+  # Load in original image
   rgbData = imageio.imread(filename_in)
-  bayerData = numpy.zeros((rgbData.shape[0], rgbData.shape[1]), dtype='uint16')
-
-  # Copy in RGGB bayer pattern
-  for x in range(0, rgbData.shape[0]):
-    for y in range(0, rgbData.shape[1]):
-      if y % 2 == 0:
-        if x % 2 == 0:
-          bayerData[x, y] = rgbData[x, y, 0]
-        else:
-          bayerData[x, y] = rgbData[x, y, 1]
-      else:
-        if x % 2 == 0:
-          bayerData[x, y] = rgbData[x, y, 1]
-        else:
-          bayerData[x, y] = rgbData[x, y, 2]
+  shape = (rgbData.shape[0], rgbData.shape[1])
+
+  # 'out' may be a preallocated uint16 array (e.g. the one returned by a previous
+  # call) that receives the whole plane, so batches of same-sized frames reuse it
+  # - With 'cacheFile' the plane is kept in a memory-mapped .npy file instead
+  if cacheFile is not None:
+    out = numpy.lib.format.open_memmap(cacheFile, mode='w+', dtype='uint16', shape=shape)
+  elif out is None:
+    out = numpy.empty(shape, dtype='uint16')
+  elif out.shape != shape or out.dtype != numpy.uint16:
+    raise Exception('Bayer Simulation Error - output buffer is %s %s but %s uint16 is required'
+                    %(out.shape, out.dtype, shape))
+
+  # Sample each tile through the bayer filter into its part of the plane as it is written
+  def bayerTiles():
+    for row, col in tile_origins(shape, tileSize):
+      rgbTile = rgbData[row:row + tileSize, col:col + tileSize]
+      yield mosaic_bayer(rgbTile, pattern, out[row:row + tileSize, col:col + tileSize])
 
   # Write out the bayer data
-  with imageio.get_writer(uri=filename_out, format='TIFF', mode='i') as writer:
-    writer.set_meta_data({ "compress": 9 }) # Enable compression
-    writer.append_data(bayerData)
+  write_tiff_tiles(filename_out, bayerTiles(), shape, 'uint16', compression, compressionLevel,
+                   bigTiff, tileSize)
+
+  if cacheFile is not None:
+    out.flush()
+  return out
 
 ''' Develop a RAW file at half resolution and save to normal image '''
 def quick_develop_raw(filename_in, filename_out, overwrite=False, brightnessScale=1.0,
@@ -66,9 +119,33 @@ def high_quality_develop_raw(filename_in, filename_out, overwrite=False, brightn
   develop_raw(filename_in, filename_out, overwrite, brightnessScale,
               autoWhiteBalance, customWhiteBalance, False)
 
-''' Develop a RAW file at half resolution and save to normal image '''
+''' Develop a RAW file and save to a normal image '''
 def develop_raw(filename_in, filename_out, overwrite=False, brightnessScale=1.0,
-                autoWhiteBalance=False, customWhiteBalance=None, halfSize=False):
+                autoWhiteBalance=False, customWhiteBalance=None, halfSize=False,
+                compression='deflate', compressionLevel=1, bitDepth=8, bigTiff=None):
+  # Confirm the input file does exist
+  if not path.exists(filename_in):
+    raise Exception('RAW Conversion Error - "%s" does not exist' %(filename_in))
+
+  # If overwrite is false, confirm the output file does NOT exist
+  if path.exists(filename_out) and not overwrite:
+    raise Exception('RAW Conversion Error - "%s" does exist and overwrite is False' %(filename_out))
+
+  # Develop the image and save it to the indicated output
+  rgbData = decode_raw(filename_in, brightnessScale, autoWhiteBalance, customWhiteBalance,
+                       halfSize, bitDepth)
+  write_tiff(filename_out, rgbData, compression, compressionLevel, bitDepth, bigTiff)
+
+# Output extensions that an embedded JPEG thumbnail can be copied to unchanged
+JPEG_FILE_EXTENSION_LIST = ('.jpg', '.jpeg')
+
+''' Develop a preview of a RAW file from its embedded thumbnail without decoding
+    the sensor data (falls back to a normal develop when there is no usable
+    thumbnail) and return the source that was used ('thumbnail' or 'develop') '''
+def preview_develop_raw(filename_in, filename_out, overwrite=False, brightnessScale=1.0,
+                        autoWhiteBalance=False, customWhiteBalance=None, halfSize=True,
+                        compression='deflate', compressionLevel=1, bitDepth=8, bigTiff=None,
+                        minimumSize=0):
   # Confirm the input file does exist
   if not path.exists(filename_in):
     raise Exception('RAW Conversion Error - "%s" does not exist' %(filename_in))
@@ -77,6 +154,42 @@ def develop_raw(filename_in, filename_out, overwrite=False, brightnessScale=1.0,
   if path.exists(filename_out) and not overwrite:
     raise Exception('RAW Conversion Error - "%s" does exist and overwrite is False' %(filename_out))
 
+  # Attempt to extract the embedded thumbnail (does not unpack the sensor data)
+  with rawpy.imread(filename_in) as rawImg:
+    try:
+      thumb = rawImg.extract_thumb()
+    except (rawpy.LibRawNoThumbnailError, rawpy.LibRawUnsupportedThumbnailError):
+      thumb = None
+
+  jpegOutput = filename_out.lower().endswith(JPEG_FILE_EXTENSION_LIST)
+  if thumb is not None:
+    # A JPEG thumbnail going to a JPEG file with no size requirement is copied as is
+    if thumb.format == rawpy.ThumbFormat.JPEG and jpegOutput and minimumSize <= 0:
+      with open(filename_out, 'wb') as outFile:
+        outFile.write(thumb.data)
+      return 'thumbnail'
+
+    # Otherwise decode it and make sure it is large enough to be useful
+    rgbData = imageio.imread(thumb.data) if thumb.format == rawpy.ThumbFormat.JPEG else thumb.data
+    if rgbData.ndim == 3 and max(rgbData.shape[0], rgbData.shape[1]) >= minimumSize:
+      if jpegOutput:
+        imageio.imwrite(filename_out, rgbData)
+      else:
+        write_tiff(filename_out, rgbData, compression, compressionLevel, bitDepth, bigTiff)
+      return 'thumbnail'
+
+  # No usable thumbnail so fall back to developing the sensor data
+  rgbData = decode_raw(filename_in, brightnessScale, autoWhiteBalance, customWhiteBalance,
+                       halfSize, 8 if jpegOutput else bitDepth)
+  if jpegOutput:
+    imageio.imwrite(filename_out, rgbData)
+  else:
+    write_tiff(filename_out, rgbData, compression, compressionLevel, bitDepth, bigTiff)
+  return 'develop'
+
+''' Load and demosaic a RAW file returning the developed RGB data '''
+def decode_raw(filename_in, brightnessScale=1.0, autoWhiteBalance=False,
+               customWhiteBalance=None, halfSize=False, bitDepth=8, gamma=RENDER_GAMMA):
   # Determine white balance settings
   cameraWhiteBalance = not autoWhiteBalance
   if not autoWhiteBalance and type(customWhiteBalance) is tuple and len(customWhiteBalance) == 4:
@@ -90,11 +203,239 @@ def develop_raw(filename_in, filename_out, overwrite=False, brightnessScale=1.0,
       no_auto_bright = True,
       half_size = halfSize,
       bright = brightnessScale,
+      gamma = gamma,
       use_camera_wb = cameraWhiteBalance,
       use_auto_wb = autoWhiteBalance,
-      user_wb = customWhiteBalance)
+      user_wb = list(customWhiteBalance),
+      output_bps = bitDepth)
+
+  return rgbData
+
+''' List the top-left corner of every tile covering an image '''
+def tile_origins(shape, tileSize=TIFF_TILE_SIZE):
+  for row in range(0, shape[0], tileSize):
+    for col in range(0, shape[1], tileSize):
+      yield row, col
+
+''' Convert 8 or 16 bit image data to the requested bit depth '''
+def convert_bit_depth(imageData, bitDepth):
+  if bitDepth == 8 and imageData.dtype == numpy.uint16:
+    return (imageData >> 8).astype(numpy.uint8)
+  if bitDepth == 16 and imageData.dtype == numpy.uint8:
+    return imageData.astype(numpy.uint16) * 257
+  return imageData
+
+''' Write an image to a tiled TIFF converting one tile at a time '''
+def write_tiff(filename_out, imageData, compression='deflate', compressionLevel=6, bitDepth=None,
+               bigTiff=None, tileSize=TIFF_TILE_SIZE):
+  # Keep the bit depth of the data unless asked to change it
+  if bitDepth is None:
+    bitDepth = imageData.dtype.itemsize * 8
+  if bitDepth not in (8, 16):
+    raise Exception('TIFF Output Error - unsupported bit depth %s (expected 8 or 16)' %(bitDepth))
+
+  tiles = (convert_bit_depth(imageData[row:row + tileSize, col:col + tileSize], bitDepth)
+           for row, col in tile_origins(imageData.shape, tileSize))
+  write_tiff_tiles(filename_out, tiles, imageData.shape, 'uint%d' %(bitDepth), compression,
+                   compressionLevel, bigTiff, tileSize)
+
+''' Write a TIFF from an iterator of tiles (in row-major order) so the full
+    image never needs to be held in memory in its output form '''
+def write_tiff_tiles(filename_out, tiles, shape, dtype, compression='deflate', compressionLevel=6,
+                     bigTiff=None, tileSize=TIFF_TILE_SIZE):
+  # Confirm the compression is one we know about
+  if compression not in TIFF_COMPRESSION_LIST:
+    raise Exception('TIFF Output Error - unknown compression "%s" (expected one of %s)'
+                    %(compression, ', '.join(TIFF_COMPRESSION_LIST)))
+
+  # Switch to BigTIFF when the data would not fit in a classic TIFF
+  if bigTiff is None:
+    bigTiff = numpy.prod(shape, dtype='uint64') * numpy.dtype(dtype).itemsize > TIFF_CLASSIC_LIMIT
+
+  compressionArgs = None
+  if compression in ('deflate', 'zstd') and compressionLevel is not None:
+    compressionArgs = { 'level': compressionLevel }
+
+  with tifffile.TiffWriter(filename_out, bigtiff=bool(bigTiff)) as writer:
+    writer.write(tiles, shape=shape, dtype=dtype, tile=(tileSize, tileSize),
+                 photometric=('rgb' if len(shape) == 3 else 'minisblack'),
+                 compression=TIFF_COMPRESSION_LIST[compression], compressionargs=compressionArgs)
+
+''' Measure the mean of each raw colour channel over the well exposed pixels
+    of a half size, linear, un-white-balanced develop (region is an optional
+    (left, top, width, height) crop given as fractions of the image) '''
+def measure_channel_means(filename_in, region=None, darkFraction=0.02, clipFraction=0.95):
+  with rawpy.imread(filename_in) as rawImg:
+    rgbData = rawImg.postprocess(
+      no_auto_bright = True,
+      half_size = True,
+      gamma = (1, 1),
+      output_color = rawpy.ColorSpace.raw,
+      use_camera_wb = False,
+      use_auto_wb = False,
+      user_wb = [1.0, 1.0, 1.0, 1.0],
+      output_bps = 16)
+
+  # Crop to the requested region (e.g. the gray card)
+  if region is not None:
+    height, width = rgbData.shape[0], rgbData.shape[1]
+    left, top = int(region[0] * width), int(region[1] * height)
+    right, bottom = int((region[0] + region[2]) * width), int((region[1] + region[3]) * height)
+    rgbData = rgbData[top:max(bottom, top + 1), left:max(right, left + 1)]
+
+  # Ignore clipped and nearly black pixels as they carry no colour information
+  pixels = rgbData.reshape(-1, 3)
+  valid = (pixels.max(axis=1) < clipFraction * 65535) & (pixels.min(axis=1) > darkFraction * 65535)
+  if not numpy.any(valid):
+    raise Exception('White Balance Error - "%s" has no usable pixels' %(filename_in))
+
+  return pixels[valid].mean(axis=0, dtype='float64'), int(numpy.count_nonzero(valid))
+
+''' Pick up to sampleCount frames spread evenly across a session '''
+def sample_frames(filenames, sampleCount=16):
+  step = max(len(filenames) / max(sampleCount, 1), 1)
+  return [filenames[int(i * step)] for i in range(min(sampleCount, len(filenames)))]
+
+''' Estimate one set of white balance multipliers (R, G, B, G2) for a session
+    from a gray card frame or, without one, from the gray world average of an
+    evenly spread sample of the frames '''
+def estimate_white_balance(filenames, grayCard=None, grayCardRegion=None, sampleCount=16):
+  if grayCard is not None:
+    channelMeans, _ = measure_channel_means(grayCard, grayCardRegion)
+  else:
+    if len(filenames) == 0:
+      raise Exception('White Balance Error - no frames to sample')
+
+    # Weight each sampled frame by its pixel count
+    samples = sample_frames(filenames, sampleCount)
+    channelSums = numpy.zeros(3)
+    pixelTotal = 0
+    for filename in samples:
+      # An unreadable frame is reported by the develop itself so just skip it here
+      try:
+        means, count = measure_channel_means(filename)
+      except Exception:
+        continue
+      channelSums += means * count
+      pixelTotal += count
+
+    if pixelTotal == 0:
+      raise Exception('White Balance Error - none of the %d sampled frames were usable' %(len(samples)))
+    channelMeans = channelSums / pixelTotal
+
+  red, green, blue = channelMeans
+  return (float(green / red), 1.0, float(green / blue), 1.0)
+
+# White level LibRaw scales its output curve to when auto brightening is off
+OUTPUT_CURVE_WHITE = 0x2000 << 3
+
+''' Build LibRaw's output curve as a 16 bit lookup table (the same as gamma_curve()
+    in LibRaw, which maps its linear 16 bit image to the developed values) '''
+def output_curve(brightnessScale=1.0, gamma=RENDER_GAMMA):
+  power, slope = 1.0 / gamma[0], gamma[1]
+
+  # Find where the linear toe meets the power curve (the same bisection as LibRaw)
+  toeEnd, offset = 0.0, 0.0
+  if slope and (slope - 1) * (power - 1) <= 0:
+    bounds = [0.0, 0.0]
+    bounds[1 if slope >= 1 else 0] = 1.0
+    knee = 0.0
+    for _ in range(48):
+      knee = (bounds[0] + bounds[1]) / 2
+      bounds[1 if ((knee / slope) ** -power - 1) / power - 1 / knee > -1 else 0] = knee
+    toeEnd = knee / slope
+    offset = knee * (1 / power - 1)
+
+  ratio = numpy.arange(0x10000, dtype='float64') / int(OUTPUT_CURVE_WHITE / brightnessScale)
+  curve = numpy.where(ratio < toeEnd, ratio * slope,
+                      numpy.power(ratio, power) * (1 + offset) - offset) * 0x10000
+  return numpy.where(ratio < 1, curve, 0xffff).astype('uint16')
+
+''' Decode a RAW file into a memory-mapped cache of LibRaw's linear 16 bit image
+    (white balanced and converted to sRGB but before its output curve) plus a
+    .json naming the source, unless an up-to-date cache already exists. White
+    balance is applied before demosaicing so it is part of the cache key along
+    with the source path, size and modification time. Returns the cache filename '''
+def cache_linear_raw(filename_in, cacheDirectory, halfSize=False, autoWhiteBalance=False,
+                     customWhiteBalance=None):
+  # Confirm the input file does exist
+  if not path.exists(filename_in):
+    raise Exception('RAW Conversion Error - "%s" does not exist' %(filename_in))
+
+  # Name the cache by a hash of everything that changes its contents (so sources
+  # that share a name in different directories never collide)
+  stat = os.stat(filename_in)
+  source = { 'file': path.abspath(filename_in), 'size': stat.st_size, 'mtime': stat.st_mtime_ns,
+             'halfSize': halfSize, 'autoWhiteBalance': autoWhiteBalance,
+             'customWhiteBalance': (list(customWhiteBalance) if customWhiteBalance is not None else None) }
+  cacheKey = hashlib.sha1(json.dumps(source, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+  cacheBase = path.join(cacheDirectory, '%s-%s' %(path.splitext(path.basename(filename_in))[0], cacheKey))
+  cacheFile = cacheBase + '.npy'
+  metaFile = cacheBase + '.json'
+
+  # Reuse the cache when its metadata confirms it was made from this exact source
+  try:
+    with open(metaFile, 'r') as cacheMeta:
+      meta = json.load(cacheMeta)
+    if meta['key'] == cacheKey and meta['source'] == source and path.exists(cacheFile):
+      return cacheFile
+  except (OSError, ValueError, KeyError):
+    pass
+
+  # A flat gamma (and unit brightness) leaves LibRaw's output curve as the identity
+  rgbData = decode_raw(filename_in, 1.0, autoWhiteBalance, customWhiteBalance, halfSize,
+                       bitDepth=16, gamma=(1, 1))
+
+  # Write the cache before its metadata (so a partial cache is never trusted)
+  os.makedirs(cacheDirectory, exist_ok=True)
+  if path.exists(metaFile):
+    os.remove(metaFile)
+  cache = numpy.lib.format.open_memmap(cacheFile, mode='w+', dtype='uint16', shape=rgbData.shape)
+  cache[:] = rgbData
+  cache.flush()
+  del cache
+
+  with open(metaFile, 'w') as cacheMeta:
+    json.dump({ 'key': cacheKey, 'source': source }, cacheMeta, indent=1)
+
+  return cacheFile
+
+''' Render a cached linear RAW decode to an image without touching the RAW file
+    by applying LibRaw's output curve to it (crop is an optional (left, top,
+    width, height) in cache pixels) '''
+def render_cached_raw(cacheFile, filename_out, overwrite=False, brightnessScale=1.0, crop=None,
+                      compression='deflate', compressionLevel=1, bitDepth=8, bigTiff=None,
+                      tileSize=TIFF_TILE_SIZE):
+  # If overwrite is false, confirm the output file does NOT exist
+  if path.exists(filename_out) and not overwrite:
+    raise Exception('RAW Conversion Error - "%s" does exist and overwrite is False' %(filename_out))
+
+  linearData = numpy.load(cacheFile, mmap_mode='r')
+  if crop is not None:
+    left, top, width, height = crop
+    linearData = linearData[top:top + height, left:left + width]
+
+  # LibRaw keeps the top byte of the curve for 8 bit output
+  curve = output_curve(brightnessScale)
+  if bitDepth == 8:
+    curve = (curve >> 8).astype('uint8')
+
+  # Render one tile at a time straight from the mapped cache
+  def renderedTiles():
+    for row, col in tile_origins(linearData.shape, tileSize):
+      yield curve[linearData[row:row + tileSize, col:col + tileSize]]
+
+  write_tiff_tiles(filename_out, renderedTiles(), linearData.shape, curve.dtype,
+                   compression, compressionLevel, bigTiff, tileSize)
 
-  # Save the file to the indicated output
-  with imageio.get_writer(uri=filename_out, format='TIFF', mode='i') as writer:
-    # writer.set_meta_data({ "compress": 1 }) # Enable compression
-    writer.append_data(rgbData)
+''' Develop a RAW file through the linear cache, decoding it only when the cache
+    is missing or stale so later variants (brightness, bit depth, crop and
+    compression) are I/O bound instead of decode bound '''
+def cached_develop_raw(filename_in, filename_out, overwrite=False, brightnessScale=1.0,
+                       autoWhiteBalance=False, customWhiteBalance=None, halfSize=False,
+                       compression='deflate', compressionLevel=1, bitDepth=8, bigTiff=None,
+                       cacheDirectory='cache', crop=None):
+  cacheFile = cache_linear_raw(filename_in, cacheDirectory, halfSize, autoWhiteBalance,
+                               customWhiteBalance)
+  render_cached_raw(cacheFile, filename_out, overwrite, brightnessScale, crop, compression,
+                    compressionLevel, bitDepth, bigTiff)
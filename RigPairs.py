@@ -0,0 +1,141 @@
+"""Candidate image pairs for matching derived from the fixed layout of the capture rig.
+
+Every image is placed on a (ring, camera, step) grid: the ring of cameras it
+came from, the camera index within that ring and the turntable step it was
+taken at. Only images that are close along one axis of that grid are paired,
+so the number of pairs grows as O(n * k) instead of O(n^2).
+"""
+
+import os
+import re
+import sys
+import argparse
+
+from SessionIndex import SessionIndex
+
+# Default filename pattern, e.g. 'ring2_cam07_step015.jpg' or 'r2-c7-s15.tif'
+DEFAULT_PATTERN = r'r(?:ing)?(?P<ring>\d+)[_-]c(?:am)?(?P<camera>\d+)[_-]s(?:tep)?(?P<step>\d+)'
+
+# Axes of the rig grid
+AXES = ('ring', 'camera', 'step')
+
+# Axes that wrap around (the turntable comes back to its first step)
+DEFAULT_WRAP_AXES = ('step',)
+
+# Neighbours paired along each axis
+DEFAULT_NEIGHBOURS = 2
+
+
+def parseTopology(filenames, pattern=DEFAULT_PATTERN):
+    """ {filename: (ring, camera, step)} for every filename the pattern matches
+        (groups missing from the pattern are taken as 0) """
+    expression = re.compile(pattern, re.IGNORECASE)
+    topology = {}
+    for filename in filenames:
+        match = expression.search(os.path.basename(filename))
+        if match is not None:
+            groups = match.groupdict()
+            topology[filename] = tuple(int(groups.get(axis) or 0) for axis in AXES)
+
+    return topology
+
+
+def exifTopology(filenames, firstRing=0):
+    """ {filename: (ring, camera, step)} from the EXIF data of the session index: each directory
+        is its own ring (numbered from firstRing), the camera is the rank of the body serial
+        number and the step the rank of the capture time """
+    topology = {}
+    byDirectory = {}
+    for filename in filenames:
+        byDirectory.setdefault(os.path.dirname(filename), []).append(filename)
+
+    for ring, directory in enumerate(sorted(byDirectory), firstRing):
+        names = byDirectory[directory]
+        with SessionIndex(directory) as index:
+            index.update()
+            rows = {row['name']: row for row in index.query()}
+
+        # Group by serial (falling back to model) ordered by capture time
+        captures = {}
+        for filename in names:
+            row = rows.get(os.path.basename(filename))
+            if row is not None and (row['serial'] or row['model']) and row['captured']:
+                captures.setdefault(row['serial'] or row['model'], []).append((row['captured'], filename))
+
+        for camera, serial in enumerate(sorted(captures)):
+            for step, (captured, filename) in enumerate(sorted(captures[serial])):
+                topology[filename] = (ring, camera, step)
+
+    return topology
+
+
+def placeImages(filenames, pattern=None):
+    """ {filename: (ring, camera, step)} from the filenames and, for any that don't match the
+        pattern, the EXIF data (on rings after those of the filenames so the two never share
+        a position). Images with no known position are left out """
+    topology = parseTopology(filenames, pattern or DEFAULT_PATTERN)
+    missing = [filename for filename in filenames if filename not in topology]
+    if len(missing) > 0:
+        firstRing = max((position[0] for position in topology.values()), default=-1) + 1
+        topology.update(exifTopology(missing, firstRing))
+
+    return topology
+
+
+def rigPairs(topology, neighbours=DEFAULT_NEIGHBOURS, wrapAxes=DEFAULT_WRAP_AXES):
+    """ Set of (filename, filename) pairs of images at the same grid position or within
+        'neighbours' grid positions of each other along a single axis """
+    positions = {}
+    for filename, position in topology.items():
+        positions.setdefault(position, []).append(filename)
+    sizes = [max(position[axis] for position in positions) + 1 for axis in range(len(AXES))] if positions else []
+
+    pairs = set()
+    for position, filenames in positions.items():
+        others = list(filenames)
+        for axis, name in enumerate(AXES):
+            for distance in range(1, neighbours + 1):
+                other = list(position)
+                other[axis] += distance
+                if name in wrapAxes:
+                    other[axis] %= sizes[axis]
+                others.extend(positions.get(tuple(other), []))
+
+        for filename in filenames:
+            pairs.update(tuple(sorted((filename, otherName))) for otherName in others if otherName != filename)
+
+    return pairs
+
+
+def imagePairs(filenames, pattern=None, neighbours=DEFAULT_NEIGHBOURS, wrapAxes=DEFAULT_WRAP_AXES):
+    """ Candidate pairs for a list of images placed with placeImages(). Images with no known
+        position are paired with every other image so they can still be matched. Returns
+        (pairs, unplaced filenames) """
+    topology = placeImages(filenames, pattern)
+    pairs = rigPairs(topology, neighbours, wrapAxes)
+    unplaced = [filename for filename in filenames if filename not in topology]
+    for filename in unplaced:
+        pairs.update(tuple(sorted((filename, other))) for other in filenames if other != filename)
+
+    return pairs, unplaced
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='RigPairs.py',
+        description='List the image pairs the rig topology allows to overlap.'
+    )
+    parser.add_argument('directory', help='Session directory of images.')
+    parser.add_argument('-p', '--pattern', action='store', default=DEFAULT_PATTERN, help='Filename regex with ring, camera and step groups.')
+    parser.add_argument('-k', '--neighbours', action='store', type=int, default=DEFAULT_NEIGHBOURS, help='Neighbours paired along each axis.')
+    args = parser.parse_args()
+
+    filenames = sorted(os.path.join(args.directory, entry) for entry in os.listdir(args.directory)
+                       if entry.lower().endswith(SessionIndex.INDEXED_EXTENSION_LIST))
+    pairs, unplaced = imagePairs(filenames, args.pattern, args.neighbours)
+
+    for first, second in sorted(pairs):
+        print('%s\t%s' % (os.path.basename(first), os.path.basename(second)))
+    allPairs = len(filenames) * (len(filenames) - 1) // 2
+    print('%d images, %d pairs (%.1f%% of all %d), %d without a rig position' % (
+        len(filenames), len(pairs), 100.0 * len(pairs) / max(allPairs, 1), allPairs, len(unplaced)), file=sys.stderr)
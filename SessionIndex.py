@@ -0,0 +1,156 @@
+"""An on-disk index of the images in a session directory and their EXIF data."""
+
+import os
+import sys
+import sqlite3
+import argparse
+import concurrent.futures
+
+import ExifHeader
+import RawUtils
+
+
+class SessionIndex:
+    # Index database is stored inside the session directory
+    DEFAULT_FILENAME = '.session_index.sqlite'
+
+    # Everything we index (RAW files and the developed image types MetaUtils loads)
+    INDEXED_EXTENSION_LIST = RawUtils.RAW_FILE_EXTENSION_LIST + ('.jpg', '.jpeg', '.png', '.tiff')
+
+    # Number of threads reading headers in parallel
+    DEFAULT_WORKERS = 8
+
+    COLUMNS = ('name', 'size', 'mtime', 'make', 'model', 'serial', 'captured',
+               'exposure', 'fnumber', 'iso')
+
+    # Open (or create) the index for a session directory
+    def __init__(self, directory, indexFileName=None):
+        self.directory = directory
+        self.indexFileName = indexFileName or os.path.join(directory, SessionIndex.DEFAULT_FILENAME)
+        self.db = sqlite3.connect(self.indexFileName)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS images (
+                name TEXT PRIMARY KEY, size INTEGER, mtime INTEGER,
+                make TEXT, model TEXT, serial TEXT, captured TEXT,
+                exposure REAL, fnumber REAL, iso INTEGER);
+            CREATE INDEX IF NOT EXISTS images_serial ON images (serial);
+            CREATE INDEX IF NOT EXISTS images_captured ON images (captured);
+        ''')
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+    @staticmethod
+    def readRecord(entryPath, name, size, mtime):
+        """ Build the index row for one file from its EXIF header """
+        exif = ExifHeader.readExif(entryPath)
+
+        # EXIF dates are 'YYYY:MM:DD HH:MM:SS', store as sortable 'YYYY-MM-DD HH:MM:SS'
+        captured = exif.get('dateTime')
+        if isinstance(captured, str) and len(captured) >= 19:
+            captured = captured[:10].replace(':', '-') + captured[10:19]
+        else:
+            captured = None
+
+        def number(value):
+            return value if isinstance(value, (int, float)) else None
+
+        return (name, size, mtime, exif.get('make'), exif.get('model'), exif.get('serial'), captured,
+                number(exif.get('exposureTime')), number(exif.get('fNumber')), number(exif.get('iso')))
+
+    def update(self, workers=None):
+        """ Bring the index up to date with the directory, only reading the
+            headers of new or changed files. Returns (updated, removed, unchanged) """
+        known = {row['name']: (row['size'], row['mtime'])
+                 for row in self.db.execute('SELECT name, size, mtime FROM images')}
+
+        # Find new and changed files
+        changed = []
+        seen = set()
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if not entry.is_file() or not entry.name.lower().endswith(SessionIndex.INDEXED_EXTENSION_LIST):
+                    continue
+                stat = entry.stat()
+                seen.add(entry.name)
+                if known.get(entry.name) != (stat.st_size, stat.st_mtime_ns):
+                    changed.append((entry.path, entry.name, stat.st_size, stat.st_mtime_ns))
+
+        # Read the headers of changed files in parallel (I/O bound so threads are enough)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers or SessionIndex.DEFAULT_WORKERS) as executor:
+            records = list(executor.map(lambda args: SessionIndex.readRecord(*args), changed))
+
+        removed = [name for name in known if name not in seen]
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO images VALUES (%s)' % ', '.join('?' * len(SessionIndex.COLUMNS)), records)
+            self.db.executemany('DELETE FROM images WHERE name = ?', [(name,) for name in removed])
+
+        return len(records), len(removed), len(seen) - len(records)
+
+    def query(self, camera=None, start=None, end=None, minExposure=None, maxExposure=None, extensions=None):
+        """ Return index rows (as dicts, sorted by name) matching all given filters
+            - camera matches the serial number or the model name
+            - start/end are 'YYYY-MM-DD HH:MM:SS' prefixes bounding the capture time
+            - minExposure/maxExposure bound the exposure time in seconds """
+        conditions = []
+        parameters = []
+        if camera is not None:
+            conditions.append('(serial = ? OR model = ?)')
+            parameters += [camera, camera]
+        if start is not None:
+            conditions.append('captured >= ?')
+            parameters.append(start)
+        if end is not None:
+            # Treat the end as inclusive of everything it is a prefix of
+            conditions.append('captured <= ?')
+            parameters.append(end + '\uffff')
+        if minExposure is not None:
+            conditions.append('exposure >= ?')
+            parameters.append(minExposure)
+        if maxExposure is not None:
+            conditions.append('exposure <= ?')
+            parameters.append(maxExposure)
+
+        sql = 'SELECT * FROM images'
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        rows = [dict(row) for row in self.db.execute(sql + ' ORDER BY name', parameters)]
+
+        if extensions is not None:
+            rows = [row for row in rows if row['name'].lower().endswith(tuple(extensions))]
+        return rows
+
+    def queryPaths(self, *args, **kwargs):
+        """ Same as query() but returns full paths """
+        return [os.path.join(self.directory, row['name']) for row in self.query(*args, **kwargs)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='SessionIndex.py',
+        description='Index a session directory and list the images matching some filters.'
+    )
+    parser.add_argument('directory', help='Session directory to index.')
+    parser.add_argument('-c', '--camera', action='store', help='Only images from this camera serial number or model.')
+    parser.add_argument('-s', '--start', action='store', help='Only images captured at or after this time (YYYY-MM-DD HH:MM:SS).')
+    parser.add_argument('-e', '--end', action='store', help='Only images captured at or before this time (YYYY-MM-DD HH:MM:SS).')
+    parser.add_argument('--minExposure', action='store', type=float, help='Shortest exposure time in seconds.')
+    parser.add_argument('--maxExposure', action='store', type=float, help='Longest exposure time in seconds.')
+    parser.add_argument('-j', '--workers', action='store', type=int, default=None, help='Number of threads reading headers.')
+    args = parser.parse_args()
+
+    with SessionIndex(args.directory) as index:
+        updated, removed, unchanged = index.update(args.workers)
+        print('Indexed %d new/changed, %d removed, %d unchanged' % (updated, removed, unchanged), file=sys.stderr)
+
+        for row in index.query(args.camera, args.start, args.end, args.minExposure, args.maxExposure):
+            print('%s\t%s\t%s\t%s\t%s' % (row['name'], row['serial'] or row['model'] or '-',
+                                          row['captured'] or '-', row['exposure'] or '-', row['iso'] or '-'))
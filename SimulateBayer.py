@@ -8,9 +8,9 @@ from os import path
 # Utility objects and functions for Raw processing
 import RawUtils
 
-def create_raw_file(fileInfo):
-  # Develop the raw file
-  RawUtils.simulate_bayer_filter(fileInfo['inFile'], fileInfo['outFile'], True)
+def create_raw_file(fileInfo, bayerBuffer=None):
+  # Develop the raw file (returns the bayer plane so it can be reused)
+  return RawUtils.simulate_bayer_filter(fileInfo['inFile'], fileInfo['outFile'], True, out=bayerBuffer)
 
 # Hard-coded directories for testing
 IN_DIRECTORY = '/Volumes/Samsung_T5/SimulatedScans/BackgroundMarkersHQ/raw'
@@ -30,9 +30,11 @@ for filename in os.listdir(IN_DIRECTORY):
     outputFile = path.splitext(outputFile)[0] + '.tif'
     rawFiles.append({ 'inFile': inputFile, 'outFile': outputFile })
 
-# run process_raw_file() once for each entry in the array concurrently
+# run create_raw_file() once for each entry reusing one bayer buffer (all
+# frames of a rendered scan share the same resolution)
+bayerBuffer = None
 for rawFile in rawFiles:
-  create_raw_file(rawFile)
+  bayerBuffer = create_raw_file(rawFile, bayerBuffer)
 
 RawUtils.quick_develop_raw('/Volumes/Samsung_T5/SimulatedScans/BackgroundMarkersHQ/sim/BackgroundMarkersHQ0009.dng',
   '/Volumes/Samsung_T5/SimulatedScans/BackgroundMarkersHQ/sim/BackgroundMarkersHQ0009.tif', True,
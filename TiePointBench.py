@@ -0,0 +1,132 @@
+"""Benchmark the tie point bounding-box filter against a stand-in chunk.
+
+Compares the per-point MetaUtils.checkPoint() loop with the batched
+MetaUtils.selectPointsOutsideRegion() on randomly scattered tie points and
+checks that both select exactly the same points. When Metashape is not
+installed, minimal stand-ins for Metashape.Vector and Metashape.Matrix are
+used so the benchmark can run anywhere.
+"""
+
+import sys
+import time
+import argparse
+
+import numpy as np
+
+try:
+    import Metashape
+except ImportError:
+    import types
+
+    class Vector:
+        """ Just enough of Metashape.Vector for checkPoint() """
+
+        def __init__(self, values):
+            self.values = [float(value) for value in values]
+
+        x = property(lambda self: self.values[0])
+        y = property(lambda self: self.values[1])
+        z = property(lambda self: self.values[2])
+
+        @property
+        def size(self):
+            return len(self.values)
+
+        @size.setter
+        def size(self, value):
+            self.values = (self.values + [0.0] * value)[:value]
+
+        def __getitem__(self, index):
+            return self.values[index]
+
+        def __sub__(self, other):
+            return Vector([a - b for a, b in zip(self.values, other.values)])
+
+    class Matrix:
+        """ Just enough of Metashape.Matrix for checkPoint() """
+
+        def __init__(self, rows):
+            self.rows = [[float(value) for value in row] for row in rows]
+
+        def row(self, index):
+            return Vector(self.rows[index])
+
+        def t(self):
+            return Matrix(zip(*self.rows))
+
+        def __mul__(self, vector):
+            return Vector([sum(a * b for a, b in zip(row, vector.values)) for row in self.rows])
+
+    Metashape = types.ModuleType('Metashape')
+    Metashape.Vector = Vector
+    Metashape.Matrix = Matrix
+    sys.modules['Metashape'] = Metashape
+
+from MetaUtilsClass import MetaUtils
+
+
+class StandInPoint:
+    """ A tie point with a homogeneous coordinate and selection flag """
+
+    def __init__(self, coord):
+        self._coord = coord
+        self.selected = False
+
+    # Metashape returns a new copy of the coordinate on every access
+    @property
+    def coord(self):
+        return Metashape.Vector(self._coord)
+
+
+class StandInRegion:
+    """ An oriented box like Metashape.Region """
+
+    def __init__(self, center, size, rot):
+        self.center = Metashape.Vector(center)
+        self.size = Metashape.Vector(size)
+        self.rot = Metashape.Matrix(rot)
+
+
+def makeStandIns(count, seed=0):
+    """ Scatter points around a rotated box so many of them fall outside """
+    generator = np.random.default_rng(seed)
+    coords = generator.normal(0.0, 1.0, size=(count, 3))
+    points = [StandInPoint((x, y, z, 1.0)) for x, y, z in coords.tolist()]
+
+    # Random rotation from the QR decomposition of a random matrix
+    rot, _ = np.linalg.qr(generator.normal(size=(3, 3)))
+    region = StandInRegion((0.1, -0.2, 0.05), (2.138, 1.145, 2.138), rot.tolist())
+    return points, region
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='TiePointBench.py',
+        description='Time the per-point and batched tie point filters on a stand-in chunk.'
+    )
+    parser.add_argument('-n', '--count', action='store', type=int, default=300000, help='Number of tie points.')
+    args = parser.parse_args()
+
+    points, region = makeStandIns(args.count)
+
+    startTime = time.perf_counter()
+    for point in points:
+        MetaUtils.checkPoint(point, region)
+    loopTime = time.perf_counter() - startTime
+    loopSelection = [point.selected for point in points]
+
+    for point in points:
+        point.selected = False
+
+    startTime = time.perf_counter()
+    selected = MetaUtils.selectPointsOutsideRegion(points, region)
+    batchTime = time.perf_counter() - startTime
+    batchSelection = [point.selected for point in points]
+
+    print('%d tie points, %d outside the box' % (len(points), selected))
+    print('checkPoint loop:  %8.3fs' % loopTime)
+    print('batched:          %8.3fs (%.1fx faster)' % (batchTime, loopTime / max(batchTime, 1e-9)))
+    if loopSelection != batchSelection:
+        print('MISMATCH: selections differ for %d points' % sum(a != b for a, b in zip(loopSelection, batchSelection)))
+        sys.exit(1)
+    print('Selections match')
@@ -0,0 +1,70 @@
+"""Compare file size and write time of the TIFF compression options."""
+
+# For working with files and directories
+import os
+from os import path
+
+# For command line parsing and timing
+import time
+import argparse
+import tempfile
+
+# For reading our images
+import imageio
+
+# Utility objects and functions for Raw processing
+import RawUtils
+
+''' Load an image to benchmark with (RAW files are developed first) '''
+def load_image(filename, bitDepth, halfSize):
+  if filename.lower().endswith(RawUtils.RAW_FILE_EXTENSION_LIST) and not filename.lower().endswith('.tif'):
+    return RawUtils.decode_raw(filename, halfSize=halfSize, bitDepth=bitDepth)
+  return RawUtils.convert_bit_depth(imageio.imread(filename), bitDepth)
+
+''' Write every image with one codec and report total size and time '''
+def benchmark_codec(images, outDirectory, compression, level, bitDepth):
+  totalBytes = 0
+  totalTime = 0.0
+  for index, imageData in enumerate(images):
+    filename_out = path.join(outDirectory, 'bench_%d.tif' %(index))
+    startTime = time.perf_counter()
+    RawUtils.write_tiff(filename_out, imageData, compression, level, bitDepth)
+    totalTime += time.perf_counter() - startTime
+    totalBytes += path.getsize(filename_out)
+    os.remove(filename_out)
+
+  return totalBytes, totalTime
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(
+    prog='TiffBenchmark.py',
+    description='Report the size/time trade-off of each TIFF compression option on some images.'
+  )
+  parser.add_argument('images', nargs='+', help='RAW or TIFF images to benchmark with.')
+  parser.add_argument('-d', '--bitDepth', action='store', type=int, default=8, choices=[8, 16], help='Bits per channel to write.')
+  parser.add_argument('-f', '--fullSize', action='store_true', default=False, help='Develop RAW images at full resolution.')
+  parser.add_argument('-l', '--levels', action='store', default='1,6,9', help='Comma separated deflate/zstd levels to try.')
+  args = parser.parse_args()
+
+  images = [load_image(filename, args.bitDepth, not args.fullSize) for filename in args.images]
+  rawBytes = sum(imageData.size for imageData in images) * (args.bitDepth // 8)
+  levels = [int(level) for level in args.levels.split(',')]
+
+  # Every codec/level combination to try
+  codecs = [('none', None), ('lzw', None)]
+  codecs += [('deflate', level) for level in levels]
+  codecs += [('zstd', level) for level in levels]
+
+  print('%d image(s), %.1f MB uncompressed at %d bits' %(len(images), rawBytes / 2**20, args.bitDepth))
+  print('%-8s %5s %10s %7s %9s %9s' %('codec', 'level', 'size MB', 'ratio', 'seconds', 'MB/s'))
+  with tempfile.TemporaryDirectory() as outDirectory:
+    for compression, level in codecs:
+      try:
+        totalBytes, totalTime = benchmark_codec(images, outDirectory, compression, level, args.bitDepth)
+      except Exception as e:
+        print('%-8s %5s unavailable (%s)' %(compression, '-' if level is None else level, e))
+        continue
+
+      print('%-8s %5s %10.1f %7.2f %9.2f %9.1f' %(
+        compression, '-' if level is None else level, totalBytes / 2**20, rawBytes / totalBytes,
+        totalTime, rawBytes / 2**20 / max(totalTime, 1e-9)))